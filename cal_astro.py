@@ -19,114 +19,509 @@
 '''
 
 import argparse
+import collections
 import csv
 import datetime
-import icalendar
+import io
+import itertools
+import mmap
+import os
+import pickle
+import tempfile
+import unittest
 
 from dateutil import rrule
 
+import cal_cache
 import cal_ephemeris
 import cal_holidays
+import cal_ical
+import cal_lazy
+import cal_parallel
 
+numpy = cal_lazy.lazy_import('numpy')  # only the binary almanac
 
-def gen_lunar_data(rrule_gen, eph, hol):
+CHUNK_DAYS = 64  # days computed per batch by iter_lunar_data
+TWILIGHT = (cal_ephemeris.RuleSunset.sunset,
+            cal_ephemeris.RuleSunset.nautical)
+
+# Binary almanac, a header then one record per calendar day, little endian
+ALMANAC_MAGIC = b'SJAAALMN'
+ALMANAC_FORMAT = 1  # bump when a dtype below changes
+ALMANAC_EPOCH = datetime.date(1970, 1, 1)  # 'first_day'/'date' count from
+ALMANAC_HEADER = [
+    ('magic', 'S8'),
+    ('format', '<u4'),
+    ('header_size', '<u4'),  # records start here
+    ('record_size', '<u4'),
+    ('first_day', '<i4'),  # date of record 0
+    ('days', '<u4'),  # records, one per day
+    ('reserved', 'V36'),  # pads the header to 64 bytes
+]
+ALMANAC_RECORD = [
+    ('date', '<i4'),
+    ('sunset', '<i4'),  # times in seconds after the date's local midnight
+    ('nautical', '<i4'),
+    ('illumination', '<f4'),  # percent, NaN without data
+    ('moon_rise', '<i4'),  # NO_TIME when the moon doesn't rise that night
+    ('moon_set', '<i4'),
+    ('flags', '<u4'),  # HAS_DATA | HOLIDAY
+]
+NO_TIME = -2**31
+HAS_DATA = 1  # the day was computed, other records are blank
+HOLIDAY = 2  # near a holiday weekend
+
+AlmanacDay = collections.namedtuple(
+    'AlmanacDay',
+    'date sunset nautical illumination moon_rise moon_set holiday')
+
+
+class LunarEntry(list):
+    '''One day's lunar data row, as written to the CSV after the datetime.
+
+        raw holds the unformatted (sunset, nautical, illumination, moon
+        rise, moon set) for AlmanacSink, outside the row's columns.
+    '''
+    __slots__ = ('raw', )
+
+
+def gen_lunar_data(rrule_gen, eph, hol, fast=False, threads=1):
     '''Return a list of lunar events for every date from the rrule.'''
-    data = []
-    for day in rrule_gen:
-        entry = []
-        entry.append(day)
-        entry.append(day.strftime('%b %-d %Y'))
-        entry.append(day.strftime('%a'))
-        entry.append(eph.get_sunset(day).strftime('%-I:%M %p'))
-        entry.append(
-            eph.get_sunset(
-                day, cal_ephemeris.RuleSunset.nautical).strftime('%-I:%M %p'))
-        illum, moon_rise, moon_set = eph.get_moon_visibility(day)
-        entry.append(int(round(illum)))
-        try:
-            if moon_rise.strftime('%p') == 'AM':
-                entry.append(moon_rise.strftime('%-I:%M %p (%a)'))
-            else:
-                entry.append(moon_rise.strftime('%-I:%M %p'))
-        except AttributeError:
-            entry.append('')
+    return list(iter_lunar_data(rrule_gen, eph, hol, fast, threads))
+
+
+def iter_lunar_data(rrule_gen, eph, hol, fast=False, threads=1):
+    '''Yield the lunar events for every date from the rrule, as computed.
+
+        Dates are taken CHUNK_DAYS at a time so memory stays flat.
+
+        fast - use the batch analytic sunset model (within a few seconds)
+        threads - compute the days on a pool of threads (None = default)
+    '''
+    rrule_gen = iter(rrule_gen)
+    while True:
+        days = list(itertools.islice(rrule_gen, CHUNK_DAYS))
+        if not days:
+            return
+        if fast:
+            sunsets = eph.get_sunsets(days)
+            nauticals = eph.get_sunsets(days,
+                                        cal_ephemeris.RuleSunset.nautical)
+        else:
+            sunsets = nauticals = [None] * len(days)
+        for entry in eph.map(lambda args: gen_lunar_entry(eph, hol, *args),
+                             zip(days, sunsets, nauticals), threads):
+            yield entry
+
+
+def gen_lunar_entry(eph, hol, day, sunset=None, nautical=None):
+    '''Return the lunar events for one date.'''
+    if sunset is None or nautical is None:
+        sunset, nautical = eph.twilight_ladder(day, TWILIGHT).values()
+
+    entry = LunarEntry()
+    entry.append(day)
+    entry.append(day.strftime('%b %-d %Y'))
+    entry.append(day.strftime('%a'))
+    entry.append(sunset.strftime('%-I:%M %p'))
+    entry.append(nautical.strftime('%-I:%M %p'))
+    illum, moon_rise, moon_set = eph.get_moon_visibility(day)
+    entry.append(int(round(illum)))
+    try:
+        if moon_rise.strftime('%p') == 'AM':
+            entry.append(moon_rise.strftime('%-I:%M %p (%a)'))
+        else:
+            entry.append(moon_rise.strftime('%-I:%M %p'))
+    except AttributeError:
+        entry.append('')
+    try:
+        if moon_set.strftime('%p') == 'AM':
+            entry.append(moon_set.strftime('%-I:%M %p (%a)'))
+        else:
+            entry.append(moon_set.strftime('%-I:%M %p'))
+    except AttributeError:
+        entry.append('')
+    entry.append(hol.holiday_weekend(day))
+    entry.raw = (sunset, nautical, illum, moon_rise, moon_set)
+    return entry
+
+
+def gen_year_data(year, eph, fast=False, threads=1):
+    '''Lunar data for every Friday and Saturday of a year.'''
+    return list(iter_year_data(year, eph, fast, threads))
+
+
+def iter_year_data(year, eph, fast=False, threads=1):
+    '''Yield a year's lunar data as computed, see iter_lunar_data.'''
+    hol = cal_holidays.CalHoliday(year)
+    start, until = cal_parallel.year_window(year)
+    rrule_gen = rrule.rrule(
+        rrule.WEEKLY,
+        dtstart=start,
+        until=until,
+        byweekday=(rrule.FR, rrule.SA))
+    return iter_lunar_data(rrule_gen, eph, hol, fast, threads)
+
+
+def gen_years_data(years,
+                   jobs=1,
+                   fast=False,
+                   cache_filename=None,
+                   threads=1):
+    '''Lunar data for a range of years, one year per pool task.'''
+    return list(iter_years_data(years, jobs, fast, cache_filename, threads))
+
+
+def iter_years_data(years,
+                    jobs=1,
+                    fast=False,
+                    cache_filename=None,
+                    threads=1,
+                    eph=None):
+    '''Yield lunar data for a range of years, a year at a time, in order.
+
+        With one job the years are streamed from here, a chunk of days at
+        a time, with eph, or with a CalEphemeris of its own on
+        cache_filename, closed when done.  Pool workers return whole
+        years, to cross the process boundary.
+    '''
+    if jobs is not None and jobs <= 1:
+        owned = eph is None
+        if owned:
+            eph = cal_ephemeris.CalEphemeris(_open_cache(cache_filename))
         try:
-            if moon_set.strftime('%p') == 'AM':
-                entry.append(moon_set.strftime('%-I:%M %p (%a)'))
-            else:
-                entry.append(moon_set.strftime('%-I:%M %p'))
-        except AttributeError:
-            entry.append('')
-        entry.append(hol.holiday_weekend(day))
-        data.append(entry)
+            for year in years:
+                for line in iter_year_data(year, eph, fast, threads):
+                    yield line
+        finally:
+            if owned and eph.cache:
+                eph.cache.close()
+        return
+
+    tasks = [(year, fast, threads) for year in years]
+    for data in cal_parallel.pool_imap(_gen_year, tasks, jobs, _init_worker,
+                                       (cache_filename, )):
+        for line in data:
+            yield line
+
+
+def _open_cache(cache_filename):
+    if cache_filename:
+        return cal_cache.EphemerisCache(cache_filename)
+    return None
+
+
+# ------------------------------------------------------------------------------
+# Process pool workers for gen_years_data, one CalEphemeris per process
+# ------------------------------------------------------------------------------
+_EPH = None
+
+
+def _init_worker(cache_filename):
+    global _EPH
+    _EPH = cal_ephemeris.CalEphemeris(_open_cache(cache_filename))
+
+
+def _gen_year(task):
+    year, fast, threads = task
+    data = gen_year_data(year, _EPH, fast, threads)
+    if _EPH.cache:
+        _EPH.cache.flush()
     return data
 
 
-def write_csv(filename, data):
-    '''Write out a list of lists into a CSV file.'''
-    with open(filename, 'w') as cfp:
-        cfp = csv.writer(cfp)
+# ==============================================================================
+# Output sinks, fed one line at a time by run_pipeline()
+# ==============================================================================
+class CsvSink(object):
+    '''Astro data lines to a CSV file, by name or an open text file.'''
+
+    def __init__(self, filename):
+        self.owned = isinstance(filename, str)  # close what we open
+        if self.owned:
+            self.cfp = open(filename, 'w', buffering=1)  # flush every row
+        else:
+            self.cfp = filename
+        self.writer = csv.writer(self.cfp)
         header = ('Date', 'Day', 'Sunset', 'Nautical Twilight',
                   'Illumination %', 'Moon Rise', 'Moon Set', 'Holiday')
-        cfp.writerow(header)
-        for line in data:
-            cfp.writerow(line[1:])  # omit the datetime object
+        self.writer.writerow(header)
 
+    def write(self, line):
+        self.writer.writerow(line[1:])  # omit the datetime object
 
-def write_astro_ical(filename, start, until, data, eph, hol):
-    '''Write out lunar data and other events in an iCal compatible format.'''
-    cal = icalendar.Calendar()
-    cal.add('prodid', 'Astro Calendar')
-    cal.add('version', '2.0')
-    for line in data:
+    def close(self):
+        if self.owned:
+            self.cfp.close()
+
+
+class IcsSink(object):
+    '''Astro data lines, holidays and moon phases to an iCal file.
+
+        Each line's events are serialized and written as they arrive, the
+        holidays and moon phases follow when the sink is closed.  filename
+        may also be an open binary file.
+    '''
+
+    def __init__(self, filename, start, until, eph, hol):
+        self.start = start
+        self.until = until
+        self.eph = eph
+        self.hol = hol
+
+        self.owned = isinstance(filename, str)
+        self.icfp = open(filename, 'wb') if self.owned else filename
+        self.cal = cal_ical.IcalWriter(self.icfp, 'Astro Calendar')
+
+    def add(self, date, summary):
+        self.cal.add_event(summary, date)
+
+    def write(self, line):
         date = datetime.date(line[0].year, line[0].month, line[0].day)
-        event = icalendar.Event()
-        event.add('dtstart', date)
-        event.add('summary', 'SS - {}, NT = {}\n'.format(line[3], line[4]))
-        cal.add_component(event)
+        self.add(date, 'SS - {}, NT = {}\n'.format(line[3], line[4]))
 
-        event = icalendar.Event()
-        event.add('dtstart', date)
         if line[5] < 10:
-            event.add('summary', '{}% - New Moon'.format(line[5]))
+            summary = '{}% - New Moon'.format(line[5])
         elif line[5] > 90:
-            event.add('summary', '{}% - Full Moon'.format(line[5]))
+            summary = '{}% - Full Moon'.format(line[5])
         elif line[6]:
-            event.add('summary', '{}% MR - {}'.format(line[5], line[6]))
+            summary = '{}% MR - {}'.format(line[5], line[6])
         elif line[7]:
-            event.add('summary', '{}% MS - {}'.format(line[5], line[7]))
+            summary = '{}% MS - {}'.format(line[5], line[7])
         else:
-            event.add('summary', '{}% Moon'.format(line[5]))
-        cal.add_component(event)
+            summary = '{}% Moon'.format(line[5])
+        self.add(date, summary)
+        self.icfp.flush()
+
+    def close(self):
+        # Holidays
+        for date, name in self.hol.get_holidays():
+            self.add(date, '{}\n'.format(name))
+
+        # Moon Phases
+        for phase, date in self.eph.gen_moon_phases(self.start, self.until):
+            # Cast to just date from datetime
+            self.add(date.date(), '{}: {}\n'.format(
+                str(phase), date.strftime('%-I:%M %p')))
+
+        self.cal.close()
+        if self.owned:
+            self.icfp.close()
+
+
+class AlmanacSink(object):
+    '''Astro data lines (LunarEntrys) to a binary almanac, see Almanac.
+
+        One ALMANAC_RECORD per calendar day from first to last, days
+        without a line stay blank (flags 0), so any date is at a fixed
+        offset.  The records (28 bytes a day) are filled in memory and
+        written on close.  filename may also be an open binary file.
+    '''
+
+    def __init__(self, filename, first, last):
+        self.owned = isinstance(filename, str)
+        self.afp = open(filename, 'wb') if self.owned else filename
+        self.first = first.toordinal()
+        days = last.toordinal() - self.first + 1
+        self.records = numpy.zeros(days, numpy.dtype(ALMANAC_RECORD))
+        self.records['date'] = numpy.arange(
+            self.first - ALMANAC_EPOCH.toordinal(),
+            self.first - ALMANAC_EPOCH.toordinal() + days)
+        for name in ('sunset', 'nautical', 'moon_rise', 'moon_set'):
+            self.records[name] = NO_TIME
+        self.records['illumination'] = numpy.nan
+
+    def write(self, line):
+        day = line[0]
+        i = day.toordinal() - self.first
+        if not 0 <= i < len(self.records):
+            raise ValueError('{:%Y-%m-%d} is outside the almanac'.format(day))
+        midnight = datetime.datetime(day.year, day.month, day.day)
+
+        def seconds(time):
+            if time is None:
+                return NO_TIME
+            # truncated, as strftime truncates to the minute
+            return (time - midnight) // datetime.timedelta(seconds=1)
 
-    # Holidays
-    for date, name in hol.get_holidays():
-        event = icalendar.Event()
-        event.add('dtstart', date)
-        event.add('summary', '{}\n'.format(name))
-        cal.add_component(event)
+        sunset, nautical, illum, moon_rise, moon_set = line.raw
+        self.records[i] = (self.records['date'][i], seconds(sunset),
+                           seconds(nautical), illum, seconds(moon_rise),
+                           seconds(moon_set),
+                           HAS_DATA | (HOLIDAY if line[8] else 0))
 
-    # Moon Phases
-    for phase, date in eph.gen_moon_phases(start, until):
-        event = icalendar.Event()
-        event.add('dtstart', date.date())  # Cast to just date from datetime
-        event.add('summary', '{}: {}\n'.format(
-            str(phase), date.strftime('%-I:%M %p')))
-        cal.add_component(event)
+    def close(self):
+        header = numpy.zeros((), numpy.dtype(ALMANAC_HEADER))
+        header['magic'] = ALMANAC_MAGIC
+        header['format'] = ALMANAC_FORMAT
+        header['header_size'] = header.itemsize
+        header['record_size'] = self.records.itemsize
+        header['first_day'] = self.first - ALMANAC_EPOCH.toordinal()
+        header['days'] = len(self.records)
+        self.afp.write(header.tobytes())
+        self.afp.write(self.records.tobytes())
+        if self.owned:
+            self.afp.close()
 
-    with open(filename, 'wb') as icfp:
-        icfp.write(cal.to_ical())
+
+class Almanac(object):
+    '''A binary almanac from AlmanacSink, memory mapped.
+
+        records is the read only numpy array of ALMANAC_RECORDs, one per
+        day from first, for vectorized use; get() looks a date up in O(1)
+        without reading the rest of the file.
+    '''
+
+    def __init__(self, filename):
+        header_type = numpy.dtype(ALMANAC_HEADER)
+        record_type = numpy.dtype(ALMANAC_RECORD)
+        self.afp = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(self.afp.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            self.afp.close()
+            raise ValueError('{} is not an almanac'.format(filename))
+        if len(self.map) >= header_type.itemsize:
+            header = numpy.frombuffer(self.map, header_type, 1)[0].item()
+            magic, format_, header_size, record_size, first_day, days, _ = (
+                header)
+            del header
+        if (len(self.map) < header_type.itemsize or magic != ALMANAC_MAGIC
+                or format_ != ALMANAC_FORMAT
+                or record_size != record_type.itemsize
+                or len(self.map) < header_size + days * record_size):
+            self.close()
+            raise ValueError('{} is not a format {} almanac'.format(
+                filename, ALMANAC_FORMAT))
+        self.first = ALMANAC_EPOCH + datetime.timedelta(days=first_day)
+        self.records = numpy.frombuffer(self.map, record_type, days,
+                                        header_size)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''Unmap and close the file.
+
+            Arrays taken from records keep the mapping alive, drop them
+            first, or the file stays mapped until they go.
+        '''
+        self.records = numpy.zeros(0, numpy.dtype(ALMANAC_RECORD))
+        try:
+            self.map.close()
+        except BufferError:  # someone still holds a view of records
+            pass
+        self.afp.close()
+
+    def index(self, date):
+        '''Record number of a date, or None outside the almanac.'''
+        i = date.toordinal() - self.first.toordinal()
+        return i if 0 <= i < len(self.records) else None
+
+    def get(self, date):
+        '''AlmanacDay (local datetimes) for a date, None without data.'''
+        i = self.index(date)
+        if i is None:
+            return None
+        (_, sunset, nautical, illumination, moon_rise, moon_set,
+         flags) = self.records[i].item()
+        if not flags & HAS_DATA:
+            return None
+        midnight = datetime.datetime(date.year, date.month, date.day)
+
+        def time(seconds):
+            if seconds == NO_TIME:
+                return None
+            return midnight + datetime.timedelta(seconds=seconds)
+
+        return AlmanacDay(midnight.date(), time(sunset), time(nautical),
+                          illumination, time(moon_rise), time(moon_set),
+                          bool(flags & HOLIDAY))
+
+
+def run_pipeline(data, sinks):
+    '''Fan each line out to every sink in a single pass.'''
+    try:
+        for line in data:
+            for sink in sinks:
+                sink.write(line)
+    finally:
+        for sink in sinks:
+            sink.close()
+
+
+def write_csv(filename, data):
+    '''Write out a list of lists into a CSV file.'''
+    run_pipeline(data, [CsvSink(filename)])
+
+
+def write_astro_ical(filename, start, until, data, eph, hol):
+    '''Write out lunar data and other events in an iCal compatible format.'''
+    run_pipeline(data, [IcsSink(filename, start, until, eph, hol)])
+
+
+def write_astro(years,
+                csv_file,
+                ics_file,
+                jobs=1,
+                fast=False,
+                cache_filename=None,
+                threads=1,
+                almanac_file=None):
+    '''Astro data for a range of years to CSV and iCal, in one pass.
+
+        csv_file/ics_file are filenames or open (text/binary) files,
+        almanac_file (optional) a binary almanac too, see Almanac.
+    '''
+    cache = _open_cache(cache_filename)
+    eph = cal_ephemeris.CalEphemeris(cache)
+    hol = cal_holidays.CalHoliday(years)
+
+    # Get info for every Friday and Saturday
+    start = cal_parallel.year_window(years[0])[0]
+    until = cal_parallel.year_window(years[-1])[1]
+    data = iter_years_data(years, jobs, fast, cache_filename, threads, eph)
+    sinks = [CsvSink(csv_file), IcsSink(ics_file, start, until, eph, hol)]
+    if almanac_file:
+        sinks.append(AlmanacSink(almanac_file, start, until))
+    run_pipeline(data, sinks)
+    if cache:
+        cache.close()
 
 
 def main():
     '''Main, silly lint tool.'''
     parser = argparse.ArgumentParser(description='Calendar Generator')
-    parser.add_argument(
+    years = parser.add_mutually_exclusive_group(required=True)
+    years.add_argument(
         '--year',
         type=int,
         action='store',
-        required=True,
         help='Year of the generated Calendar')
+    years.add_argument(
+        '--years',
+        type=cal_parallel.parse_years,
+        action='store',
+        help='Range of years, e.g. 2019-2028')
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        action='store',
+        default=1,
+        help='Worker processes, one year each (0 = one per core)')
+    parser.add_argument(
+        '--threads',
+        type=int,
+        action='store',
+        default=1,
+        help='Threads per process computing the days (0 = default pool)')
     parser.add_argument(
         '--filename',
         action='store',
@@ -137,23 +532,160 @@ def main():
         action='store',
         help='iCal Output Filename',
         default='astro.ics')
+    parser.add_argument(
+        '--bfilename',
+        action='store',
+        help='Binary Almanac Output Filename (memory mappable, see Almanac)')
+    parser.add_argument(
+        '--cache',
+        action='store',
+        help='Ephemeris Cache Filename (SQLite), reused between runs')
+    parser.add_argument(
+        '--fast',
+        action='store_true',
+        help='Analytic sunset/twilight times, accurate to a few seconds')
+    parser.add_argument(
+        '--profile',
+        nargs='?',
+        const='-',
+        metavar='JSON',
+        help='Count ephem calls and time each stage, report to stderr or '
+        'a JSON file (use one job)')
     args = parser.parse_args()
 
-    eph = cal_ephemeris.CalEphemeris()
-    hol = cal_holidays.CalHoliday(args.year)
+    profiler = None
+    if args.profile:
+        import cal_profile
+        profiler = cal_profile.Profiler()
+        profiler.wrap_stage('csv write', CsvSink, 'write')
+        profiler.install()
 
-    # Get info for every Friday and Saturday
-    start = datetime.datetime(args.year, 1, 1)
-    until = datetime.datetime(args.year, 12, 31)
-    rrule_gen = rrule.rrule(
-        rrule.WEEKLY,
-        dtstart=start,
-        until=until,
-        byweekday=(rrule.FR, rrule.SA))
+    years = args.years or range(args.year, args.year + 1)
+    write_astro(years, args.filename, args.ifilename, args.jobs or None,
+                args.fast, args.cache, args.threads or None, args.bfilename)
+    if profiler:
+        profiler.uninstall()
+        profiler.write(args.profile)
+
+
+# ==============================================================================
+class TestUM(unittest.TestCase):
+    def setUp(self):
+        self.eph = cal_ephemeris.CalEphemeris()
+        self.hol = cal_holidays.CalHoliday(2019)
+        fd, self.filename = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_streaming(self):
+        """Rows reach the file while later rows are still to come."""
+        days = rrule.rrule(
+            rrule.WEEKLY,
+            dtstart=datetime.datetime(2019, 1, 1),
+            byweekday=(rrule.FR, rrule.SA),
+            count=1000)
+        data = iter_lunar_data(days, self.eph, self.hol)
+        sink = CsvSink(self.filename)
+        for line in itertools.islice(data, 3):
+            sink.write(line)
+        with open(self.filename) as cfp:
+            self.assertEqual(len(cfp.readlines()), 4)
+        # only the first chunk (five memo values a day) is computed so far
+        self.assertLessEqual(self.eph.memo.stats()['size'], 5 * CHUNK_DAYS)
+        run_pipeline(itertools.islice(data, 2), [sink])
+        with open(self.filename) as cfp:
+            lines = cfp.readlines()
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[-1].startswith('Jan 18 2019,Fri,'))
+
+        # a serial multi-year run streams too, not a year at a time
+        eph = cal_ephemeris.CalEphemeris()
+        data = iter_years_data(range(2019, 2021), eph=eph)
+        self.assertEqual(next(data)[0], datetime.datetime(2019, 1, 4))
+        self.assertLessEqual(eph.memo.stats()['size'], 5 * CHUNK_DAYS)
+
+    def test_write_astro(self):
+        """Serial runs share one cache and leave no connection open."""
+        import gc
+
+        def caches():
+            gc.collect()
+            return [x for x in gc.get_objects()
+                    if isinstance(x, cal_cache.EphemerisCache) and x.db]
+
+        fd, cache_filename = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        try:
+            before = len(caches())
+            for _ in range(2):
+                write_astro(range(2019, 2020), io.StringIO(), io.BytesIO(),
+                            cache_filename=cache_filename)
+                self.assertEqual(len(caches()), before)
+        finally:
+            os.remove(cache_filename)
+
+    def test_almanac(self):
+        """Every computed day reads back at its own offset, the rest blank."""
+        first, last = datetime.datetime(2019, 1, 1), datetime.datetime(
+            2019, 1, 31)
+        days = rrule.rrule(rrule.WEEKLY, dtstart=first, until=last,
+                           byweekday=(rrule.FR, rrule.SA))
+        data = gen_lunar_data(days, self.eph, self.hol)
+        run_pipeline(data, [AlmanacSink(self.filename, first, last)])
+
+        with Almanac(self.filename) as almanac:
+            self.assertEqual(len(almanac), 31)
+            self.assertEqual(almanac.records.dtype.itemsize, 28)
+            for line in data:
+                day = almanac.get(line[0].date())
+                self.assertEqual(day.date, line[0].date())
+                self.assertEqual(day.sunset.strftime('%-I:%M %p'), line[3])
+                self.assertEqual(day.nautical.strftime('%-I:%M %p'),
+                                 line[4])
+                self.assertEqual(int(round(day.illumination)), line[5])
+                for moon, text in ((day.moon_rise, line[6]),
+                                   (day.moon_set, line[7])):
+                    self.assertEqual(
+                        moon.strftime('%-I:%M %p') if moon else '',
+                        text.split(' (')[0])
+                self.assertEqual(day.holiday, bool(line[8]))
+            self.assertIsNone(almanac.get(datetime.date(2019, 1, 7)))  # Mon
+            self.assertIsNone(almanac.get(datetime.date(2019, 2, 1)))
+
+        # rows keep their columns, the raw values survive the process pool
+        self.assertEqual(len(data[0]), 9)
+        self.assertEqual(pickle.loads(pickle.dumps(data[0])).raw,
+                         data[0].raw)
+
+        # fixed width records after the header, no parsing needed
+        with open(self.filename, 'rb') as afp:
+            raw = afp.read()
+        record = numpy.frombuffer(raw, numpy.dtype(ALMANAC_RECORD), 1,
+                                  offset=64 + 3 * 28)[0]  # Jan 4, a Friday
+        self.assertEqual(record['flags'] & HAS_DATA, HAS_DATA)
+        self.assertEqual(ALMANAC_EPOCH + datetime.timedelta(
+            days=int(record['date'])), datetime.date(2019, 1, 4))
+
+        # closed means unmapped, the file can be rewritten or replaced
+        self.assertTrue(almanac.map.closed)
+        self.assertTrue(almanac.afp.closed)
+        run_pipeline(data[:1],
+                     [AlmanacSink(self.filename, data[0][0], data[0][0])])
+        with Almanac(self.filename) as almanac:
+            self.assertEqual(len(almanac), 1)
+            replacement = self.filename + '.new'
+            run_pipeline([], [AlmanacSink(replacement, first, last)])
+        os.replace(replacement, self.filename)
+        with Almanac(self.filename) as almanac:
+            self.assertEqual(len(almanac), 31)
+            self.assertIsNone(almanac.get(first))
 
-    data = gen_lunar_data(rrule_gen, eph, hol)
-    write_csv(args.filename, data)
-    write_astro_ical(args.ifilename, start, until, data, eph, hol)
+        with open(self.filename, 'r+b') as afp:
+            afp.write(b'NOTALMNC')
+        with self.assertRaises(ValueError):
+            Almanac(self.filename)
 
 
 # -------------------------------------
@@ -0,0 +1,437 @@
+'''
+
+  Astronomy Club Event Generator
+  file: cal_bench.py
+
+  Copyright (C) 2016  Teruo Utsumi, San Jose Astronomical Association
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+'''
+
+import argparse
+import collections
+import csv
+import datetime
+import io
+import json
+import os
+import pickle
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from dateutil import rrule
+
+import cal_astro
+import cal_catalog
+import cal_ephemeris
+import cal_events
+import cal_gen
+import cal_holidays
+import cal_ical
+import cal_parallel
+
+BENCHMARKS = collections.OrderedDict()
+YEAR = 2019  # year generated by the single year benchmarks
+THRESHOLD = 0.25  # default allowed slow down vs the baseline, 25%
+NOISE_FLOOR = 0.002  # seconds, smaller differences are never regressions
+STARTUP_BUDGET = 0.2  # seconds, for a cold interpreter to start and exit
+
+
+def benchmark(func):
+    '''Register a benchmark, it returns a dict of label -> seconds.'''
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def best_of(func, repeat=3):
+    '''Best wall clock time of a few calls.'''
+    times = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - begin)
+    return min(times)
+
+
+# ==============================================================================
+# Benchmarks
+# ==============================================================================
+@benchmark
+def startup():
+    '''Cold start of a fresh interpreter, checked against STARTUP_BUDGET.'''
+    here = os.path.dirname(os.path.abspath(__file__))
+    commands = collections.OrderedDict((
+        ('python', ['-c', 'pass']),
+        ('import cal_gen', ['-c', 'import cal_gen']),
+        ('cal_gen.py --help', [os.path.join(here, 'cal_gen.py'), '--help']),
+        ('cal_astro.py --help', [os.path.join(here, 'cal_astro.py'),
+                                 '--help']),
+    ))
+
+    def run(args):
+        subprocess.run([sys.executable] + args, cwd=here, check=True,
+                       stdout=subprocess.DEVNULL)
+
+    return collections.OrderedDict(
+        (label, best_of(lambda: run(args), repeat=5))
+        for label, args in commands.items())
+
+
+@benchmark
+def astro_threads(years=4, threads=4):
+    '''cal_astro.gen_lunar_data, serial vs a thread pool (no memo reuse).'''
+    start = datetime.datetime(2019, 1, 1)
+    until = datetime.datetime(2019 + years, 1, 1)
+    days = list(
+        rrule.rrule(
+            rrule.WEEKLY,
+            dtstart=start,
+            until=until,
+            byweekday=(rrule.FR, rrule.SA)))
+    hol = cal_holidays.CalHoliday(range(2019, 2019 + years + 1))
+
+    def run(count):
+        eph = cal_ephemeris.CalEphemeris()
+        cal_astro.gen_lunar_data(days, eph, hol, threads=count)
+
+    return collections.OrderedDict((
+        ('serial', best_of(lambda: run(1))),
+        ('{} threads'.format(threads), best_of(lambda: run(threads))),
+    ))
+
+
+@benchmark
+def cal_gen_year():
+    '''A full CalGen year: init_events and every event's gen_occurances.'''
+    start, until = cal_parallel.year_window(YEAR)
+
+    def run():
+        gen = cal_gen.CalGen()
+        for event in gen.events:
+            gen.get_occurances(event, start, until)
+
+    return collections.OrderedDict((
+        ('init_events', best_of(cal_gen.CalGen)),
+        ('year', best_of(run)),
+    ))
+
+
+@benchmark
+def catalog(copies=25):
+    '''Event catalog, compiled from JSON vs the cached plan unpickled.'''
+    with open(cal_catalog.CATALOG) as cfp:
+        catalog = json.load(cfp)
+    catalog['events'] *= copies
+    text = json.dumps(catalog)
+    data = pickle.dumps(cal_catalog.compile_catalog(text),
+                        pickle.HIGHEST_PROTOCOL)
+    label = '{} events'.format(len(catalog['events']))
+    return collections.OrderedDict((
+        ('compile ' + label, best_of(
+            lambda: cal_catalog.compile_catalog(text))),
+        ('plan ' + label, best_of(lambda: pickle.loads(data))),
+    ))
+
+
+@benchmark
+def query(years=50, count=1000):
+    '''CalGen.query over a materialized schedule vs filtering every event.'''
+    gen = cal_gen.CalGen()
+    begin = time.perf_counter()
+    gen.materialize(range(YEAR, YEAR + years))
+    materialize = time.perf_counter() - begin
+    houge = cal_events.LOCATIONS[1]
+    public = cal_events.EventVisibility.public
+    windows = [(datetime.datetime(YEAR + x % years, 1 + x % 12, 1),
+                datetime.datetime(YEAR + x % years, 1 + x % 12, 28))
+               for x in range(count)]
+
+    def indexed():
+        for start, until in windows:
+            gen.query(start, until, houge, public)
+
+    def scan():
+        for start, until in windows[:count // 10]:
+            [gen.get_occurances(event, *gen.span).between(start, until)
+             for event in gen.events
+             if event.location == houge and event.visibility == public]
+
+    def after():
+        for start, _ in windows:
+            gen.next_occurance(0, start)
+
+    return collections.OrderedDict((
+        ('materialize {} years'.format(years), materialize),
+        ('{} queries'.format(count), best_of(indexed)),
+        ('{} queries by scanning'.format(count), best_of(scan) * 10),
+        ('{} next_occurance'.format(count), best_of(after)),
+    ))
+
+
+@benchmark
+def cal_gen_ics():
+    '''CalGen.gen_cal, public and private, occurances already generated.'''
+    start, until = cal_parallel.year_window(YEAR)
+    gen = cal_gen.CalGen()
+    for event in gen.events:
+        gen.get_occurances(event, start, until)
+
+    def run():
+        for public in (True, False):
+            gen.gen_cal(start, until, public, io.BytesIO())
+
+    return collections.OrderedDict((('public+private', best_of(run)), ))
+
+
+@benchmark
+def astro_year():
+    '''cal_astro.gen_year_data, every Friday and Saturday of a year.'''
+    def run():
+        cal_astro.gen_year_data(YEAR, cal_ephemeris.CalEphemeris())
+
+    return collections.OrderedDict((('year', best_of(run)), ))
+
+
+@benchmark
+def almanac(count=100):
+    '''Open a year of astro data and look a date up, CSV vs almanac.'''
+    start, until = cal_parallel.year_window(YEAR)
+    data = cal_astro.gen_year_data(YEAR, cal_ephemeris.CalEphemeris())
+    dates = [data[x % len(data)][0].date() for x in range(count)]
+    dirname = tempfile.mkdtemp()
+    filename = os.path.join(dirname, 'astro')
+    cal_astro.run_pipeline(data, [
+        cal_astro.CsvSink(filename + '.csv'),
+        cal_astro.AlmanacSink(filename + '.alm', start, until)
+    ])
+
+    def parse():
+        for date in dates:
+            with open(filename + '.csv') as cfp:
+                rows = {row[0]: row for row in csv.reader(cfp)}
+            rows[date.strftime('%b %-d %Y')]
+
+    def mapped():
+        for date in dates:
+            with cal_astro.Almanac(filename + '.alm') as almanac:
+                almanac.get(date)
+
+    try:
+        return collections.OrderedDict((
+            ('{} csv lookups'.format(count), best_of(parse)),
+            ('{} almanac lookups'.format(count), best_of(mapped)),
+        ))
+    finally:
+        for name in os.listdir(dirname):
+            os.remove(os.path.join(dirname, name))
+        os.rmdir(dirname)
+
+
+@benchmark
+def moon_phases(years=10):
+    '''CalEphemeris.gen_moon_phases over ten years.'''
+    start = datetime.datetime(YEAR, 1, 1)
+    until = datetime.datetime(YEAR + years, 1, 1)
+
+    def run():
+        eph = cal_ephemeris.CalEphemeris()
+        list(eph.gen_moon_phases(start, until))
+
+    return collections.OrderedDict((('{} years'.format(years),
+                                     best_of(run)), ))
+
+
+@benchmark
+def oppositions():
+    '''CalEphemeris.calc_opposition for all PLANETS in a year.'''
+    def run():
+        eph = cal_ephemeris.CalEphemeris()
+        for body in cal_ephemeris.PLANETS:
+            eph.calc_opposition(YEAR, body())
+
+    return collections.OrderedDict((('all planets', best_of(run)), ))
+
+
+@benchmark
+def holidays(years=10):
+    '''CalHoliday construction, one year and ten, nothing shared.'''
+    def run(span):
+        cal_holidays.CalHoliday.weekend_index.clear()
+        cal_holidays.CalHoliday(span)
+
+    return collections.OrderedDict((
+        ('1 year', best_of(lambda: run(YEAR))),
+        ('{} years'.format(years),
+         best_of(lambda: run(range(YEAR, YEAR + years)))),
+    ))
+
+
+@benchmark
+def ics_writer(events=20000):
+    '''Serialize VEVENTs, icalendar.Calendar vs the streaming IcalWriter.'''
+    import icalendar
+    day = datetime.datetime(2019, 1, 4, 19)
+    data = [('In-town Star Party', day + datetime.timedelta(days=x),
+             day + datetime.timedelta(days=x, hours=3))
+            for x in range(events)]
+
+    def tree():
+        cal = icalendar.Calendar()
+        cal.add('prodid', 'SJAA Public Events Calendar')
+        cal.add('version', '2.0')
+        for summary, dtstart, dtend in data:
+            event = icalendar.Event()
+            event.add('dtstart', dtstart)
+            event.add('dtend', dtend)
+            event.add('summary', summary)
+            cal.add_component(event)
+        return cal.to_ical()
+
+    def stream():
+        icfp = io.BytesIO()
+        with cal_ical.IcalWriter(icfp, 'SJAA Public Events Calendar') as cal:
+            for summary, dtstart, dtend in data:
+                cal.add_event(summary, dtstart, dtend)
+        return icfp.getvalue()
+
+    assert tree() == stream()
+    return collections.OrderedDict((
+        ('icalendar', best_of(tree)),
+        ('IcalWriter', best_of(stream)),
+    ))
+
+
+# ==============================================================================
+# Baselines
+# ==============================================================================
+def run(names):
+    '''Run benchmarks, return name -> label -> seconds.'''
+    return collections.OrderedDict(
+        (name, BENCHMARKS[name]()) for name in names)
+
+
+def save(filename, results):
+    '''Write results as a baseline JSON file.'''
+    baseline = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+    with open(filename, 'w') as bfp:
+        json.dump(baseline, bfp, indent=2)
+
+
+def load(filename):
+    '''Results from a baseline JSON file.'''
+    with open(filename) as bfp:
+        return json.load(bfp)['results']
+
+
+def compare(baseline, results, threshold=THRESHOLD):
+    '''Timings slower than the baseline by more than the threshold.
+
+        Only timings in both are compared, and a slow down under
+        NOISE_FLOOR seconds never counts.
+
+        input
+            baseline    dict    name -> label -> seconds
+            results     dict    name -> label -> seconds
+            threshold   float   allowed slow down, 0.25 = 25%
+        output
+            return      list    (name, label, baseline, seconds)
+    '''
+    regressions = []
+    for name, timings in results.items():
+        for label, seconds in timings.items():
+            try:
+                before = baseline[name][label]
+            except KeyError:
+                continue
+            if (seconds > before * (1 + threshold)
+                    and seconds - before > NOISE_FLOOR):
+                regressions.append((name, label, before, seconds))
+    return regressions
+
+
+def main():
+    '''Run the benchmarks, print the timings, save or compare them.'''
+    parser = argparse.ArgumentParser(description='Generator Benchmarks')
+    parser.add_argument(
+        'names',
+        nargs='*',
+        help='Benchmarks to run (default all): {}'.format(
+            ', '.join(BENCHMARKS)))
+    parser.add_argument(
+        '--save',
+        action='store',
+        help='Save the timings as a baseline JSON file')
+    parser.add_argument(
+        '--compare',
+        action='store',
+        help='Baseline JSON file, exit 1 on any regression')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        action='store',
+        default=THRESHOLD,
+        help='Allowed slow down vs the baseline (default {})'.format(
+            THRESHOLD))
+    args = parser.parse_args()
+
+    baseline = load(args.compare) if args.compare else {}
+    results = collections.OrderedDict()
+    for name in args.names or BENCHMARKS:
+        results[name] = BENCHMARKS[name]()
+        for label, seconds in results[name].items():
+            line = '{:24} {:24} {:9.4f}s'.format(name, label, seconds)
+            before = baseline.get(name, {}).get(label)
+            if before:
+                line += ' {:+7.1%}'.format(seconds / before - 1)
+            print(line)
+
+    status = 0
+    for label, seconds in results.get('startup', {}).items():
+        if seconds > STARTUP_BUDGET:
+            print('OVER BUDGET startup {}: {:.4f}s > {}s'.format(
+                label, seconds, STARTUP_BUDGET))
+            status = 1
+
+    if args.save:
+        save(args.save, results)
+    if args.compare:
+        regressions = compare(baseline, results, args.threshold)
+        for name, label, before, seconds in regressions:
+            print('REGRESSION {} {}: {:.4f}s -> {:.4f}s'.format(
+                name, label, before, seconds))
+        return 1 if regressions else status
+    return status
+
+
+# ==============================================================================
+class TestUM(unittest.TestCase):
+    def test_compare(self):
+        """Only slow downs past the threshold and the noise floor count."""
+        baseline = {'astro_year': {'year': 1.0, 'gone': 1.0},
+                    'holidays': {'1 year': 0.001}}
+        results = {'astro_year': {'year': 1.3, 'new': 9.0},
+                   'holidays': {'1 year': 0.002}}
+        self.assertEqual(compare(baseline, results),
+                         [('astro_year', 'year', 1.0, 1.3)])
+        self.assertEqual(compare(baseline, results, threshold=0.5), [])
+
+
+# -------------------------------------
+if __name__ == '__main__':
+    exit(main())
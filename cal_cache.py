@@ -0,0 +1,328 @@
+'''
+
+  Astronomy Club Event Generator
+  file: cal_cache.py
+
+  Copyright (C) 2016  Teruo Utsumi, San Jose Astronomical Association
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+'''
+
+import atexit
+import collections
+import datetime
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+import ephem
+
+# ==============================================================================
+# Constants
+# ==============================================================================
+CACHE_FORMAT = '4'  # bump when the stored layout/encoding changes
+FLUSH_COUNT = 500  # commit pending writes after this many new entries
+MEMO_SIZE = 4096  # default number of in-process memo entries
+
+
+# ==============================================================================
+# Value encoding, JSON plus tagged datetimes
+# ==============================================================================
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return {'dt': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'d': value.isoformat()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(x) for x in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if 'dt' in value:
+            return datetime.datetime.fromisoformat(value['dt'])
+        return datetime.date.fromisoformat(value['d'])
+    if isinstance(value, list):
+        return [_decode(x) for x in value]
+    return value
+
+
+def local_zone():
+    '''The process' local time zone, as names and UTC offsets.
+
+        Cached datetimes are naive local times (ephem.localtime), only
+        valid for the zone they were computed in.
+    '''
+    return '{}/{},{}/{}'.format(time.tzname[0], time.tzname[1],
+                                time.timezone, time.altzone)
+
+
+def date_key(date):
+    '''Normalize a date/datetime into a cache key string.
+
+        A datetime at midnight and the plain date hit the same entry.
+    '''
+    if isinstance(date, datetime.datetime):
+        if date.time() == datetime.time(0, 0):
+            return date.date().isoformat()
+    return date.isoformat()
+
+
+# ==============================================================================
+# In-process LRU memo
+# ==============================================================================
+class Memo(object):
+    '''Bounded least-recently-used memo with hit/miss counters.'''
+
+    def __init__(self, size=MEMO_SIZE):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''Return the memoized value, raise KeyError if we don't have it.'''
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries)
+        }
+
+
+# ==============================================================================
+# Persistent Ephemeris Cache
+# ==============================================================================
+class EphemerisCache(object):
+    '''SQLite backed store of computed ephemeris values.
+
+        Entries are keyed by (site, quantity, date) where site is the
+        observer "lat,long,elevation" string, quantity names the value (and
+        horizon) e.g. 'sunset:-12', and date comes from date_key().  The
+        whole store is dropped when the ephem version it was built with
+        differs from the one installed.  Sites are stored per local time
+        zone (see local_zone()), a cache shared by processes in different
+        zones keeps separate values for each.
+    '''
+
+    def __init__(self, filename, zone=None):
+        self.filename = filename
+        self.zone = zone or local_zone()
+        # shared by every thread, serialized through self.lock
+        self.db = sqlite3.connect(
+            filename, timeout=60, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta '
+                        '(key TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS ephem '
+                        '(site TEXT, quantity TEXT, date TEXT, value TEXT, '
+                        'PRIMARY KEY (site, quantity, date))')
+        self.sites = {}  # site -> {(quantity, date): value}, loaded lazily
+        self.pending = []
+        self._check_version()
+        atexit.register(self.close)
+
+    def _check_version(self):
+        '''Drop everything if built by a different ephem/cache version.'''
+        version = '{}/{}'.format(ephem.__version__, CACHE_FORMAT)
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row and row[0] == version:
+            return
+        self.db.execute('DELETE FROM ephem')
+        self.db.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version, ))
+        self.db.commit()
+
+    def _load(self, site):
+        entries = self.sites.get(site)
+        if entries is None:
+            with self.lock:
+                entries = {}
+                rows = self.db.execute(
+                    'SELECT quantity, date, value FROM ephem WHERE site = ?',
+                    (self._zoned(site), ))
+                for quantity, date, value in rows:
+                    entries[(quantity, date)] = _decode(json.loads(value))
+                self.sites[site] = entries
+        return entries
+
+    def _zoned(self, site):
+        return '{}@{}'.format(site, self.zone)
+
+    # --------------------------------------
+    def get(self, site, quantity, date):
+        '''Return the cached value, raise KeyError if we don't have it.'''
+        return self._load(site)[(quantity, date)]
+
+    def put(self, site, quantity, date, value):
+        with self.lock:
+            self._load(site)[(quantity, date)] = value
+            self.pending.append((self._zoned(site), quantity, date,
+                                 json.dumps(_encode(value))))
+            if len(self.pending) >= FLUSH_COUNT:
+                self.flush()
+
+    def flush(self):
+        '''Commit any pending entries to disk.'''
+        with self.lock:
+            if self.pending and self.db:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO ephem VALUES (?, ?, ?, ?)',
+                    self.pending)
+                self.db.commit()
+            self.pending = []
+
+    def invalidate(self, site=None):
+        '''Forget entries for one observer site, or everything.'''
+        with self.lock:
+            self.pending = [
+                x for x in self.pending if site and x[0] != self._zoned(site)
+            ]
+            if site:
+                self.sites.pop(site, None)
+                self.db.execute('DELETE FROM ephem WHERE site = ?',
+                                (self._zoned(site), ))
+            else:
+                self.sites = {}
+                self.db.execute('DELETE FROM ephem')
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db:
+                self.flush()
+                self.db.close()
+                self.db = None
+        atexit.unregister(self.close)  # or it keeps the cache alive
+
+
+# ==============================================================================
+class TestUM(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.cache = EphemerisCache(self.filename)
+
+    def tearDown(self):
+        self.cache.close()
+        os.remove(self.filename)
+
+    def test_round_trip(self):
+        """Values survive a close and reopen."""
+        sunset = datetime.datetime(2018, 7, 31, 20, 16, 19, 349778)
+        self.cache.put('site', 'sunset:0', '2018-08-01', sunset)
+        self.cache.put('site', 'moon_rise', '2018-08-15', None)
+        self.cache.close()
+
+        self.cache = EphemerisCache(self.filename)
+        self.assertEqual(sunset,
+                         self.cache.get('site', 'sunset:0', '2018-08-01'))
+        self.assertIsNone(self.cache.get('site', 'moon_rise', '2018-08-15'))
+        with self.assertRaises(KeyError):
+            self.cache.get('other', 'sunset:0', '2018-08-01')
+
+    def test_zone(self):
+        """Local times from one time zone aren't read back in another."""
+        sunset = datetime.datetime(2018, 7, 31, 20, 16)
+        self.cache.close()
+        self.cache = EphemerisCache(self.filename, 'PST/PDT,28800/25200')
+        self.cache.put('site', 'sunset:0', '2018-08-01', sunset)
+        self.cache.close()
+        self.cache = EphemerisCache(self.filename, 'EST/EDT,18000/14400')
+        with self.assertRaises(KeyError):
+            self.cache.get('site', 'sunset:0', '2018-08-01')
+        self.cache.close()
+        self.cache = EphemerisCache(self.filename, 'PST/PDT,28800/25200')
+        self.assertEqual(sunset,
+                         self.cache.get('site', 'sunset:0', '2018-08-01'))
+
+    def test_close(self):
+        """A closed cache isn't kept alive by its exit hook."""
+        import gc
+        import weakref
+        cache = weakref.ref(self.cache)
+        self.cache.close()
+        self.cache = EphemerisCache(self.filename)
+        gc.collect()
+        self.assertIsNone(cache())
+
+    def test_invalidate(self):
+        """Explicit invalidation of a single observer site."""
+        self.cache.put('a', 'illum', '2018-08-01', 79.0)
+        self.cache.put('b', 'illum', '2018-08-01', 79.0)
+        self.cache.invalidate('a')
+        with self.assertRaises(KeyError):
+            self.cache.get('a', 'illum', '2018-08-01')
+        self.assertEqual(79.0, self.cache.get('b', 'illum', '2018-08-01'))
+
+    def test_version(self):
+        """A different ephem version throws the stored values away."""
+        self.cache.put('site', 'illum', '2018-08-01', 79.0)
+        self.cache.db.execute(
+            "UPDATE meta SET value = 'old' WHERE key = 'version'")
+        self.cache.close()
+        self.cache = EphemerisCache(self.filename)
+        with self.assertRaises(KeyError):
+            self.cache.get('site', 'illum', '2018-08-01')
+
+    def test_memo(self):
+        """Least recently used entries are evicted first."""
+        memo = Memo(2)
+        memo.put('a', 1)
+        memo.put('b', 2)
+        self.assertEqual(1, memo.get('a'))
+        memo.put('c', 3)
+        with self.assertRaises(KeyError):
+            memo.get('b')
+        self.assertEqual(3, memo.get('c'))
+        self.assertEqual({'hits': 2, 'misses': 1, 'size': 2}, memo.stats())
+
+    def test_date_key(self):
+        """Midnight datetimes and dates share a key."""
+        self.assertEqual(
+            date_key(datetime.date(2018, 8, 1)),
+            date_key(datetime.datetime(2018, 8, 1)))
+        self.assertNotEqual(
+            date_key(datetime.date(2018, 8, 1)),
+            date_key(datetime.datetime(2018, 8, 1, 12)))
+
+
+# ==============================================================================
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,271 @@
+'''
+
+  Astronomy Club Event Generator
+  file: cal_catalog.py
+
+  Copyright (C) 2016  Teruo Utsumi, San Jose Astronomical Association
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+'''
+
+import collections
+import datetime
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import cal_events
+
+# ==============================================================================
+# Constants
+# ==============================================================================
+CATALOG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'events.json')
+CATALOG_FORMAT = 1  # "format" of the catalogs we can read
+PLAN_FORMAT = 2  # bump when EventPlan or compile() changes
+PLAN_DIR = '__pycache__'  # next to the catalog, like Python's bytecode
+
+WEEKDAYS = {
+    'MON': cal_events.MON,
+    'TUE': cal_events.TUE,
+    'WED': cal_events.WED,
+    'THU': cal_events.THU,
+    'FRI': cal_events.FRI,
+    'SAT': cal_events.SAT,
+    'SUN': cal_events.SUN,
+}
+
+# One event compiled from the catalog, date_rule/time_rule name the
+# CalEvent helper (lunar, lunar_yearly, monthly, yearly / times,
+# sunset_times) called with the args.  location is the LOCATIONS key,
+# looked up by build() so edited coordinates aren't pickled in the plan
+EventPlan = collections.namedtuple(
+    'EventPlan', 'name visibility location url description '
+    'date_rule date_args time_rule time_args')
+
+
+# ==============================================================================
+# Catalog -> plan
+# ==============================================================================
+def _time(value):
+    return datetime.time.fromisoformat(value) if value else None
+
+
+def compile_event(entry):
+    '''EventPlan for one catalog entry, ValueError if it doesn't make sense.
+
+        Date rules, with "weekday" (MON..SUN):
+            "lunar": phase (moon_new, moon_1q, ...) [and "months": [...]]
+            "monthly": week of the month
+            "yearly": week of the month, with "month"
+        Time rules:
+            "times": {"start": "19:30", "duration": hours}
+            "sunset_times": {"sunset": nautical..., "earliest": "19:00" or
+                             null, "offset": hours, "length": hours}
+    '''
+    name = entry.get('name')
+    try:
+        weekday = WEEKDAYS[entry['weekday']]
+        if 'lunar' in entry:
+            phase = cal_events.RuleLunar[entry['lunar']]
+            if 'months' in entry:
+                date_rule = 'lunar_yearly'
+                date_args = (phase, weekday, tuple(entry['months']))
+            else:
+                date_rule, date_args = 'lunar', (phase, weekday)
+        elif 'monthly' in entry:
+            date_rule, date_args = 'monthly', (entry['monthly'], weekday)
+        elif 'yearly' in entry:
+            date_rule = 'yearly'
+            date_args = (entry['month'], entry['yearly'], weekday)
+        else:
+            raise KeyError('lunar, monthly or yearly')
+
+        if 'times' in entry:
+            times = entry['times']
+            time_rule = 'times'
+            time_args = (_time(times['start']), times.get('duration', 1))
+        elif 'sunset_times' in entry:
+            times = entry['sunset_times']
+            time_rule = 'sunset_times'
+            time_args = (cal_events.RuleSunset[times['sunset']],
+                         _time(times.get('earliest')),
+                         times.get('offset', 0), times.get('length', 1))
+        else:
+            raise KeyError('times or sunset_times')
+
+        location = entry['location']
+        cal_events.LOCATIONS[location]  # KeyError if there's no such site
+        return EventPlan(name,
+                         cal_events.EventVisibility[entry['visibility']],
+                         location,
+                         entry.get('url'), entry.get('description', ''),
+                         date_rule, date_args, time_rule, time_args)
+    except (KeyError, TypeError, ValueError) as err:
+        raise ValueError('catalog event {!r}: bad or missing {}'.format(
+            name, err))
+
+
+def compile_catalog(text):
+    '''The plan, a tuple of EventPlans in catalog order, from JSON text.'''
+    catalog = json.loads(text)
+    if catalog.get('format') != CATALOG_FORMAT:
+        raise ValueError('catalog format {!r}, expected {}'.format(
+            catalog.get('format'), CATALOG_FORMAT))
+    return tuple(compile_event(x) for x in catalog['events'])
+
+
+# ==============================================================================
+# Plans cached by content hash
+# ==============================================================================
+def plan_filename(filename, data):
+    '''Where the plan for this catalog content is cached.'''
+    digest = hashlib.sha1(data)
+    digest.update(str(PLAN_FORMAT).encode('ascii'))
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(
+        os.path.dirname(os.path.abspath(filename)), PLAN_DIR,
+        '{}.{}.plan'.format(stem, digest.hexdigest()[:20]))
+
+
+def load(filename=CATALOG):
+    '''The plan for a catalog file, compiled once per content.
+
+        A catalog is compiled on first use and the plan pickled next to
+        it, later runs with the same bytes only unpickle.  A plan that
+        can't be written (read only directory) is just not cached.
+    '''
+    with open(filename, 'rb') as cfp:
+        data = cfp.read()
+    cached = plan_filename(filename, data)
+    try:
+        with open(cached, 'rb') as pfp:
+            return pickle.load(pfp)
+    except (OSError, pickle.PickleError, EOFError, AttributeError):
+        pass
+
+    plan = compile_catalog(data.decode('utf-8'))
+    try:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(cached))
+        with os.fdopen(fd, 'wb') as pfp:
+            pickle.dump(plan, pfp, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, cached)
+    except OSError:
+        pass
+    return plan
+
+
+def build(plan, eph):
+    '''New CalEvents, in plan order, computing with eph.'''
+    events = []
+    for item in plan:
+        event = cal_events.CalEvent(eph)
+        event.name = item.name
+        event.visibility = item.visibility
+        event.location = cal_events.LOCATIONS[item.location]
+        event.url = item.url
+        event.description = item.description
+        getattr(event, item.date_rule)(*item.date_args)
+        getattr(event, item.time_rule)(*item.time_args)
+        events.append(event)
+    return events
+
+
+# ==============================================================================
+class TestUM(unittest.TestCase):
+    CATALOG = {
+        'format': 1,
+        'events': [{
+            'name': 'Dark Sky Night',
+            'visibility': 'member',
+            'location': 4,
+            'lunar': 'moon_new',
+            'weekday': 'SAT',
+            'sunset_times': {
+                'sunset': 'civil',
+                'earliest': '19:00',
+                'length': 4
+            },
+        }, {
+            'name': 'Imaging SIG',
+            'visibility': 'public',
+            'location': 1,
+            'monthly': 3,
+            'weekday': 'TUE',
+            'times': {
+                'start': '19:30',
+                'duration': 2
+            },
+        }]
+    }
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, 'club.json')
+        with open(self.filename, 'w') as cfp:
+            json.dump(self.CATALOG, cfp)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_compile(self):
+        """Same rules as the CalEvent helpers would give."""
+        from unittest import mock
+        dark_sky, image_sig = build(load(self.filename), None)
+        event = cal_events.CalEvent(None)
+        event.location = cal_events.LOCATIONS[4]
+        event.lunar(cal_events.RuleLunar.moon_new, cal_events.SAT)
+        event.sunset_times(cal_events.RuleSunset.civil,
+                           datetime.time(hour=19), 0, 4)
+        self.assertEqual(dark_sky.fingerprint(), event.fingerprint())
+        self.assertEqual(dark_sky.visibility,
+                         cal_events.EventVisibility.member)
+        self.assertEqual(image_sig.date_rules['byweekday'],
+                         cal_events.TUE(3))
+        self.assertEqual(image_sig.duration, datetime.timedelta(hours=2))
+
+        # sites are looked up when built, not frozen into the plan
+        moved = cal_events.LOCATIONS[4]._replace(lat='37.1')
+        with mock.patch.dict(cal_events.LOCATIONS, {4: moved}):
+            self.assertEqual(build(load(self.filename), None)[0].location,
+                             moved)
+
+        entry = dict(self.CATALOG['events'][1], weekday='Tuesday')
+        with self.assertRaises(ValueError):
+            compile_event(entry)
+
+    def test_cache(self):
+        """The second load unpickles, an edit compiles a new plan."""
+        plan = load(self.filename)
+        with open(self.filename, 'rb') as cfp:
+            cached = plan_filename(self.filename, cfp.read())
+        self.assertTrue(os.path.exists(cached))
+        with open(cached, 'wb') as pfp:
+            pickle.dump(plan[:1], pfp)  # prove load() reads the pickle
+        self.assertEqual(load(self.filename), plan[:1])
+
+        catalog = json.loads(json.dumps(self.CATALOG))
+        catalog['events'][1]['times']['duration'] = 3
+        with open(self.filename, 'w') as cfp:
+            json.dump(catalog, cfp)
+        plan = load(self.filename)
+        self.assertEqual(plan[1].time_args[1], 3)
+        self.assertEqual(len(os.listdir(os.path.dirname(cached))), 2)
+
+
+# ==============================================================================
+if __name__ == '__main__':
+    unittest.main()
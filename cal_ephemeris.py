@@ -23,14 +23,26 @@
                     - lint cleanup, add start/until members
 '''
 
+import bisect
+import calendar
+import collections
+import copy
 import datetime
 import math
+import os
+import tempfile
+import threading
 import unittest
 
 import ephem
 
+import cal_lazy
+from cal_cache import MEMO_SIZE, EphemerisCache, Memo, date_key
 from cal_events import RuleLunar, RuleSunset
 
+futures = cal_lazy.lazy_import('concurrent.futures')
+numpy = cal_lazy.lazy_import('numpy')  # only the batch sunset model
+
 # ==============================================================================
 # Ephem Constants
 # ==============================================================================
@@ -46,16 +58,45 @@ LAT = '37.257465'
 LONG = '-121.942281'
 ELEVATION = 50
 
+# cache site of values that don't depend on the observer (moon phases...)
+SHARED_SITE = 'geocentric'
+
 ########################################
 # Astro objects
 ########################################
-MOON = ephem.Moon()
-PLANETS = (ephem.Mars(), ephem.Jupiter(), ephem.Saturn(), ephem.Uranus(),
-           ephem.Neptune(), ephem.Pluto())
+# body classes, instantiated per call so nothing mutable is shared
+PLANETS = (ephem.Mars, ephem.Jupiter, ephem.Saturn, ephem.Uranus,
+           ephem.Neptune, ephem.Pluto)
+
+LUNATION_ZERO = datetime.datetime(
+    2000, 1, 6, 18, 14, tzinfo=datetime.timezone.utc).timestamp()
+SYNODIC_MONTH = 29.530588853 * 24 * 3600  # seconds
 
 EPHEM_SECOND = ephem.second
 EPHEM_DAY = ephem.hour * 24
 EPHEM_MONTH = EPHEM_DAY * 30
+EPHEM_UNIX = 25567.5  # ephem.Date of the unix epoch
+
+########################################
+# Analytic solar model (get_sunsets)
+########################################
+UNIX_JD = 2440587.5  # Julian day of the unix epoch
+SUN_SEMIDIAMETER = math.radians(959.63 / 3600)  # at 1 AU
+SUNSETS_MAX_ERROR = 5  # seconds vs get_sunset, 1900-2100 at Houge Park
+SUNSETS_REFINE_LEAD = 600  # seconds, start refinement before the estimate
+TWILIGHT_CHAIN_ALT = math.radians(1)  # sun altitude to chain the ladder
+
+########################################
+# Nightly moon solver (moon_night)
+########################################
+MoonNight = collections.namedtuple('MoonNight', 'illum rise set')
+MOON_HORIZON_MARGIN = math.radians(1)  # rise or set too close to call
+
+########################################
+# Opposition finder (calc_oppositions)
+########################################
+OPPOSITION_GRID = EPHEM_MONTH * 3  # well under half a synodic period
+OPPOSITION_ITERATIONS = 40  # regula falsi steps, converges in under 10
 
 SEASONS = {
     'spring': (ephem.next_vernal_equinox, 'Spring Equinox'),
@@ -76,28 +117,298 @@ NEXT_MOON_PHASE = {
 }
 
 
+# ==============================================================================
+# Vectorized Solar Model
+# ==============================================================================
+def solar_position(jd):
+    '''Low precision (NOAA/Meeus) apparent solar position.
+
+        input
+            jd      numpy.array     Julian days (UT)
+        output
+            return  tuple           declination (radians), equation of time
+                                    (minutes), distance (AU) arrays
+    '''
+    t = (jd - 2451545.0) / 36525.0
+    l0 = numpy.radians((280.46646 + t * (36000.76983 + t * 0.0003032)) % 360)
+    m = numpy.radians(357.52911 + t * (35999.05029 - 0.0001537 * t))
+    e = 0.016708634 - t * (0.000042037 + 0.0000001267 * t)
+    c = numpy.radians(
+        numpy.sin(m) * (1.914602 - t * (0.004817 + 0.000014 * t)) +
+        numpy.sin(2 * m) * (0.019993 - 0.000101 * t) +
+        numpy.sin(3 * m) * 0.000289)
+    omega = numpy.radians(125.04 - 1934.136 * t)
+    lam = l0 + c - numpy.radians(0.00569 + 0.00478 * numpy.sin(omega))
+    eps = numpy.radians(23 + (26 + (
+        21.448 - t * (46.815 + t * (0.00059 - t * 0.001813))) / 60) / 60 +
+                        0.00256 * numpy.cos(omega))
+
+    decl = numpy.arcsin(numpy.sin(eps) * numpy.sin(lam))
+    y = numpy.tan(eps / 2)**2
+    eot = 4 * numpy.degrees(
+        y * numpy.sin(2 * l0) - 2 * e * numpy.sin(m) +
+        4 * e * y * numpy.sin(m) * numpy.cos(2 * l0) -
+        0.5 * y * y * numpy.sin(4 * l0) - 1.25 * e * e * numpy.sin(2 * m))
+    dist = 1.000001018 * (1 - e * e) / (1 + e * numpy.cos(m + c))
+    return decl, eot, dist
+
+
+class SolarTable(object):
+    '''solar_position() at 0h UT of every unix day in [first, last].
+
+        Site independent, so one table serves every observer: each site
+        interpolates it at its own instants, within a second of computing
+        solar_position() there (the position changes smoothly over a day).
+    '''
+
+    def __init__(self, first, last):
+        self.first = first
+        self.last = last
+        self.columns = solar_position(UNIX_JD +
+                                      numpy.arange(first, last + 1.0))
+
+    def interpolate(self, days):
+        '''declination, equation of time, distance at unix days (floats).'''
+        whole = numpy.floor(days)
+        frac = days - whole  # NaN (no setting) stays NaN
+        i = (numpy.nan_to_num(whole, nan=self.first) - self.first).astype(int)
+        return tuple(x[i] + (x[i + 1] - x[i]) * frac for x in self.columns)
+
+
+def utc_seconds(date):
+    '''Unix time of a date/naive datetime, taken as UTC like ephem does.'''
+    seconds = calendar.timegm(date.timetuple())
+    if isinstance(date, datetime.datetime):
+        seconds += date.microsecond / 1e6
+    return seconds
+
+
+# ==============================================================================
+# Opposition Finder
+# ==============================================================================
+def ecliptic_lon(body, date):
+    '''Ecliptic longitude (radians, equinox of date) of a computed body.'''
+    return float(
+        ephem.Ecliptic(
+            ephem.Equatorial(body.a_ra, body.a_dec, epoch=body.a_epoch),
+            epoch=date).lon)
+
+
+def find_opposition(planet, start, end):
+    '''Time of opposition bracketed by start and end (ephem dates).
+
+        Opposition is the root of g = (lon - sun lon) mod 2pi - pi, which
+        falls smoothly through zero where the planet's elongation jumps
+        from -pi to +pi.  Regula falsi with the Illinois modification gets
+        to EPHEM_SECOND in a handful of evaluations.
+
+        input
+            planet  ephem.<planet>()    planet object
+            start   float               ephem date before opposition
+            end     float               ephem date after opposition
+        output
+            return  float               ephem date of opposition
+    '''
+    sun = ephem.Sun()
+
+    def g(date):
+        planet.compute(date)
+        sun.compute(date)
+        lon = ecliptic_lon(planet, date) - ecliptic_lon(sun, date)
+        return lon % (2 * math.pi) - math.pi
+
+    g_start, g_end = g(start), g(end)
+    date = start
+    side = 0
+    for _ in range(OPPOSITION_ITERATIONS):
+        prev = date
+        date = (start * g_end - end * g_start) / (g_end - g_start)
+        g_date = g(date)
+        if abs(date - prev) < EPHEM_SECOND or g_date == 0:
+            break
+        if (g_date > 0) == (g_end > 0):
+            end, g_end = date, g_date
+            if side < 0:
+                g_start /= 2
+            side = -1
+        else:
+            start, g_start = date, g_date
+            if side > 0:
+                g_end /= 2
+            side = 1
+    return date
+
+
+# ==============================================================================
+# Lunation Table
+# ==============================================================================
+class LunationTable(object):
+    '''Sorted moon phase instants over a span of years.
+
+        Lookups bisect into the table instead of searching with ephem.
+        Phases strictly cycle new, 1st qtr, full, 3rd qtr so a particular
+        phase is never more than three entries from any index.
+    '''
+
+    def __init__(self, phases, first, last):
+        self.first = first  # years covered
+        self.last = last
+        self.dates = [date for _, date in phases]
+        self.phases = [phase for phase, _ in phases]
+        # lunation number of the first new moon in the table
+        for phase, date in phases:
+            if phase == RuleLunar.moon_new:
+                self.new_zero = self.dates.index(date)
+                self.lunation_zero = int(
+                    round((date.timestamp() - LUNATION_ZERO) /
+                          SYNODIC_MONTH))
+                break
+
+    def between(self, start, until, lunar_phase=None):
+        '''Iterate (phase, datetime) with start <= datetime < until.'''
+        first = bisect.bisect_left(self.dates, start)
+        last = bisect.bisect_left(self.dates, until)
+        for i in range(first, last):
+            if not lunar_phase or lunar_phase == self.phases[i]:
+                yield self.phases[i], self.dates[i]
+
+    def nearest(self, date, lunar_phase=None):
+        '''Datetime of the phase instant nearest the given date.'''
+        i = bisect.bisect_left(self.dates, date)
+        candidates = [
+            x for x in range(max(i - 4, 0), min(i + 4, len(self.dates)))
+            if not lunar_phase or lunar_phase == self.phases[x]
+        ]
+        return min((self.dates[x] for x in candidates),
+                   key=lambda x: abs(x - date))
+
+    def phase_at(self, date):
+        '''Principal phase whose instant is nearest the given date.'''
+        i = bisect.bisect_left(self.dates, date)
+        if i == len(self.dates) or (
+                i and date - self.dates[i - 1] < self.dates[i] - date):
+            i -= 1
+        return self.phases[i]
+
+    def lunation(self, date):
+        '''Lunation number of the most recent new moon at/before date.'''
+        i = bisect.bisect_right(self.dates, date) - 1
+        return self.lunation_zero + (i - self.new_zero) // 4
+
+    def __len__(self):
+        return len(self.dates)
+
+
 # ==============================================================================
 # Ephemeris Wrapper Class
 # ==============================================================================
 class CalEphemeris(object):
     '''Wrap python ephem library for use by cal_events et al.'''
 
-    def __init__(self):
-        '''Setup the python ephem, with an observer at Houge Park.'''
-        self.observer = ephem.Observer()
-        self.observer.lat = LAT
-        self.observer.lon = LONG
-        self.observer.elevation = ELEVATION
+    def __init__(self, cache=None, memo_size=MEMO_SIZE):
+        '''Setup the python ephem, with an observer at Houge Park.
+
+            cache - optional cal_cache.EphemerisCache to read through
+            memo_size - number of results kept in the in-process LRU memo
+        '''
+        self.lat = LAT
+        self.lon = LONG
+        self.elevation = ELEVATION
+        self.site = '{},{},{}'.format(LAT, LONG, ELEVATION)
+        self.cache = cache
+        self.memo = Memo(memo_size)
+        self.lunation_table = None
+        self.solar_table = None
+        self.lock = threading.Lock()
+        self.local = threading.local()  # per thread ephem.Observer
+        self.root = self  # owner of the shared state, see at()
+        self.views = {(LAT, LONG, ELEVATION): self}
 
         self.astro_events = []
         # self.gen_astro_data(year)
 
+    @property
+    def observer(self):
+        '''This thread's ephem.Observer at our site.'''
+        try:
+            return self.local.observer
+        except AttributeError:
+            observer = ephem.Observer()
+            observer.lat = self.lat
+            observer.lon = self.lon
+            observer.elevation = self.elevation
+            self.local.observer = observer
+            return observer
+
+    def at(self, location):
+        '''This ephemeris for an observer at another site.
+
+            The view shares the memo, the persistent cache and everything
+            that doesn't depend on the observer (moon phases, illumination,
+            oppositions, the solar positions behind get_sunsets()).
+            Sunsets and moon rise/set are per site, cached under the
+            site's "lat,long,elevation".
+
+            input
+                location    cal_events.Location (or None for this site)
+            output
+                return      CalEphemeris
+        '''
+        if location is None:
+            return self
+        root = self.root
+        key = (location.lat, location.lon, location.elevation)
+        with root.lock:
+            view = root.views.get(key)
+            if view is None:
+                view = copy.copy(root)
+                view.lat, view.lon, view.elevation = key
+                view.site = '{},{},{}'.format(*key)
+                view.local = threading.local()
+                view.astro_events = []
+                root.views[key] = view
+            return view
+
+    def map(self, func, items, threads=None):
+        '''Ordered map of func over items on a pool of threads.'''
+        if threads is not None and threads <= 1:
+            return [func(item) for item in items]
+        with futures.ThreadPoolExecutor(threads) as pool:
+            return list(pool.map(func, items))
+
+    def _cached(self, quantity, key, calc, shared=False):
+        '''Read a value through the memo, then the persistent cache.
+
+            shared values don't depend on the observer, every site reads
+            the same entry.
+        '''
+        site = SHARED_SITE if shared else self.site
+        try:
+            return self.memo.get((site, quantity, key))
+        except KeyError:
+            pass
+        if self.cache is None:
+            value = calc()
+        else:
+            try:
+                value = self.cache.get(site, quantity, key)
+            except KeyError:
+                value = calc()
+                self.cache.put(site, quantity, key, value)
+        self.memo.put((site, quantity, key), value)
+        return value
+
     # --------------------------------------
     # Ephem to Regular Units Helper Functions
     # --------------------------------------
     def get_datetime(self, ephem_date):
         return ephem.localtime(ephem_date)
 
+    def get_ephem_date(self, local):
+        '''ephem.Date of a naive local datetime (the reverse of above).'''
+        return ephem.Date(
+            datetime.datetime.utcfromtimestamp(local.timestamp()))
+
     def get_degrees(self, radians):
         return math.degrees(float(radians))
 
@@ -105,10 +416,159 @@ class CalEphemeris(object):
     # Rising/Setting/Phases/etc...
     # --------------------------------------
     def get_sunset(self, date, horizon=RuleSunset.sunset):
+        return self._cached('sunset:' + horizon.deg, date_key(date),
+                            lambda: self._calc_sunset(date, horizon))
+
+    def _calc_sunset(self, date, horizon):
         self.observer.date = date
         self.observer.horizon = horizon.deg
         return self.get_datetime(self.observer.next_setting(ephem.Sun()))
 
+    def twilight_ladder(self, date, horizons=tuple(RuleSunset)):
+        '''Sunset and the twilights of a date in one pass.
+
+            Within a second of get_sunset() for each horizon, but one Sun
+            body is shared and each deeper horizon's search starts from the
+            previous crossing.  Searches from another start can land a
+            fraction of a second apart, so the ladder has its own
+            memo/cache entries ('ladder:<deg>') and never changes what
+            get_sunset() returns.
+
+            input
+                date     datetime    as given to get_sunset
+                horizons tuple       RuleSunset values, shallowest first
+            output
+                return   OrderedDict RuleSunset -> local datetime
+        '''
+        ladder = {}
+
+        def calc(horizon):
+            if not ladder:
+                ladder.update(self._calc_ladder(date, horizons))
+            return ladder[horizon]
+
+        return collections.OrderedDict(
+            (horizon,
+             self._cached('ladder:' + horizon.deg, date_key(date),
+                          lambda horizon=horizon: calc(horizon)))
+            for horizon in horizons)
+
+    def _calc_ladder(self, date, horizons):
+        observer = self.observer
+        sun = ephem.Sun()
+        observer.date = date
+        sun.compute(observer)
+        # in daylight the crossings come in order, after dark the next
+        # deeper one may be tonight's while the next sunset is tomorrow's
+        chained = sun.alt > TWILIGHT_CHAIN_ALT
+        ladder = {}
+        for horizon in horizons:
+            observer.horizon = horizon.deg
+            crossing = observer.next_setting(sun)
+            ladder[horizon] = self.get_datetime(crossing)
+            if chained:
+                observer.date = crossing
+            else:
+                observer.date = date
+        return ladder
+
+    def get_sunsets(self, dates, horizon=RuleSunset.sunset, refine=False):
+        '''Batch get_sunset() over many dates at once.
+
+            The analytic solar model is within SUNSETS_MAX_ERROR seconds of
+            get_sunset().  With refine, each estimate seeds an ephem search
+            which lands within a second of get_sunset(), but not on the
+            same microsecond, so refined times have their own memo/cache
+            entries ('sunsets:<deg>').
+
+            input
+                dates   list        dates/datetimes as given to get_sunset
+                horizon RuleSunset  sunset or twilight type
+                refine  bool        polish every result with ephem
+            output
+                return  list        local datetimes (None if the sun never
+                                    reaches the horizon)
+        '''
+        times = numpy.array([utc_seconds(date) for date in dates], dtype=float)
+        sets = self.get_sunset_epochs(times, horizon)
+        if not refine:
+            return [
+                None if numpy.isnan(x) else datetime.datetime.fromtimestamp(x)
+                for x in sets
+            ]
+        return [
+            self._cached(
+                'sunsets:' + horizon.deg, date_key(date),
+                lambda: self._refine_sunset(date, start, horizon))
+            for date, start in zip(dates, numpy.maximum(
+                times, sets - SUNSETS_REFINE_LEAD))
+        ]
+
+    def _refine_sunset(self, date, start, horizon):
+        if numpy.isnan(start):
+            return self._calc_sunset(date, horizon)
+        return self._calc_sunset(
+            ephem.Date(EPHEM_UNIX + start / 86400.0), horizon)
+
+    def solar_days(self, first, last):
+        '''Return a SolarTable covering unix days first..last.'''
+        root = self.root  # one table for every site
+        table = root.solar_table
+        if table is None or first < table.first or last > table.last:
+            with root.lock:
+                table = root.solar_table
+                if table is not None:
+                    if first >= table.first and last <= table.last:
+                        return table
+                    first = min(first, table.first)
+                    last = max(last, table.last)
+                table = SolarTable(first, last)
+                root.solar_table = table
+        return table
+
+    def get_sunset_epochs(self, times, horizon=RuleSunset.sunset):
+        '''Vectorized next setting after each time.
+
+            The solar positions come from the SolarTable every site
+            shares, only the hour angles are computed per site.
+
+            input
+                times   numpy.array     unix times (seconds)
+                horizon RuleSunset      sunset or twilight type
+            output
+                return  numpy.array     unix times of the next setting of the
+                                        sun's upper limb, NaN if none
+        '''
+        lat = float(self.observer.lat)
+        lon = math.degrees(float(self.observer.lon))
+        # same refracted upper limb target as ephem's next_setting()
+        target = ephem.unrefract(self.observer.pressure, self.observer.temp,
+                                 ephem.degrees(horizon.deg) - SUN_SEMIDIAMETER)
+
+        days = numpy.floor(times / 86400.0)
+        best = numpy.full(times.shape, numpy.nan)
+        if not len(times):
+            return best
+        # settings fall from half a day before to a day and a half after
+        # local noon, the day either side of each time is tried
+        solar = self.solar_days(int(days.min()) - 2, int(days.max()) + 3)
+        for offset in (-1, 0, 1):
+            day = days + offset
+            minutes = numpy.full(times.shape, 720 - 4 * lon)  # UTC noon
+            for _ in range(3):
+                decl, eot, dist = solar.interpolate(day + minutes / 1440.0)
+                alt = target + SUN_SEMIDIAMETER - SUN_SEMIDIAMETER / dist
+                cos_ha = ((numpy.sin(alt) - math.sin(lat) * numpy.sin(decl)) /
+                          (math.cos(lat) * numpy.cos(decl)))
+                with numpy.errstate(invalid='ignore'):
+                    ha = numpy.degrees(numpy.arccos(cos_ha))
+                minutes = 720 - 4 * lon - eot + 4 * ha
+            sets = (day * 1440 + minutes) * 60
+            with numpy.errstate(invalid='ignore'):
+                later = (sets > times) & ~(best <= sets)
+            best = numpy.where(later, sets, best)
+        return best
+
     def _moon_setup(self, date):
         start = date.replace(hour=18, minute=0)
         until = start + datetime.timedelta(hours=9)  # 3pm to 3am window
@@ -118,49 +578,131 @@ class CalEphemeris(object):
 
     def moon_rise(self, date):
         '''Moon rise for a date, around the sunset please.'''
-        start, until = self._moon_setup(date)
-        moon_rise = self.get_datetime(self.observer.next_rising(ephem.Moon()))
-        if moon_rise > start and moon_rise < until:
-            return moon_rise
-        return None
+        return self.moon_night(date).rise
 
     def moon_set(self, date):
         '''Moon set for a date, around the sunset please.'''
+        return self.moon_night(date).set
+
+    def moon_night(self, date):
+        '''Moon illumination, rise and set for the night of a date.
+
+            One Moon body and one observer setup answer all three, and a
+            search is only run when its event can land in the window.  The
+            values (and memo/cache entries) are those of moon_illum(),
+            moon_rise() and moon_set().
+
+            output
+                return  MoonNight   illum (%), rise/set (local datetime or
+                                    None if not in the window)
+        '''
+        night = {}
+
+        def calc(field):
+            if not night:
+                night.update(self._calc_moon_night(date)._asdict())
+            return night[field]
+
+        key = date.date().isoformat()
+        return MoonNight(*[
+            self._cached('moon_' + field, key,
+                         lambda field=field: calc(field),
+                         shared=field == 'illum')
+            for field in MoonNight._fields
+        ])
+
+    def _calc_moon_night(self, date):
         start, until = self._moon_setup(date)
-        moon_set = self.get_datetime(self.observer.next_setting(ephem.Moon()))
-        if moon_set > start and moon_set < until:
-            return moon_set
-        return None
+        observer = self.observer
+        moon = ephem.Moon()
+        moon.compute(observer)
+        illum = moon.phase
+        search = {'rise': observer.next_rising, 'set': observer.next_setting}
+
+        # Up or down at each end of the window?  The moon stays up (and
+        # down) for more than 9 hours here, so at most one event fits.
+        search_start = observer.date
+        ends = []
+        for end in (start, until):
+            observer.date = self.get_ephem_date(end)
+            moon.compute(observer)
+            ends.append(moon.alt + moon.radius)  # upper limb
+        observer.date = search_start
+        if min(abs(x) for x in ends) < MOON_HORIZON_MARGIN:
+            events = ('rise', 'set')  # too close to call, search both
+        elif (ends[0] > 0) == (ends[1] > 0):
+            events = ()
+        elif ends[0] > 0:
+            events = ('set', )
+        else:
+            events = ('rise', )
+
+        times = dict.fromkeys(('rise', 'set'))
+        for event in events:
+            time = self.get_datetime(search[event](moon))
+            if start < time < until:
+                times[event] = time
+        return MoonNight(illum, times['rise'], times['set'])
 
     def moon_illum(self, date):
+        return self._cached('moon_illum', date.date().isoformat(),
+                            lambda: self._calc_moon_illum(date),
+                            shared=True)
+
+    def _calc_moon_illum(self, date):
         date = date.replace(hour=18, minute=0)  # 6pm
         moon = ephem.Moon()
         moon.compute(date)
         return moon.phase
 
     def get_moon_phase(self, date):
-        '''Get the Moon Phase around 6pm of any date.'''
+        '''Get the nearest principal Moon Phase around 6pm of any date.'''
         date = date.replace(hour=18, minute=0)
-        elong = self.get_degrees(ephem.Moon(date).elong)
-        phase = round(elong / 90.0) * 90
-        if phase == -90:
-            return RuleLunar.moon_3q
-        elif phase == 0:
-            return RuleLunar.moon_new
-        elif phase == 90:
-            return RuleLunar.moon_1q
-        return RuleLunar.moon_full
+        return self._cached(
+            'moon_phase', date.date().isoformat(),
+            lambda: self.lunations(date, date).phase_at(date),
+            shared=True)
 
     def get_moon_visibility(self, date):
-        return [
-            self.moon_illum(date),
-            self.moon_rise(date),
-            self.moon_set(date)
-        ]
+        return list(self.moon_night(date))
 
     def gen_moon_phases(self, start, until, lunar_phase=None):
         '''Return an interator of moon phases over the given dates.'''
-        phase_date = start
+        return self.lunations(start, until).between(start, until, lunar_phase)
+
+    def lunations(self, start, until):
+        '''Return a LunationTable covering the dates, plus a year margin.'''
+        first, last = start.year - 1, until.year + 1
+        root = self.root  # one table for every site
+        table = root.lunation_table
+        if table is None or first < table.first or last > table.last:
+            with root.lock:
+                table = root.lunation_table
+                if table is not None:
+                    if first >= table.first and last <= table.last:
+                        return table
+                    first = min(first, table.first)
+                    last = max(last, table.last)
+                phases = []
+                for year in range(first, last + 1):
+                    phases += self.moon_phases_year(year)
+                table = LunationTable(phases, first, last)
+                root.lunation_table = table
+        return table
+
+    def moon_phases_year(self, year):
+        '''List of (phase, datetime) for every moon phase in a year.'''
+        phases = self._cached(
+            'moon_phases', str(year), lambda: [[phase.value, date] for (
+                phase, date) in self._calc_moon_phases(
+                    datetime.datetime(year, 1, 1),
+                    datetime.datetime(year + 1, 1, 1))],
+            shared=True)
+        return [(RuleLunar(phase), date) for phase, date in phases]
+
+    def _calc_moon_phases(self, start, until):
+        # start a day early, ephem treats naive datetimes as UTC
+        phase_date = start - datetime.timedelta(days=1)
 
         while phase_date < until:
             elong = self.get_degrees(ephem.Moon(phase_date).elong)
@@ -177,19 +719,16 @@ class CalEphemeris(object):
                 nxt_phase = ephem.next_full_moon(phase_date)
                 phase = RuleLunar.moon_full
             phase_date = self.get_datetime(nxt_phase)
-            if phase_date < until and (not lunar_phase
-                                       or lunar_phase == phase):
+            if start <= phase_date < until:
                 yield phase, phase_date
             phase_date += datetime.timedelta(days=1)
 
     def get_nearest_phase(self, date, lunar_phase):
-        start = date - datetime.timedelta(days=15)
-        until = date + datetime.timedelta(days=15)
-        phases = [
-            x[1] for x in self.gen_moon_phases(
-                start, until, lunar_phase=lunar_phase)
-        ]
-        return min(phases, key=lambda x: abs(x - date))
+        return self.lunations(date, date).nearest(date, lunar_phase)
+
+    def get_lunation(self, date):
+        '''Lunation number (Meeus, 0 = new moon of Jan 6 2000) for a date.'''
+        return self.lunations(date, date).lunation(date)
 
     # --------------------------------------
     def gen_astro_data(self, year):
@@ -242,34 +781,24 @@ class CalEphemeris(object):
             after 3pm that day.
         '''
 
-        # set time for noon
-        self.observer.date = date.combine(date, datetime.time(12, 0))
-        time_sunset = self.get_sunset(date, RuleSunset.sunset)
-        time_civil = self.get_sunset(date, RuleSunset.civil)
-        time_nautical = self.get_sunset(date, RuleSunset.nautical)
-        time_astro = self.get_sunset(date, RuleSunset.astronomical)
-        time_sunset = time_sunset.strftime(FMT_HM)
-        time_civil = time_civil.strftime(FMT_HM)
-        time_nautical = time_nautical.strftime(FMT_HM)
-        time_astro = time_astro.strftime(FMT_HM)
-        sun = '{} sunset - {} / {} / {}'.format(time_sunset, time_civil,
-                                                time_nautical, time_astro)
-
-        #   print(date.strftime(FMT_YDATE))
-        #   MOON.compute('2016/2/28')
+        ladder = self.twilight_ladder(date)
+        sun = '{} sunset - {} / {} / {}'.format(
+            *[x.strftime(FMT_HM) for x in ladder.values()])
+
         # set time for 3pm
         date = date.combine(date, datetime.time(15, 0))
-        MOON.compute(date)
+        body = ephem.Moon()
+        body.compute(date)
         self.observer.date = date
         self.observer.horizon = RuleSunset.sunset.deg
-        time_moonset = ephem.localtime(self.observer.next_setting(MOON))
+        time_moonset = self.get_datetime(self.observer.next_setting(body))
         # figure out which of moonrise/moonset occurs from 3pm-3am
-        if date <= time_moonset < date + datetime.timedelay(hours=12):
+        if date <= time_moonset < date + datetime.timedelta(hours=12):
             moon = '{} moonset'.format(time_moonset.strftime(FMT_HM))
         else:
-            time_moonrise = ephem.localtime(self.observer.next_rising(MOON))
+            time_moonrise = self.get_datetime(self.observer.next_rising(body))
             moon = '{} moonrise'.format(time_moonrise.strftime(FMT_HM))
-        moon += ' - {:2.1f}%'.format(MOON.phase)
+        moon += ' - {:2.1f}%'.format(body.phase)
         return (sun, moon)
 
     ######################################
@@ -289,27 +818,69 @@ class CalEphemeris(object):
                 return  list    list of datetime/planet string tuples
         '''
         l_events = []
-        for planet in PLANETS:
-            date_opp = self.calc_opposition(year, planet)
-            if date_opp:
-                # spaces for formatting
-                event = (
-                    date_opp,
-                    "                               {} at opposition".format(
-                        planet.name))
-                l_events.append(event)
+        for name, date_opp in self.calc_oppositions([year])[year]:
+            # spaces for formatting
+            event = (date_opp,
+                     "                               {} at opposition".format(
+                         name))
+            l_events.append(event)
         return l_events
 
+    def calc_oppositions(self, years):
+        '''Oppositions of all PLANETS over a range of years.
+
+            One monthly grid is shared by every planet and the whole span,
+            each bracketed opposition is then refined by find_opposition().
+            Results are cached a year at a time.
+
+            input
+                years   list    years to be considered
+
+            output
+                return  dict    year -> list of [planet name, datetime], in
+                                PLANETS order
+        '''
+        years = list(years)
+        found = {}
+
+        def calc(year):
+            if not found:
+                found.update(self._calc_oppositions(years[0], years[-1]))
+            return found.get(year, [])
+
+        return {
+            year: self._cached('oppositions', str(year),
+                               lambda year=year: calc(year),
+                               shared=True)
+            for year in years
+        }
+
+    def _calc_oppositions(self, first, last):
+        # from a step before New Year's to a step after, as ephem dates
+        start = ephem.Date(datetime.datetime(first, 1, 1)) - OPPOSITION_GRID
+        end = ephem.Date(datetime.datetime(last + 1, 1, 1)) + OPPOSITION_GRID
+        grid = [start + OPPOSITION_GRID * x
+                for x in range(int((end - start) / OPPOSITION_GRID) + 2)]
+        found = {}
+        for body in PLANETS:
+            planet = body()
+            elongs = [self.ephem_elong(date, planet) for date in grid]
+            for i in range(len(grid) - 1):
+                if elongs[i] < 0 < elongs[i + 1]:
+                    date = ephem.localtime(ephem.Date(
+                        find_opposition(planet, grid[i] - EPHEM_DAY,
+                                        grid[i + 1] + EPHEM_DAY)))
+                    if first <= date.year <= last:
+                        found.setdefault(date.year, []).append(
+                            [planet.name, date])
+        return found
+
     def calc_opposition(self, year, planet):
         r'''
         Calculate opposition to solar system object.  Opposition occurs when
         elongation goes from -pi to +pi.
 
         'ephem.elong' is elongation (angle between object and sun) in radians.
-        As string 'ephem.elong' is deg:min:sec.
-
-        Note: Elongation monotonically (?) decreases towards -pi until past
-            opposition, at which point elongation jumps to about +pi
 
         elongation vs time:
                   |\      |\
@@ -323,62 +894,19 @@ class CalEphemeris(object):
         Notes:
         - Times within two minutes of Sky Safari in most cases, but not
           identical.
-        - Tried the following, but the calcuated minimum point was
-          off by a few minutes:
-        http://stackoverflow.com/questions/10146924/finding-
-          the-maximum-of-a-function
-
-        solution = scipy.optimize.minimize_scalar(lambda x: -f(x),
-                                                  bounds=[0,1],
-                                                  method='bounded')
+        - Looked up from calc_oppositions(), see find_opposition().
         - ephem uses 'float' data type to represent time, not datetime
 
         input
             year    int                 year to be generated
-            planet  ephem.<planet>()    planet object
+            planet  ephem.<planet>()    one of the PLANETS
 
         output
             return  datetime            time of opposition of 'planet'
         '''
-        # set start_date as one month before New Year's local time
-        # set end_date as one month after New Year's of following year
-        new_years = datetime.datetime(year, 1, 1, 0, 0)
-        start_date = ephem.Date(new_years) - EPHEM_MONTH
-        end_date = ephem.Date(new_years) + EPHEM_MONTH * 13
-
-        date = start_date
-        min_elong = +4
-        min_elong_date = date
-        # sample elong every month and find min
-        while date < end_date:
-            planet.compute(date)
-            elong = planet.elong
-            if elong < min_elong:
-                min_elong = elong
-                min_elong_date = date
-            date = ephem.Date(date) + EPHEM_MONTH
-        if min_elong_date == start_date or min_elong_date == end_date:
-            # min elongation is outside year -> return nothing
-            return None
-        # elongation the month after opposition should be positive
-        end_date = ephem.Date(min_elong_date) + EPHEM_MONTH
-        end_date_elong = self.ephem_elong(end_date, planet)  # should be < 0
-        # binary search - find min elongation until interval
-        # becomes <= 1 second
-        start_date = min_elong_date
-        while end_date - start_date > EPHEM_SECOND:
-            mid_date = (start_date + end_date) / 2
-            mid_date_elong = self.ephem_elong(mid_date, planet)
-            if mid_date_elong > 0:
-                end_date = mid_date
-            else:
-                start_date = mid_date
-            d = ephem.Date(start_date)
-        # change 'start_date' to datetime format
-        d = ephem.Date(start_date)
-        date = ephem.localtime(d)
-        if date.year == year:
-            return date
+        for name, date in self.calc_oppositions([year])[year]:
+            if name == planet.name:
+                return date
         return None
 
 
@@ -401,6 +929,61 @@ class TestUM(unittest.TestCase):
         self.assertEqual(sunset.hour, 21)
         self.assertEqual(sunset.minute, 21)
 
+    def test_sunsets(self):
+        days = [self.aug + datetime.timedelta(days=x) for x in range(366)]
+        for horizon in RuleSunset:
+            exact = [self.eph.get_sunset(x, horizon) for x in days]
+            approx = self.eph.get_sunsets(days, horizon)
+            refined = self.eph.get_sunsets(days, horizon, refine=True)
+            for x, y, z in zip(exact, approx, refined):
+                self.assertLess(abs(x - y).total_seconds(),
+                                SUNSETS_MAX_ERROR)
+                self.assertLess(abs(x - z).total_seconds(), 1)
+            # cached apart, get_sunset() after a refine is still its own
+            eph = CalEphemeris()
+            eph.get_sunsets(days[:5], horizon, refine=True)
+            self.assertEqual([eph.get_sunset(x, horizon) for x in days[:5]],
+                             exact[:5])
+
+    def test_twilight_ladder(self):
+        # the same times as four get_sunset() calls, day or night
+        for hour in (0, 12, 20, 23):
+            date = self.aug_mid.replace(hour=hour)
+            ladder = CalEphemeris().twilight_ladder(date)
+            self.assertEqual(list(ladder), list(RuleSunset))
+            for horizon, time in ladder.items():
+                self.assertLess(
+                    abs(time - self.eph._calc_sunset(date, horizon))
+                    .total_seconds(), 1)
+        # cached apart, get_sunset() is the same whichever runs first
+        ladder = self.eph.twilight_ladder(self.aug)
+        self.assertEqual(self.eph.memo.stats()['misses'], 4)
+        for horizon in RuleSunset:
+            self.assertEqual(self.eph.get_sunset(self.aug, horizon),
+                             CalEphemeris()._calc_sunset(self.aug, horizon))
+        self.assertEqual(self.eph.memo.stats()['misses'], 8)
+        self.assertEqual(self.eph.twilight_ladder(self.aug), ladder)
+        sun, moon = self.eph.calc_date_ephem(self.aug)
+        self.assertEqual(sun,
+                         '08:16 PM sunset - 08:47 PM / 09:21 PM / 09:59 PM')
+        self.assertEqual(moon, '11:10 PM moonrise - 75.0%')
+
+    def test_threads(self):
+        # each thread gets its own observer, results match the serial path
+        days = [self.aug + datetime.timedelta(days=x) for x in range(60)]
+        serial = CalEphemeris()
+        expect = [serial.get_moon_visibility(x) for x in days]
+        self.assertEqual(expect,
+                         self.eph.map(self.eph.get_moon_visibility, days, 4))
+        barrier = threading.Barrier(4, timeout=10)
+
+        def observer(_):
+            barrier.wait()  # all four threads at once
+            return self.eph.observer
+
+        observers = self.eph.map(observer, range(4), 4)
+        self.assertEqual(len(set(id(x) for x in observers)), 4)
+
     def test_moon_rise(self):
         # Moonrise on August 1, 2018 is 23:10 in San Jose
         rise = self.eph.moon_rise(self.aug)
@@ -424,6 +1007,19 @@ class TestUM(unittest.TestCase):
         ill = self.eph.moon_illum(self.aug)
         self.assertEqual(round(ill), 79)
 
+    def test_moon_night(self):
+        night = self.eph.moon_night(self.aug)
+        self.assertEqual(night.illum, self.eph.moon_illum(self.aug))
+        self.assertEqual((night.rise.hour, night.rise.minute), (23, 10))
+        self.assertIsNone(night.set)
+        # skipping searches changes nothing vs searching for both events
+        days = [self.aug + datetime.timedelta(days=x) for x in range(60)]
+        nights = [self.eph.moon_night(x) for x in days]
+        from unittest import mock
+        with mock.patch(__name__ + '.MOON_HORIZON_MARGIN', 10):
+            self.assertEqual(nights,
+                             [CalEphemeris().moon_night(x) for x in days])
+
     def test_moon_phase(self):
         # Phases of the Moon in August
         phases = self.eph.gen_moon_phases(self.aug, self.aug_late)
@@ -451,6 +1047,110 @@ class TestUM(unittest.TestCase):
         nearest = self.eph.get_nearest_phase(date, RuleLunar.moon_1q)
         self.assertEqual(nearest.day, 18)
 
+    def test_lunations(self):
+        table = self.eph.lunations(self.aug, self.aug_late)
+        # one year margin either side, about 50 phases a year
+        self.assertEqual((table.first, table.last), (2017, 2019))
+        self.assertTrue(145 < len(table) < 152)
+        self.assertEqual(
+            self.eph.get_moon_phase(datetime.datetime(2018, 8, 12)),
+            RuleLunar.moon_new)
+        self.assertEqual(
+            self.eph.get_moon_phase(datetime.datetime(2018, 8, 27)),
+            RuleLunar.moon_full)
+        # new moon of Aug 11 2018 is Meeus lunation 230
+        self.assertEqual(self.eph.get_lunation(self.aug), 229)
+        self.assertEqual(self.eph.get_lunation(self.aug_mid), 230)
+        # queries outside the table extend it
+        self.eph.get_nearest_phase(datetime.datetime(2021, 3, 1),
+                                   RuleLunar.moon_full)
+        self.assertEqual(self.eph.lunation_table.last, 2022)
+
+    def test_oppositions(self):
+        # the monthly sampling and bisection this replaced gave, for 2018:
+        bisected = {
+            'Mars': datetime.datetime(2018, 7, 26, 21, 59, 55),
+            'Jupiter': datetime.datetime(2018, 5, 8, 17, 24, 19),
+            'Saturn': datetime.datetime(2018, 6, 27, 6, 12, 22),
+            'Uranus': datetime.datetime(2018, 10, 23, 17, 30, 31),
+            'Neptune': datetime.datetime(2018, 9, 7, 11, 10, 53),
+            'Pluto': datetime.datetime(2018, 7, 12, 2, 44, 28),
+        }
+        for body in PLANETS:
+            date = self.eph.calc_opposition(2018, body())
+            self.assertLess(
+                abs(date - bisected[body().name]).total_seconds(), 60)
+        self.assertEqual(len(self.eph.calc_planets(2018)), 6)
+        # one pass over several years, December oppositions included
+        found = self.eph.calc_oppositions(range(2001, 2004))
+        self.assertIn(['Saturn', datetime.datetime(2002, 12, 17, 9, 12)],
+                      [[x, y.replace(second=0, microsecond=0)]
+                       for x, y in found[2002]])
+        self.assertIsNone(self.eph.calc_opposition(2019, ephem.Mars()))
+
+    def test_sites(self):
+        from cal_events import LOCATIONS
+        self.assertIs(self.eph.at(LOCATIONS[1]), self.eph)
+        pinnacles = self.eph.at(LOCATIONS[6])
+        self.assertIs(pinnacles, self.eph.at(LOCATIONS[6]))
+        self.assertIs(pinnacles, pinnacles.at(LOCATIONS[6]))
+        # further east, the sun sets a few minutes earlier
+        delta = (self.eph.get_sunset(self.aug) -
+                 pinnacles.get_sunset(self.aug)).total_seconds()
+        self.assertTrue(120 < delta < 300, delta)
+        # site independent results are shared, not recomputed
+        self.eph.moon_illum(self.aug)
+        pinnacles.moon_illum(self.aug)
+        self.assertEqual(self.eph.memo.stats()['hits'], 1)
+        self.eph.get_moon_phase(self.aug)
+        self.assertIs(pinnacles.lunations(self.aug, self.aug),
+                      self.eph.lunation_table)
+        self.assertNotEqual(
+            self.eph.moon_rise(self.aug), pinnacles.moon_rise(self.aug))
+        # one table of solar positions, each site its own sunsets
+        days = [self.aug + datetime.timedelta(days=x) for x in range(30)]
+        self.eph.get_sunsets(days)
+        table = self.eph.solar_table
+        for x, y in zip(pinnacles.get_sunsets(days), days):
+            self.assertLess(abs(x - pinnacles.get_sunset(y)).total_seconds(),
+                            SUNSETS_MAX_ERROR)
+        self.assertIs(pinnacles.solar_days(table.first, table.last), table)
+        self.assertIs(self.eph.solar_table, table)
+
+    def test_cache(self):
+        fd, filename = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        try:
+            cache = EphemerisCache(filename)
+            eph = CalEphemeris(cache)
+            sunset = eph.get_sunset(self.aug, RuleSunset.nautical)
+            phases = list(eph.gen_moon_phases(self.aug, self.aug_late))
+            cache.close()
+
+            # A fresh cache on the same file answers without ephem
+            cache = EphemerisCache(filename)
+            eph = CalEphemeris(cache)
+            eph._calc_sunset = None
+            eph._calc_moon_phases = None
+            self.assertEqual(sunset,
+                             eph.get_sunset(self.aug, RuleSunset.nautical))
+            self.assertEqual(phases,
+                             list(eph.gen_moon_phases(self.aug,
+                                                      self.aug_late)))
+            cache.close()
+        finally:
+            os.remove(filename)
+
+    def test_memo(self):
+        # datetime and date for the same night share an entry
+        sunset = self.eph.get_sunset(self.aug)
+        self.assertEqual(sunset, self.eph.get_sunset(self.aug.date()))
+        self.eph.moon_illum(self.aug)
+        self.eph.moon_illum(self.aug.replace(hour=12))
+        stats = self.eph.memo.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+
 
 #########################################################################
 if __name__ == '__main__':
@@ -21,8 +21,11 @@
       2018-08-15  Robert Chapman, line cleanup
       2018-09-01  Robert Chapman, refactor to incorporate dateutil.rrule
 '''
-from datetime import datetime, timedelta
-import icalendar
+import bisect
+import hashlib
+from collections import namedtuple
+from datetime import datetime, time, timedelta
+import unittest
 
 from dateutil import rrule
 from enum import Enum, unique
@@ -38,15 +41,40 @@ FRI = rrule.FR
 SAT = rrule.SA
 SUN = rrule.SU
 
+# bump when a change to the generator changes occurances for the same rules
+OCCURANCE_FORMAT = 1
+
+# CalEvent attributes that change the generated occurances
+RULE_ATTRS = frozenset(('date_rules', 'lunar_rules', 'lunar_months',
+                        'start_time', 'sunset_type', 'time_earliest',
+                        'time_offset', 'duration', 'location'))
+
+
+# ==============================================================================
+# Locations
+# ==============================================================================
+class Location(namedtuple('Location', 'name lat lon elevation')):
+    '''Event site, lat/lon as ephem strings, elevation in meters.'''
+    __slots__ = ()
+
+    def __str__(self):
+        return self.name
+
+
+# coordinates are approximate, the observing area/parking of each site
 LOCATIONS = {
-    1: 'Houge Park, Blg. 1',  # indoor
-    2: 'Houge Park',  # outdoor
-    3: 'Rancho Cañada del Oro',
-    4: 'Mendoza Ranch',
-    5: 'Coyote Valley',
-    6: "Pinnacles Nat'l Park, East Side",
-    7: "Pinnacles Nat'l Park, West Side",
-    8: "Yosemite Nat'l Park, Glacier Point"
+    1: Location('Houge Park, Blg. 1', '37.257465', '-121.942281',
+                50),  # indoor
+    2: Location('Houge Park', '37.257465', '-121.942281', 50),  # outdoor
+    3: Location('Rancho Cañada del Oro', '37.1506', '-121.7826', 170),
+    4: Location('Mendoza Ranch', '37.0958', '-121.5417', 300),
+    5: Location('Coyote Valley', '37.1996', '-121.7478', 80),
+    6: Location("Pinnacles Nat'l Park, East Side", '36.4934', '-121.1467',
+                330),
+    7: Location("Pinnacles Nat'l Park, West Side", '36.4775', '-121.2262',
+                420),
+    8: Location("Yosemite Nat'l Park, Glacier Point", '37.7306',
+                '-119.5744', 2199)
 }
 
 
@@ -106,17 +134,18 @@ class CalEvent(object):
     '''Club Event date generator that follow the solar or lunar calendar.'''
 
     def __init__(self, eph):
+        self.revision = 0  # bumped whenever a date/time rule changes
         self.eph = eph  # cal_ephemeris object with the appropriate settings
 
         # Event information
         self.name = None
         self.visibility = None
-        self.location = None
+        self.location = None  # Location, twilight is computed there
         self.url = None
         self.description = None
 
         # Normal Calendar style
-        self.date_rules = None  # rrule date generator
+        self.date_rules = None  # rrule parameters, anchored per query window
 
         # Lunar Calendar style
         self.lunar_rules = None  # new, 1Q, full, 3Q
@@ -132,32 +161,48 @@ class CalEvent(object):
 
         self.duration = None  # integer hours
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in RULE_ATTRS:
+            object.__setattr__(self, 'revision', self.revision + 1)
+
+    def fingerprint(self):
+        '''Stable hash of the rules (RULE_ATTRS) behind the occurances.
+
+            The same rules give the same fingerprint in any process or run,
+            so generated occurances can be saved under it and reused.
+        '''
+        rules = [OCCURANCE_FORMAT]
+        for name in sorted(RULE_ATTRS):
+            value = getattr(self, name)
+            if isinstance(value, dict):
+                value = sorted(value.items())
+            rules.append((name, value))
+        return hashlib.sha1(repr(rules).encode('utf-8')).hexdigest()
+
     # --------------------------------------
     # Some helper functions to initialize properly
     # --------------------------------------
     def monthly(self, week, weekday):
         '''Monthly event, like in typical calendar fashion.'''
-        self.date_rules = rrule.rrule(
-            rrule.MONTHLY, byweekday=weekday(week),
-            count=1000)  # generously large but not infinite event count
+        self.date_rules = dict(freq=rrule.MONTHLY, byweekday=weekday(week))
 
     def yearly(self, month, week, weekday):
         '''Monthly event, like in typical calendar fashion.'''
-        self.date_rules = rrule.rrule(
-            rrule.YEARLY, bymonth=month, byweekday=weekday(week), count=1000)
+        self.date_rules = dict(
+            freq=rrule.YEARLY, bymonth=month, byweekday=weekday(week))
 
     def lunar(self, phase, weekday):
         '''On given weekday every lunar cycle, nearest the given phase.'''
         self.lunar_rules = phase
-        self.date_rules = rrule.rrule(
-            rrule.WEEKLY, byweekday=weekday, count=1000)
+        self.date_rules = dict(freq=rrule.WEEKLY, byweekday=weekday)
 
     def lunar_yearly(self, phase, weekday, months):
         '''Yearly near a lunar phase, on the given weekday/months.'''
         self.lunar_rules = phase
         self.lunar_months = months
-        self.date_rules = rrule.rrule(
-            rrule.YEARLY, bymonth=months, byweekday=weekday, count=1000)
+        self.date_rules = dict(
+            freq=rrule.YEARLY, bymonth=months, byweekday=weekday)
 
     def times(self, start_time, duration=1):
         '''Once a year near a lunar phase.'''
@@ -180,8 +225,16 @@ class CalEvent(object):
             return self.gen_cal_dates(start, until)
 
     def gen_dates(self, start, until):
-        days = list(self.date_rules)
-        return [d for d in days if d > start and d < until]
+        '''Iterate the rule's candidate dates, at midnight, in [start, until).
+
+            Anchored at start's midnight, so a window that doesn't start on
+            the minute can't carry its seconds into the occurances.
+        '''
+        midnight = datetime.combine(start.date(), time())
+        for day in rrule.rrule(dtstart=midnight, until=until,
+                               **self.date_rules):
+            if start <= day < until:
+                yield day
 
     def gen_cal_dates(self, start, until):
         '''Generate all the occurances of the event'''
@@ -195,11 +248,14 @@ class CalEvent(object):
     def gen_lunar_dates(self, start, until):
         '''Find the dates nearest the specified lunar phase'''
         occurances = []
-        days = self.gen_dates(start, until)
+        days = list(self.gen_dates(start, until))
+        if not days:
+            return occurances
         for phase, dt in self.eph.gen_moon_phases(
                 start, until, lunar_phase=self.lunar_rules):
             if not self.lunar_months or dt.month in self.lunar_months:
-                dt = min(days, key=lambda x: abs(x - dt))
+                i = bisect.bisect_left(days, dt)
+                dt = min(days[max(i - 1, 0):i + 1], key=lambda x: abs(x - dt))
                 dtstart, dtend = self.calc_times(dt)
                 occurances.append((dtstart, dtend))
         return occurances
@@ -214,7 +270,10 @@ class CalEvent(object):
 
     def calc_sunset_times(self, date):
         '''Calculate start time of event based on twilight time for 'date'.'''
-        dusk = self.eph.get_sunset(date, self.sunset_type)
+        # search from noon (as UTC, like ephem) for that evening's twilight
+        # at the event's own site
+        dusk = self.eph.at(self.location).get_sunset(
+            datetime.combine(date, time(12)), self.sunset_type)
 
         # round minutes to nearest quarter hour
         rounded_hour = dusk.hour
@@ -231,14 +290,106 @@ class CalEvent(object):
         return date, date + self.duration
 
     # --------------------------------------
-    def add_ical_events(self, start, until, cal):
-        '''Add all generated events to the given calendar object.'''
-        for dtstart, dtend in self.gen_occurances(start, until):
-            event = icalendar.Event()
+    def add_ical_events(self, start, until, cal, occurances=None):
+        '''Add all generated events to the given cal_ical.IcalWriter.'''
+        if occurances is None:
+            occurances = self.gen_occurances(start, until)
+        for dtstart, dtend in occurances:
             if dtend:
-                event.add('dtstart', dtstart)
-                event.add('dtend', dtend)
+                cal.add_event(self.name, dtstart, dtend)
             else:
-                event.add('dtstart', dtstart.date())
-            event.add('summary', self.name)
-            cal.add_component(event)
+                cal.add_event(self.name, dtstart.date())
+
+
+# ==============================================================================
+class TestUM(unittest.TestCase):
+    def setUp(self):
+        import cal_ephemeris
+        self.eph = cal_ephemeris.CalEphemeris()
+        self.start = datetime(2018, 1, 1)
+        self.until = datetime(2019, 1, 1)
+
+    def test_monthly(self):
+        """First Sunday of every month, in a past year."""
+        event = CalEvent(self.eph)
+        event.monthly(1, SUN)
+        event.times(time(hour=14), 2)
+        dates = event.gen_occurances(self.start, self.until)
+        self.assertEqual(len(dates), 12)
+        self.assertEqual(dates[0][0], datetime(2018, 1, 7, 14))
+        self.assertEqual(dates[-1][1], datetime(2018, 12, 2, 16))
+
+    def test_window(self):
+        """An occurance on the window's first day is kept, the last not."""
+        event = CalEvent(self.eph)
+        event.monthly(1, FRI)
+        event.times(time(hour=19), 2)
+        dates = event.gen_occurances(datetime(2021, 1, 1),
+                                     datetime(2021, 2, 5))
+        self.assertEqual([x[0] for x in dates], [datetime(2021, 1, 1, 19)])
+
+    def test_window_seconds(self):
+        """A window off the minute still gives whole minute occurances."""
+        event = CalEvent(self.eph)
+        event.lunar(RuleLunar.moon_1q, FRI)
+        event.sunset_times(RuleSunset.nautical, time(hour=19), 0, 3)
+        dates = event.gen_occurances(self.start + timedelta(seconds=30),
+                                     self.until)
+        self.assertEqual(dates, event.gen_occurances(self.start, self.until))
+        self.assertFalse([x for x in dates if x[0].second or x[1].second])
+
+    def test_revision(self):
+        """Rule changes, direct or through the helpers, bump revision."""
+        event = CalEvent(self.eph)
+        revision = event.revision
+        event.name = 'Not a rule'
+        self.assertEqual(event.revision, revision)
+        event.lunar(RuleLunar.moon_1q, FRI)
+        self.assertGreater(event.revision, revision)
+        revision = event.revision
+        event.lunar_months = (1, 2)
+        self.assertGreater(event.revision, revision)
+
+    def test_fingerprint(self):
+        """Same rules, same fingerprint, a rule edit changes it."""
+        first = CalEvent(self.eph)
+        first.lunar(RuleLunar.moon_1q, FRI)
+        second = CalEvent(self.eph)
+        second.name = 'Not a rule'
+        second.lunar(RuleLunar.moon_1q, FRI)
+        self.assertEqual(first.fingerprint(), second.fingerprint())
+        second.location = LOCATIONS[4]
+        self.assertNotEqual(first.fingerprint(), second.fingerprint())
+
+    def test_lunar(self):
+        """Friday nearest each 1st quarter moon, times from twilight."""
+        event = CalEvent(self.eph)
+        event.lunar(RuleLunar.moon_1q, FRI)
+        event.sunset_times(RuleSunset.nautical, time(hour=19), 0, 3)
+        dates = event.gen_occurances(self.start, self.until)
+        self.assertEqual(len(dates), 12)
+        # 1st qtr moon Aug 18 2018 -> Friday Aug 17, ~9pm twilight
+        self.assertIn((datetime(2018, 8, 17, 21, 0),
+                       datetime(2018, 8, 18, 0, 0)), dates)
+
+    def test_location(self):
+        """Twilight is taken at the event's own site."""
+        event = CalEvent(self.eph)
+        event.sunset_times(RuleSunset.nautical, time(hour=19), 0, 3)
+        event.location = LOCATIONS[2]
+        self.assertEqual(str(event.location), 'Houge Park')
+        day = datetime(2018, 7, 7)
+        self.assertEqual(event.calc_sunset_times(day),
+                         (datetime(2018, 7, 7, 21, 45),
+                          datetime(2018, 7, 8, 0, 45)))
+        revision = event.revision
+        event.location = LOCATIONS[6]  # ~0.8 degrees east
+        self.assertGreater(event.revision, revision)
+        self.assertEqual(event.calc_sunset_times(day),
+                         (datetime(2018, 7, 7, 21, 30),
+                          datetime(2018, 7, 8, 0, 30)))
+
+
+# ==============================================================================
+if __name__ == '__main__':
+    unittest.main()
@@ -25,11 +25,20 @@
 
 import argparse
 import csv
-import datetime
-import icalendar
+import sys
 
-import cal_events
+import cal_cache
+import cal_catalog
 import cal_ephemeris
+import cal_events
+import cal_holidays
+import cal_ical
+import cal_occurances
+import cal_parallel
+import cal_query
+import cal_schedule
+
+OCCURANCES_SITE = 'occurances'  # cache "site" of persisted occurances
 
 
 # ==============================================================================
@@ -37,254 +46,182 @@ import cal_ephemeris
 # ==============================================================================
 class CalGen():
     """Wrap the list of SJAA Events for the year."""
-    def __init__(self):
-        self.eph = cal_ephemeris.CalEphemeris()
+    def __init__(self, cache=None, catalog=cal_catalog.CATALOG):
+        self.eph = cal_ephemeris.CalEphemeris(cache)
+        self.catalog = catalog  # events.json style file, see cal_catalog
         self.events = []
+        # (event, start, until) -> (revision, OccuranceArray)
+        self.occurances = {}
+        self.index = None  # OccuranceIndex of the materialized years
+        self.years = None  # materialized years and their (start, until)
+        self.span = None
+        self.revisions = None  # event revisions the index was built from
         self.init_events()
 
+    def get_occurances(self, event, start, until):
+        """Occurances of an event, generated once per rule revision.
+
+            Kept as a cal_occurances.OccuranceArray, which iterates like
+            the (dtstart, dtend) list gen_occurances returns, so times
+            must be whole minutes (ValueError otherwise).
+        """
+        key = (event, start, until)
+        try:
+            revision, occurances = self.occurances[key]
+            if revision == event.revision:
+                return occurances
+        except KeyError:
+            pass
+        occurances = self.load_occurances(event, start, until)
+        if occurances is None:
+            occurances = event.gen_occurances(start, until)
+            self.save_occurances(event, start, until, occurances)
+        occurances = cal_occurances.OccuranceArray.from_pairs(
+            event, occurances)
+        self.occurances[key] = (event.revision, occurances)
+        return occurances
+
+    # --------------------------------------
+    # Occurances persisted in the ephemeris cache, by rule fingerprint
+    # --------------------------------------
+    def _occurance_key(self, event, start, until):
+        return ('occurances:' + event.fingerprint(),
+                '{}/{}'.format(start.isoformat(), until.isoformat()))
+
+    def load_occurances(self, event, start, until):
+        """Occurances saved by an earlier run with the same rules, or None."""
+        if self.eph.cache is None:
+            return None
+        try:
+            occurances = self.eph.cache.get(
+                OCCURANCES_SITE, *self._occurance_key(event, start, until))
+        except KeyError:
+            return None
+        return [tuple(x) for x in occurances]
+
+    def save_occurances(self, event, start, until, occurances):
+        if self.eph.cache is not None:
+            self.eph.cache.put(OCCURANCES_SITE,
+                               *self._occurance_key(event, start, until),
+                               occurances)
+
+    def gen_years(self, years, jobs=1):
+        """Generate every event for a range of years, sharded over a pool.
+
+            Each (year, event) shard covers the same window as a single
+            --year run, generated by a CalGen rebuilt from init_events in
+            the worker process.  Shards of events whose rules were edited
+            since, and every shard of a serial run, are generated here.
+            Their concatenation is stored, as one OccuranceArray per event,
+            under the whole span, so print_events, write_csv and gen_cal
+            can be called with the returned span.
+            Shards saved by an earlier run (same cache, same event rules)
+            are read back instead of generated.
+
+            input
+                years   range   years to generate
+                jobs    int     worker processes (None = one per core)
+            output
+                return  tuple   (start, until) of the whole span
+        """
+        years = list(years)
+        tasks = [(year, index) for index in range(len(self.events))
+                 for year in years]
+        # only events whose rules changed since the last run are generated
+        results = [
+            self.load_occurances(self.events[index],
+                                 *cal_parallel.year_window(year))
+            for year, index in tasks
+        ]
+        changed = [x for x, y in zip(tasks, results) if y is None]
+        shards = {}
+        if changed and (jobs is None or jobs > 1):
+            cache = self.eph.cache.filename if self.eph.cache else None
+            shards = dict(zip(changed, cal_parallel.pool_map(
+                _gen_shard, changed, jobs, _init_worker,
+                (cache, self.catalog))))
+        for i, (year, index) in enumerate(tasks):
+            if results[i] is not None:
+                continue
+            event = self.events[index]
+            window = cal_parallel.year_window(year)
+            fingerprint, results[i] = shards.get((year, index), (None, None))
+            if fingerprint != event.fingerprint():
+                # serial, or edited since init_events: the workers only
+                # know the catalog's rules
+                results[i] = event.gen_occurances(*window)
+            self.save_occurances(event, *window, results[i])
+
+        span = (cal_parallel.year_window(years[0])[0],
+                cal_parallel.year_window(years[-1])[1])
+        for index, event in enumerate(self.events):
+            shards = results[index * len(years):(index + 1) * len(years)]
+            self.occurances[(event, ) + span] = (
+                event.revision,
+                cal_occurances.OccuranceArray.from_pairs(
+                    event, [x for shard in shards for x in shard]))
+        return span
+
     def init_events(self):
-        """Put all event objects here, with the date/time rules."""
-        class_intro = cal_events.CalEvent(self.eph)
-        class_intro.name = 'Intro to the Night Sky'
-        class_intro.visibility = cal_events.EventVisibility.public
-        class_intro.location = cal_events.LOCATIONS[1]
-        class_intro.url = 'www.sjaa.net/programs/beginners-astronomy'
-        class_intro.description = ''
-        class_intro.lunar(cal_events.RuleLunar.moon_1q, cal_events.FRI)
-        class_intro.sunset_times(cal_events.RuleSunset.nautical,
-                                 datetime.time(hour=19), -1, 1)
-        self.events.append(class_intro)
-
-        class_101 = cal_events.CalEvent(self.eph)
-        class_101.name = 'Astronomy 101'
-        class_101.visibility = cal_events.EventVisibility.public
-        class_101.location = cal_events.LOCATIONS[1]
-        class_101.url = 'www.sjaa.net/programs/beginners-astronomy'
-        class_101.description = ''
-        class_101.lunar(cal_events.RuleLunar.moon_3q, cal_events.FRI)
-        class_101.sunset_times(cal_events.RuleSunset.nautical,
-                               datetime.time(hour=19), -1, 1)
-        self.events.append(class_101)
-
-        itsp_1q = cal_events.CalEvent(self.eph)
-        itsp_1q.name = 'In-town Star Party'
-        itsp_1q.visibility = cal_events.EventVisibility.public
-        itsp_1q.location = cal_events.LOCATIONS[2]
-        itsp_1q.url = 'www.sjaa.net/events/monthly-star-parties'
-        itsp_1q.description = '1st quarter moon ITSP'
-        itsp_1q.lunar(cal_events.RuleLunar.moon_1q, cal_events.FRI)
-        itsp_1q.sunset_times(cal_events.RuleSunset.nautical,
-                             datetime.time(hour=19), 0, 3)
-        self.events.append(itsp_1q)
-
-        itsp_3q = cal_events.CalEvent(self.eph)
-        itsp_3q.name = 'In-town Star Party'
-        itsp_3q.visibility = cal_events.EventVisibility.public
-        itsp_3q.location = cal_events.LOCATIONS[2]
-        itsp_3q.url = 'www.sjaa.net/events/monthly-star-parties'
-        itsp_3q.description = '3rd quarter moon ITSP'
-        itsp_3q.lunar(cal_events.RuleLunar.moon_3q, cal_events.FRI)
-        itsp_3q.sunset_times(cal_events.RuleSunset.nautical,
-                             datetime.time(hour=19), 0, 3)
-        self.events.append(itsp_3q)
-
-        starry_night = cal_events.CalEvent(self.eph)
-        starry_night.name = 'Starry Night (OSA)'
-        starry_night.visibility = cal_events.EventVisibility.public
-        starry_night.location = cal_events.LOCATIONS[3]
-        starry_night.url = 'www.sjaa.net/events/starry-nights-public-star-party/'
-        starry_night.description = 'Starry Nights hosted by the Open Space Authority'
-        starry_night.lunar(cal_events.RuleLunar.moon_3q, cal_events.SAT)
-        starry_night.sunset_times(cal_events.RuleSunset.civil, None, 0, 3)
-        self.events.append(starry_night)
-
-        dark_sky = cal_events.CalEvent(self.eph)
-        dark_sky.name = 'Dark Sky Night'
-        dark_sky.visibility = cal_events.EventVisibility.member
-        dark_sky.location = cal_events.LOCATIONS[4]
-        dark_sky.url = 'www.sjaa.net/events/dark-sky-nights'
-        dark_sky.description = ''
-        dark_sky.lunar(cal_events.RuleLunar.moon_new, cal_events.SAT)
-        dark_sky.sunset_times(cal_events.RuleSunset.civil,
-                              datetime.time(hour=19), 0, 4)
-        self.events.append(dark_sky)
-
-        quick_start = cal_events.CalEvent(self.eph)
-        quick_start.name = 'Quick STARt'
-        quick_start.visibility = cal_events.EventVisibility.private
-        quick_start.location = cal_events.LOCATIONS[1]
-        quick_start.url = 'www.sjaa.net/programs/quick-start'
-        quick_start.description = ''
-        quick_start.lunar_yearly(
-            cal_events.RuleLunar.moon_1q,
-            cal_events.SAT,
-            months=(1, 4, 7, 10))
-        quick_start.times(datetime.time(hour=19), 2)
-        self.events.append(quick_start)
-
-        solar_sunday = cal_events.CalEvent(self.eph)
-        solar_sunday.name = 'Solar Sunday'
-        solar_sunday.visibility = cal_events.EventVisibility.public
-        solar_sunday.location = cal_events.LOCATIONS[1]
-        solar_sunday.url = 'www.sjaa.net/solar-observing??'
-        solar_sunday.description = ''
-        solar_sunday.monthly(1, cal_events.SUN)
-        solar_sunday.times(datetime.time(hour=14), 2)
-        self.events.append(solar_sunday)
-
-        img_workshop = cal_events.CalEvent(self.eph)
-        img_workshop.name = 'Imaging Workshop'
-        img_workshop.visibility = cal_events.EventVisibility.public
-        img_workshop.location = cal_events.LOCATIONS[5]
-        img_workshop.url = 'https://www.sjaa.net/programs/imaging-sig/'
-        img_workshop.description = ''
-        img_workshop.lunar_yearly(
-            cal_events.RuleLunar.moon_new,
-            cal_events.SAT,
-            months=(1, 2, 4, 5, 7, 8, 10, 11))
-        img_workshop.sunset_times(cal_events.RuleSunset.nautical,
-                                  datetime.time(hour=19), 0, 3)
-        self.events.append(img_workshop)
-
-        img_clinic = cal_events.CalEvent(self.eph)
-        img_clinic.name = 'Imaging Clinic'
-        img_clinic.visibility = cal_events.EventVisibility.public
-        img_clinic.location = cal_events.LOCATIONS[5]
-        img_clinic.url = 'https://www.sjaa.net/programs/imaging-sig/'
-        img_clinic.description = ''
-        img_clinic.lunar_yearly(
-            cal_events.RuleLunar.moon_new,
-            cal_events.SAT,
-            months=(3, 6, 9, 12))
-        img_clinic.sunset_times(cal_events.RuleSunset.nautical,
-                                datetime.time(hour=19), 0, 3)
-        self.events.append(img_clinic)
-
-        bino = cal_events.CalEvent(self.eph)
-        bino.name = 'Binocular Observing'
-        bino.visibility = cal_events.EventVisibility.public
-        bino.location = cal_events.LOCATIONS[5]
-        bino.url = 'https://www.sjaa.net/events/binocular-stargazing/'
-        bino.description = ''
-        bino.lunar_yearly(
-            cal_events.RuleLunar.moon_3q,
-            cal_events.SAT,
-            months=(5, 6, 7, 8))
-        bino.sunset_times(cal_events.RuleSunset.nautical,
-                          datetime.time(hour=19), 0, 3)
-        self.events.append(bino)
-
-        pinnacles = cal_events.CalEvent(self.eph)
-        pinnacles.name = 'Pinnacles Dark Sky Observing (NPS)'
-        pinnacles.visibility = cal_events.EventVisibility.public
-        pinnacles.location = cal_events.LOCATIONS[6]
-        pinnacles.url = 'https://www.sjaa.net/events/pinnacles-stargazing/'
-        pinnacles.description = ''
-        pinnacles.lunar_yearly(
-            cal_events.RuleLunar.moon_new,
-            cal_events.SAT,
-            months=(5, 6, 7, 8))
-        pinnacles.sunset_times(cal_events.RuleSunset.nautical,
-                               datetime.time(hour=19), 0, 3)
-        self.events.append(pinnacles)
-
-        fix_it = cal_events.CalEvent(self.eph)
-        fix_it.name = 'Fix It'
-        fix_it.visibility = cal_events.EventVisibility.public
-        fix_it.location = cal_events.LOCATIONS[2]
-        fix_it.url = 'www.sjaa.net/programs/fix-it'
-        fix_it.description = ''
-        fix_it.monthly(1, cal_events.SUN)
-        fix_it.times(datetime.time(hour=14), 2)
-        self.events.append(fix_it)
-
-        image_sig = cal_events.CalEvent(self.eph)
-        image_sig.name = 'Imaging SIG'
-        image_sig.visibility = cal_events.EventVisibility.public
-        image_sig.location = cal_events.LOCATIONS[1]
-        image_sig.url = 'www.sjaa.net/programs/imaging-sig'
-        image_sig.description = ''
-        image_sig.monthly(3, cal_events.TUE)
-        image_sig.times(datetime.time(hour=19, minute=30), 2)
-        self.events.append(image_sig)
-
-        board_mtg = cal_events.CalEvent(self.eph)
-        board_mtg.name = 'Board Meeting'
-        board_mtg.visibility = cal_events.EventVisibility.public
-        board_mtg.location = cal_events.LOCATIONS[1]
-        board_mtg.url = 'www.sjaa.net/board-meeting??'
-        board_mtg.description = ''
-        board_mtg.lunar(cal_events.RuleLunar.moon_full, cal_events.SAT)
-        board_mtg.times(datetime.time(hour=18), 2)
-        self.events.append(board_mtg)
-
-        gen_mtg = cal_events.CalEvent(self.eph)
-        gen_mtg.name = 'General Meeting'
-        gen_mtg.visibility = cal_events.EventVisibility.public
-        gen_mtg.location = cal_events.LOCATIONS[1]
-        gen_mtg.url = 'www.sjaa.net/programs/monthly-guest-speakers'
-        gen_mtg.description = ''
-        gen_mtg.lunar_yearly(
-            cal_events.RuleLunar.moon_full,
-            cal_events.SAT,
-            months=(1, 3, 4, 5, 6, 7, 10, 11, 12))  # Skip special meetings
-        gen_mtg.times(datetime.time(hour=19, minute=30), 2)
-        self.events.append(gen_mtg)
-
-        mem_mtg = cal_events.CalEvent(self.eph)
-        mem_mtg.name = 'Membership Meeting/Awards Night'
-        mem_mtg.visibility = cal_events.EventVisibility.public
-        mem_mtg.location = cal_events.LOCATIONS[1]
-        mem_mtg.url = 'www.sjaa.net/membership-meeting??'
-        mem_mtg.description = ''
-        mem_mtg.lunar_yearly(
-            cal_events.RuleLunar.moon_full, cal_events.SAT, months=(2, ))
-        mem_mtg.times(datetime.time(hour=19, minute=30), 2)
-        self.events.append(mem_mtg)
-
-        movie_night = cal_events.CalEvent(self.eph)
-        movie_night.name = 'Movie Night'
-        movie_night.visibility = cal_events.EventVisibility.public
-        movie_night.location = cal_events.LOCATIONS[1]
-        movie_night.url = 'www.sjaa.net/movie-night'
-        movie_night.description = 'Member Only Movie Night'
-        movie_night.lunar_yearly(
-            cal_events.RuleLunar.moon_full, cal_events.SAT, months=(8, ))
-        movie_night.times(datetime.time(hour=19, minute=30), 2)
-        self.events.append(movie_night)
-
-        show_n_tell = cal_events.CalEvent(self.eph)
-        show_n_tell.name = 'Show-n-tell'
-        show_n_tell.visibility = cal_events.EventVisibility.public
-        show_n_tell.location = cal_events.LOCATIONS[1]
-        show_n_tell.url = 'www.sjaa.net/events/show-n-tell'
-        show_n_tell.description = ''
-        show_n_tell.lunar_yearly(
-            cal_events.RuleLunar.moon_full, cal_events.SAT, months=(9, ))
-        show_n_tell.times(datetime.time(hour=19, minute=30), 2)
-        self.events.append(show_n_tell)
-
-        swap_spring = cal_events.CalEvent(self.eph)
-        swap_spring.name = 'Spring Swap Meet'
-        swap_spring.visibility = cal_events.EventVisibility.public
-        swap_spring.location = cal_events.LOCATIONS[1]
-        swap_spring.url = 'www.sjaa.net/events/swap-meet'
-        swap_spring.description = ''
-        swap_spring.lunar_yearly(
-            cal_events.RuleLunar.moon_full, cal_events.SUN, months=(3, ))
-        swap_spring.times(datetime.time(hour=11), 4)
-        self.events.append(swap_spring)
-
-        swap_fall = cal_events.CalEvent(self.eph)
-        swap_fall.name = 'Fall Swap Meet'
-        swap_fall.visibility = cal_events.EventVisibility.public
-        swap_fall.location = cal_events.LOCATIONS[1]
-        swap_fall.url = 'www.sjaa.net/events/swap-meet'
-        swap_fall.description = ''
-        swap_fall.lunar_yearly(
-            cal_events.RuleLunar.moon_full, cal_events.SUN, months=(10, ))
-        swap_fall.times(datetime.time(hour=11), 4)
-        self.events.append(swap_fall)
+        """Build the events and their date/time rules from the catalog."""
+        self.events.extend(
+            cal_catalog.build(cal_catalog.load(self.catalog), self.eph))
+
+    # --------------------------------------
+    # Queries over a materialized schedule, see cal_query
+    # --------------------------------------
+    def materialize(self, years, jobs=1):
+        """Generate a range of years of events and index them for query().
+
+            input
+                years   range           years to generate
+                jobs    int             worker processes, see gen_years
+            output
+                return  OccuranceIndex  of every event in those years
+        """
+        self.years = list(years)
+        self.span = self.gen_years(self.years, jobs)
+        return self._build_index()
+
+    def _build_index(self):
+        self.revisions = [event.revision for event in self.events]
+        self.index = cal_query.OccuranceIndex(
+            cal_occurances.OccuranceArray.concatenate(
+                self.get_occurances(event, *self.span)
+                for event in self.events))
+        return self.index
+
+    def _index(self):
+        if self.index is None:
+            raise ValueError('materialize() a range of years first')
+        changed = [
+            event for event, revision in zip(self.events, self.revisions)
+            if event.revision != revision
+        ]
+        for event in changed:
+            # only the edited events, by year like gen_years
+            occurances = cal_occurances.OccuranceArray.concatenate(
+                self.get_occurances(event, *cal_parallel.year_window(year))
+                for year in self.years)
+            self.occurances[(event, ) + self.span] = (event.revision,
+                                                      occurances)
+        if changed:
+            self._build_index()
+        return self.index
+
+    def query(self, start, until, location=None, visibility=None):
+        """Occurances starting in [start, until), at a location/visibility.
+
+            O(log n + k) over the materialized years, see
+            OccuranceIndex.between().
+        """
+        return self._index().between(start, until, location, visibility)
+
+    def next_occurance(self, event, after):
+        """The next Occurance of an event (or its index) after a time."""
+        if isinstance(event, int):
+            event = self.events[event]
+        return self._index().next_occurance(event, after)
 
     def print_events(self, start, until):
         """Generate a summary of all events."""
@@ -292,12 +229,12 @@ class CalGen():
         private = []
         for event in self.events:
             if event.visibility == cal_events.EventVisibility.public:
-                for dtstart, _ in event.gen_occurances(start, until):
+                for dtstart, _ in self.get_occurances(event, start, until):
                     public.append("{0}: {1}".format(
                         event.name,
                         dtstart.strftime('%a %b %-d %Y - %-I:%M %p')))
             else:
-                for dtstart, _ in event.gen_occurances(start, until):
+                for dtstart, _ in self.get_occurances(event, start, until):
                     private.append("{0}: {1}".format(
                         event.name,
                         dtstart.strftime('%a %b %-d %Y - %-I:%M %p')))
@@ -308,51 +245,110 @@ class CalGen():
         print('\n'.join(private))
         return public, private
 
-    def gen_cal(self, start, until, public):
-        """Generate a calendar of public events."""
-        cal = icalendar.Calendar()
+    def find_conflicts(self, start, until):
+        """Overlapping events and events on holidays, see cal_schedule."""
+        occurances = [
+            cal_schedule.Occurance(event, dtstart, dtend)
+            for event in self.events
+            for dtstart, dtend in self.get_occurances(event, start, until)
+        ]
+        hol = cal_holidays.CalHoliday(range(start.year, until.year + 1))
+        return cal_schedule.find_conflicts(occurances, hol)
+
+    def print_conflicts(self, start, until):
+        """Print the schedule conflicts that need a manual fix."""
+        conflicts = self.find_conflicts(start, until)
+        print('*' * 80 + '\n')
+        print('\n'.join(cal_schedule.format_conflict(x) for x in conflicts))
+        return conflicts
+
+    def gen_cal(self, start, until, public, icfp):
+        """Stream a calendar of public (or member/private) events to icfp."""
         if public:
-            cal.add('prodid', 'SJAA Public Events Calendar')
+            prodid = 'SJAA Public Events Calendar'
             visibility = cal_events.EventVisibility.public,
         else:
-            cal.add('prodid', 'SJAA Member Only Events Calendar')
+            prodid = 'SJAA Member Only Events Calendar'
             visibility = (cal_events.EventVisibility.member,
                           cal_events.EventVisibility.private)
-        cal.add('version', '2.0')
+        events = [e for e in self.events if e.visibility in visibility]
+        self.write_ical(start, until, prodid, events, icfp)
 
-        for event in self.events:
-            if event.visibility in visibility:
-                event.add_ical_events(start, until, cal)
-        return cal
+    def write_ical(self, start, until, prodid, events, icfp):
+        """Stream a calendar of the given events to icfp."""
+        with cal_ical.IcalWriter(icfp, prodid) as cal:
+            for event in events:
+                event.add_ical_events(start, until, cal,
+                                      self.get_occurances(event, start, until))
 
 
-def write_csv(events, filename, start, until):
+# ------------------------------------------------------------------------------
+# Process pool workers for CalGen.gen_years, one CalGen per process
+# ------------------------------------------------------------------------------
+_WORKER = None
+
+
+def _init_worker(cache_filename, catalog):
+    global _WORKER
+    cache = None
+    if cache_filename:
+        cache = cal_cache.EphemerisCache(cache_filename)
+    _WORKER = CalGen(cache, catalog)
+
+
+def _gen_shard(task):
+    year, index = task
+    start, until = cal_parallel.year_window(year)
+    event = _WORKER.events[index]
+    occurances = event.gen_occurances(start, until)
+    if _WORKER.eph.cache:
+        _WORKER.eph.cache.flush()
+    return event.fingerprint(), occurances
+
+
+def write_csv(cal_gen, events, filename, start, until):
     with open('{}.csv'.format(filename), 'w') as cfp:
-        cfp = csv.writer(cfp)
-        header = ('Event', 'Date', 'Day', 'Type', 'Start Time', 'End Time',
-                  'Location')
-        cfp.writerow(header)
-        for event in events:
-            for dtstart, dtend in event.gen_occurances(start, until):
-                line = [event.name]
-                line.append(dtstart.strftime('%b %-d %Y'))
-                line.append(dtstart.strftime('%a'))
-                line.append(str(event.visibility).capitalize())
-                line.append(dtstart.strftime('%-I:%M %p'))
-                line.append(dtend.strftime('%-I:%M %p'))
-                line.append(event.location)
-                cfp.writerow(line)
+        write_csv_file(cal_gen, events, cfp, start, until)
+
+
+def write_csv_file(cal_gen, events, cfp, start, until):
+    """CSV of the events to an open text file."""
+    writer = csv.writer(cfp)
+    header = ('Event', 'Date', 'Day', 'Type', 'Start Time', 'End Time',
+              'Location')
+    writer.writerow(header)
+    for event in events:
+        for dtstart, dtend in cal_gen.get_occurances(event, start, until):
+            line = [event.name]
+            line.append(dtstart.strftime('%b %-d %Y'))
+            line.append(dtstart.strftime('%a'))
+            line.append(str(event.visibility).capitalize())
+            line.append(dtstart.strftime('%-I:%M %p'))
+            line.append(dtend.strftime('%-I:%M %p'))
+            line.append(event.location)
+            writer.writerow(line)
 
 
 # ==============================================================================
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Calendar Generator')
-    parser.add_argument(
+    years = parser.add_mutually_exclusive_group(required=True)
+    years.add_argument(
         '--year',
         type=int,
         action='store',
-        required=True,
         help='Year of the generated Calendar')
+    years.add_argument(
+        '--years',
+        type=cal_parallel.parse_years,
+        action='store',
+        help='Range of years, e.g. 2019-2028')
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        action='store',
+        default=1,
+        help='Worker processes for generation (0 = one per core)')
     parser.add_argument(
         '--public',
         action='store',
@@ -363,32 +359,67 @@ if __name__ == '__main__':
         action='store',
         help='Private Events Base Filename',
         default='private')
+    parser.add_argument(
+        '--cache',
+        action='store',
+        help='Ephemeris Cache Filename (SQLite), reused between runs')
+    parser.add_argument(
+        '--catalog',
+        action='store',
+        default=cal_catalog.CATALOG,
+        help='Event Catalog Filename (JSON), see cal_catalog')
+    parser.add_argument(
+        '--conflicts',
+        action='store_true',
+        help='Also list overlapping events and events on holidays')
+    parser.add_argument(
+        '--profile',
+        nargs='?',
+        const='-',
+        metavar='JSON',
+        help='Count ephem calls and time each stage, report to stderr or '
+        'a JSON file (use one job)')
     args = parser.parse_args()
 
+    profiler = None
+    if args.profile:
+        import cal_profile
+        profiler = cal_profile.Profiler()
+        profiler.wrap_stage('csv write', sys.modules[__name__], 'write_csv')
+        profiler.install()
+
     # -------------------------------------
     # Actually do the work we intend to do here
     # -------------------------------------
-    start = datetime.datetime(args.year, 1, 1)
-    until = datetime.datetime(args.year, 12, 31)
-
-    cal_gen = CalGen()
+    cache = cal_cache.EphemerisCache(args.cache) if args.cache else None
+    cal_gen = CalGen(cache, args.catalog)
+    if cache:
+        cache.flush()  # let the workers see what we have so far
+    start, until = cal_gen.gen_years(
+        args.years or range(args.year, args.year + 1), args.jobs or None)
     cal_gen.print_events(start, until)
+    if args.conflicts:
+        cal_gen.print_conflicts(start, until)
 
     public = [
         e for e in cal_gen.events
         if e.visibility == cal_events.EventVisibility.public
     ]
-    write_csv(public, args.public, start, until)
+    write_csv(cal_gen, public, args.public, start, until)
     private = [
         e for e in cal_gen.events
         if e.visibility != cal_events.EventVisibility.public
     ]
-    write_csv(private, args.private, start, until)
+    write_csv(cal_gen, private, args.private, start, until)
 
-    cal = cal_gen.gen_cal(start, until, public=True)
     with open('{}.ics'.format(args.public), 'wb') as icfp:
-        icfp.write(cal.to_ical())
+        cal_gen.gen_cal(start, until, True, icfp)
 
-    cal = cal_gen.gen_cal(start, until, public=False)
     with open('{}.ics'.format(args.private), 'wb') as icfp:
-        icfp.write(cal.to_ical())
+        cal_gen.gen_cal(start, until, False, icfp)
+
+    if cache:
+        cache.close()
+    if profiler:
+        profiler.uninstall()
+        profiler.write(args.profile)
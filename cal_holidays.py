@@ -1,31 +1,93 @@
 import datetime
-import holidays
 import unittest
 
 from dateutil import rrule
 
+import cal_lazy
+
+holidays = cal_lazy.lazy_import('holidays')
+
+# Days around a date that holiday_weekend() looks at, by weekday
+WEEKEND_WINDOWS = (
+    range(-3, 2),  # Mon, 3 days prior minimum, 1-2 days after
+    range(-4, 1),  # Tue
+    range(0, 1),  # Wed, just the day itself
+    range(-1, 5),  # Thu, 1 day prior, more for later
+    range(-2, 4),  # Fri
+    range(-3, 3),  # Sat
+    range(-4, 2),  # Sun, 1 day after, more for earlier
+)
+
 
 # ==============================================================================
 class CalHoliday(object):
     """Holiday wrapper class."""
 
+    # (first, last) year -> (first ordinal, label per day), for every instance
+    weekend_index = {}
+
     def __init__(self, date):
         try:
             # Check for a datetime object
-            year = date.year
+            years = [date.year]
         except AttributeError:
-            year = date
-        self.hol = holidays.US(years=year)
-        self._extra_holidays(year)
+            try:
+                # ...or a range of years
+                years = list(date)
+            except TypeError:
+                years = [date]
+        self.years = years
+        self.hol = self._holidays(years)
+        self.first, self.labels = self._weekend_index(min(years), max(years))
+
+    @classmethod
+    def _holidays(cls, years):
+        hol = holidays.US(years=years)
+        for year in years:
+            cls._extra_holidays(hol, year)
+        return hol
+
+    @classmethod
+    def _weekend_index(cls, first, last):
+        '''Dense holiday_weekend() labels for every day of the years.
+
+            Built once per span and shared, the neighbouring years are
+            included so windows crossing New Year see their holidays.
+        '''
+        key = (first, last)
+        index = cls.weekend_index.get(key)
+        if index is None:
+            hol = cls._holidays(range(first - 1, last + 2))
+            start = datetime.date(first, 1, 1).toordinal()
+            until = datetime.date(last + 1, 1, 1).toordinal()
+            index = (start, [
+                cls._scan(hol, datetime.date.fromordinal(x))
+                for x in range(start, until)
+            ])
+            cls.weekend_index[key] = index
+        return index
+
+    @staticmethod
+    def _scan(hol, date):
+        '''Label of the last holiday in the date's window, or ''.'''
+        holiday_text = ''
+        for i in WEEKEND_WINDOWS[date.weekday()]:
+            test_date = date + (i * datetime.timedelta(days=1))
+            holiday = hol.get(test_date)
+            if holiday:
+                holiday_text = '{0} ({1})'.format(holiday,
+                                                  test_date.strftime('%b %-d'))
+        return holiday_text
 
-    def _extra_holidays(self, year):
+    @staticmethod
+    def _extra_holidays(hol, year):
         # Add the superbowl, first Sunday in Feb.
         superb_owl = rrule.rrule(
             rrule.MONTHLY,
             count=1,
             byweekday=rrule.SU,
             dtstart=datetime.date(year, 2, 1))
-        self.hol.append({list(superb_owl)[0]: 'Superbowl Sunday'})
+        hol.append({list(superb_owl)[0]: 'Superbowl Sunday'})
 
         # Mother's day, Second Sunday in May
         mday = rrule.rrule(
@@ -33,7 +95,7 @@ class CalHoliday(object):
             count=1,
             byweekday=rrule.SU(2),
             dtstart=datetime.date(year, 5, 1))
-        self.hol.append({list(mday)[0]: "Mother's Day"})
+        hol.append({list(mday)[0]: "Mother's Day"})
 
         # Father's day, Third Sunday in June
         fday = rrule.rrule(
@@ -41,7 +103,7 @@ class CalHoliday(object):
             count=1,
             byweekday=rrule.SU(3),
             dtstart=datetime.date(year, 6, 1))
-        self.hol.append({list(fday)[0]: "Father's Day"})
+        hol.append({list(fday)[0]: "Father's Day"})
 
     def check_date(self, date):
         """Return a holiday if the day passed is one."""
@@ -53,23 +115,10 @@ class CalHoliday(object):
 
     def holiday_weekend(self, date):
         """Is the given date a near a holiday?"""
-        if date.weekday() < 2:
-            prior_days = 3 + date.weekday()  # 3 days prior minimum if Mon-Tues
-            post_days = 2 - date.weekday()  # 1-2 days after for Mon-Tues
-        elif date.weekday() > 2:
-            prior_days = date.weekday(
-            ) - 2  # 1 days prior for Thurs, more for later
-            post_days = 8 - date.weekday(
-            )  # 1 day after for Sunday, more for earlier
-
-        holiday_text = ''
-        for i in range(-1 * prior_days, post_days):
-            test_date = date + (i * datetime.timedelta(days=1))
-            holiday = self.hol.get(test_date)
-            if holiday:
-                holiday_text = '{0} ({1})'.format(holiday,
-                                                  test_date.strftime('%b %-d'))
-        return holiday_text
+        i = date.toordinal() - self.first
+        if 0 <= i < len(self.labels):
+            return self.labels[i]
+        return self._scan(self.hol, date)
 
 
 # ==============================================================================
@@ -81,6 +130,14 @@ class TestUM(unittest.TestCase):
         """14 Holidays in 2018."""
         self.assertEqual(len(self.hol.get_holidays()), 14)
 
+    def test_years(self):
+        """A range of years, each with our additions."""
+        hol = CalHoliday(range(2018, 2020))
+        self.assertEqual(len(hol.get_holidays()),
+                         14 + len(CalHoliday(2019).get_holidays()))
+        date = datetime.datetime(2019, 2, 3)
+        self.assertEqual('Superbowl Sunday', hol.check_date(date))
+
     def test_special(self):
         """SuperBowl - our special addition."""
         date = datetime.datetime(2018, 2, 4)
@@ -97,6 +154,29 @@ class TestUM(unittest.TestCase):
         self.assertEqual('Memorial Day (May 28)',
                          self.hol.holiday_weekend(date))
 
+    def test_wednesday(self):
+        """Wednesdays only match the holiday itself."""
+        self.assertEqual('Independence Day (Jul 4)',
+                         self.hol.holiday_weekend(datetime.date(2018, 7, 4)))
+        self.assertEqual('',
+                         self.hol.holiday_weekend(datetime.date(2018, 5, 30)))
+
+    def test_index(self):
+        """The dense index matches scanning each window, shared per span."""
+        hol = CalHoliday(range(2018, 2021))
+        self.assertIs(hol.labels, CalHoliday(range(2018, 2021)).labels)
+        day = datetime.datetime(2018, 1, 1)
+        while day.year < 2021:
+            self.assertEqual(
+                CalHoliday._scan(hol.hol, day), hol.holiday_weekend(day))
+            day += datetime.timedelta(days=1)
+        # New Year's Day 2021 is seen from the last days of 2020
+        self.assertEqual("New Year's Day (Jan 1)",
+                         hol.holiday_weekend(datetime.date(2020, 12, 31)))
+        # outside the span falls back to a scan
+        self.assertEqual('Memorial Day (May 27)',
+                         hol.holiday_weekend(datetime.date(2024, 5, 25)))
+
 
 # ==============================================================================
 if __name__ == '__main__':
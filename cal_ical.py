@@ -0,0 +1,163 @@
+'''
+
+  Astronomy Club Event Generator
+  file: cal_ical.py
+
+  Copyright (C) 2016  Teruo Utsumi, San Jose Astronomical Association
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+'''
+
+import datetime
+import io
+import unittest
+
+# ==============================================================================
+# Constants
+# ==============================================================================
+CRLF = '\r\n'
+FOLD_LIMIT = 75  # octets per content line, RFC 5545
+
+
+# ==============================================================================
+# Content line formatting, same output as the icalendar package
+# ==============================================================================
+def escape_text(text):
+    '''Escape a TEXT value (backslash, semicolon, comma and newlines).'''
+    return (text.replace('\\N', '\n').replace('\\', '\\\\')
+            .replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n')
+            .replace('\r', '\\n'))
+
+
+def fold_line(line):
+    '''Fold a content line at FOLD_LIMIT octets.'''
+    if len(line) < FOLD_LIMIT and line.isascii():
+        return line
+    folded = []
+    chars = []
+    count = 0
+    for char in line:
+        size = len(char.encode('utf-8'))
+        if chars and count + size >= FOLD_LIMIT:
+            # don't split a backslash escape across lines
+            if len(chars) > 1 and chars[-1] in '\\^':
+                prefix = chars.pop()
+                folded.append(''.join(chars))
+                chars = [prefix]
+                count = len(prefix.encode('utf-8'))
+            else:
+                folded.append(''.join(chars))
+                chars = []
+                count = 0
+        chars.append(char)
+        count += size
+    folded.append(''.join(chars))
+    return (CRLF + ' ').join(folded)
+
+
+def format_date(name, date):
+    '''DTSTART/DTEND line for a date or a naive (floating) datetime.'''
+    if isinstance(date, datetime.datetime):
+        return '{}:{}'.format(name, date.strftime('%Y%m%dT%H%M%S'))
+    return '{};VALUE=DATE:{}'.format(name, date.strftime('%Y%m%d'))
+
+
+# ==============================================================================
+# Streaming iCalendar Writer
+# ==============================================================================
+class IcalWriter(object):
+    '''Write a VCALENDAR to a binary file handle one VEVENT at a time.
+
+        Nothing is held in memory: the header goes out on creation, each
+        event as it's added, the footer on close().
+    '''
+
+    def __init__(self, icfp, prodid, version='2.0'):
+        self.icfp = icfp
+        self.count = 0
+        self._write([
+            'BEGIN:VCALENDAR', 'VERSION:' + escape_text(version),
+            'PRODID:' + escape_text(prodid)
+        ])
+
+    def _write(self, lines):
+        self.icfp.write(
+            ''.join(fold_line(x) + CRLF for x in lines).encode('utf-8'))
+
+    def add_event(self, summary, dtstart, dtend=None):
+        '''Add a VEVENT, dtstart/dtend are dates or naive datetimes.'''
+        lines = [
+            'BEGIN:VEVENT', 'SUMMARY:' + escape_text(summary),
+            format_date('DTSTART', dtstart)
+        ]
+        if dtend:
+            lines.append(format_date('DTEND', dtend))
+        lines.append('END:VEVENT')
+        self._write(lines)
+        self.count += 1
+
+    def close(self):
+        self._write(['END:VCALENDAR'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# ==============================================================================
+class TestUM(unittest.TestCase):
+    def write(self, prodid, events):
+        icfp = io.BytesIO()
+        with IcalWriter(icfp, prodid) as cal:
+            for event in events:
+                cal.add_event(*event)
+        return icfp.getvalue()
+
+    def reference(self, prodid, events):
+        import icalendar
+        cal = icalendar.Calendar()
+        cal.add('prodid', prodid)
+        cal.add('version', '2.0')
+        for summary, dtstart, dtend in events:
+            event = icalendar.Event()
+            event.add('dtstart', dtstart)
+            if dtend:
+                event.add('dtend', dtend)
+            event.add('summary', summary)
+            cal.add_component(event)
+        return cal.to_ical()
+
+    def test_compatible(self):
+        """Byte for byte the same as an icalendar.Calendar."""
+        events = [
+            ('In-town Star Party', datetime.datetime(2018, 8, 17, 21),
+             datetime.datetime(2018, 8, 18)),
+            ('SS - 8:16 PM, NT = 9:21 PM\n', datetime.date(2018, 8, 17),
+             None),
+            ('Escapes; commas, back\\slash\r\n', datetime.date(2018, 8, 18),
+             None),
+            ('Rancho Cañada del Oro ' * 6, datetime.date(2018, 8, 18), None),
+            ('x' * 72 + '\\,' * 10, datetime.date(2018, 8, 19), None),
+        ]
+        self.assertEqual(
+            self.reference('SJAA Public Events Calendar', events),
+            self.write('SJAA Public Events Calendar', events))
+        self.assertEqual(
+            self.reference('Astro, Calendar', []),
+            self.write('Astro, Calendar', []))
+
+
+# ==============================================================================
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+'''
+
+  Astronomy Club Event Generator
+  file: cal_lazy.py
+
+  Copyright (C) 2016  Teruo Utsumi, San Jose Astronomical Association
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+'''
+
+import importlib.util
+import os
+import subprocess
+import sys
+import unittest
+
+
+def lazy_import(name):
+    '''Import a module on first attribute access instead of now.
+
+        For heavy dependencies that only some code paths use (numpy,
+        holidays, ...), so --help and light runs start quickly.  A module
+        that's already imported is returned as is.
+
+        input
+            name    str     module name, e.g. 'concurrent.futures'
+        output
+            return  module  executed by the first getattr
+    '''
+    try:
+        return sys.modules[name]
+    except KeyError:
+        pass
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError('No module named {!r}'.format(name), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    parent, _, child = name.rpartition('.')
+    if parent:
+        # as the import system does, or 'import a.b; a.b' fails later on
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+# ==============================================================================
+class TestUM(unittest.TestCase):
+    def test_lazy(self):
+        """Nothing runs until an attribute is used, then it's the module."""
+        code = ('import cal_lazy; m = cal_lazy.lazy_import("colorsys"); '
+                'print(type(m).__name__, m.ONE_THIRD == 1.0 / 3, '
+                'type(m).__name__, cal_lazy.lazy_import("colorsys") is m)')
+        output = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.decode().split(),
+                         ['_LazyModule', 'True', 'module', 'True'])
+        self.assertIs(lazy_import('sys'), sys)
+        code = ('import cal_lazy; m = cal_lazy.lazy_import("xml.dom"); '
+                'import xml.dom; print(xml.dom is m)')
+        output = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.split(), [b'True'])
+        with self.assertRaises(ImportError):
+            lazy_import('no_such_module_here')
+
+
+# ==============================================================================
+if __name__ == '__main__':
+    unittest.main()
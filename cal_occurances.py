@@ -0,0 +1,324 @@
+'''
+
+  Astronomy Club Event Generator
+  file: cal_occurances.py
+
+  Copyright (C) 2016  Teruo Utsumi, San Jose Astronomical Association
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+'''
+
+import datetime
+import sys
+import unittest
+
+import cal_lazy
+
+numpy = cal_lazy.lazy_import('numpy')
+
+# ==============================================================================
+# Constants
+# ==============================================================================
+EPOCH = datetime.datetime(1970, 1, 1)  # naive, times are local wall clock
+EPOCH_DAY = EPOCH.toordinal()
+MINUTE = datetime.timedelta(minutes=1)
+NO_END = -1  # duration of an occurance without dtend (all day)
+
+# column dtypes, int32 minutes reach years 0 to 6000
+EVENT_TYPE = 'int32'
+MINUTES_TYPE = 'int32'
+
+
+def to_minutes(dts, ceil=False):
+    '''Minutes since EPOCH of a datetime, or a numpy array of a list.
+
+        Times on the minute convert exactly, others round down (or up
+        with ceil), so a datetime can be used as a search key.
+    '''
+    if isinstance(dts, datetime.datetime):
+        minutes = ((dts.toordinal() - EPOCH_DAY) * 1440 + dts.hour * 60 +
+                   dts.minute)
+        if ceil and (dts.second or dts.microsecond):
+            minutes += 1
+        return minutes
+    seconds = numpy.array(dts, dtype='datetime64[s]').astype('int64')
+    return -(-seconds // 60) if ceil else seconds // 60
+
+
+# ==============================================================================
+# Occurance View
+# ==============================================================================
+class OccuranceView(object):
+    '''One row of an OccuranceArray, for callers that want datetimes.
+
+        Unpacks, indexes and compares like the (dtstart, dtend) pairs
+        CalEvent.gen_occurances returns, and has the event, dtstart and
+        dtend of a cal_schedule.Occurance.
+    '''
+    __slots__ = ('event', 'dtstart', 'dtend')
+
+    def __init__(self, event, dtstart, dtend):
+        self.event = event
+        self.dtstart = dtstart
+        self.dtend = dtend
+
+    def __iter__(self):
+        yield self.dtstart
+        yield self.dtend
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, key):
+        return (self.dtstart, self.dtend)[key]
+
+    def __eq__(self, other):
+        try:
+            return tuple(self) == tuple(other)
+        except TypeError:
+            return NotImplemented
+
+    def __hash__(self):
+        return hash((self.dtstart, self.dtend))
+
+    def __repr__(self):
+        return 'OccuranceView({!r}, {!r}, {!r})'.format(
+            getattr(self.event, 'name', self.event), self.dtstart,
+            self.dtend)
+
+
+# ==============================================================================
+# Occurance Array
+# ==============================================================================
+class OccuranceArray(object):
+    '''Occurances of any number of events as three numpy columns.
+
+        event       int32   index into events, a tuple of CalEvents
+        start       int32   dtstart, minutes since EPOCH
+        duration    int32   minutes to dtend, NO_END when there's none
+
+        12 bytes an occurance, where a (dtstart, dtend) tuple in a list
+        takes about 160.  A sequence of OccuranceViews, so existing
+        "for dtstart, dtend in ..." loops work unchanged, while sorting
+        and filtering run on whole columns.  Slices and masks index like
+        numpy, slices share the columns.  Times are whole minutes, as
+        every CalEvent rule gives, from_pairs() refuses seconds rather
+        than round them.
+    '''
+    __slots__ = ('events', 'event', 'start', 'duration')
+
+    def __init__(self, events, event, start, duration):
+        self.events = tuple(events)
+        self.event = event
+        self.start = start
+        self.duration = duration
+
+    @classmethod
+    def empty(cls, events=()):
+        return cls(events, numpy.zeros(0, EVENT_TYPE),
+                   numpy.zeros(0, MINUTES_TYPE), numpy.zeros(0, MINUTES_TYPE))
+
+    @classmethod
+    def from_pairs(cls, event, pairs):
+        '''One event's (dtstart, dtend) pairs, as gen_occurances makes.
+
+            ValueError for times that aren't on the minute (the lists
+            took any datetime, the columns only hold minutes).
+        '''
+        pairs = list(pairs)
+        if not pairs:
+            return cls.empty((event, ))
+        seconds = numpy.array([x for pair in pairs for x in (
+            pair[0], pair[1] or pair[0])], 'datetime64[s]').astype('int64')
+        if (seconds % 60).any():
+            raise ValueError('occurances of {!r} not on the minute'.format(
+                getattr(event, 'name', event)))
+        starts, ends = seconds[0::2] // 60, seconds[1::2] // 60
+        duration = ends - starts
+        duration[[x[1] is None for x in pairs]] = NO_END
+        return cls((event, ), numpy.zeros(len(pairs), EVENT_TYPE),
+                   starts.astype(MINUTES_TYPE), duration.astype(MINUTES_TYPE))
+
+    @classmethod
+    def from_occurances(cls, occurances):
+        '''From cal_schedule.Occurances (event, dtstart, dtend).'''
+        events = {}
+        pairs = []
+        for occurance in occurances:
+            pairs.append(occurance[1:])
+            events.setdefault(occurance.event, []).append(len(pairs) - 1)
+        if not pairs:
+            return cls.empty()
+        packed = cls.from_pairs(None, pairs)
+        for i, rows in enumerate(events.values()):
+            packed.event[rows] = i
+        packed.events = tuple(events)
+        return packed
+
+    @classmethod
+    def concatenate(cls, arrays):
+        '''One array of all of them, in order, with their events merged.'''
+        arrays = list(arrays)
+        events = {}
+        columns = []
+        for array in arrays:
+            remap = numpy.array(
+                [events.setdefault(x, len(events)) for x in array.events],
+                EVENT_TYPE)
+            columns.append(remap[array.event] if len(remap) else array.event)
+        if not arrays:
+            return cls.empty()
+        return cls(events, numpy.concatenate(columns).astype(EVENT_TYPE),
+                   numpy.concatenate([x.start for x in arrays]),
+                   numpy.concatenate([x.duration for x in arrays]))
+
+    # --------------------------------------
+    # Sequence of OccuranceViews
+    # --------------------------------------
+    def __len__(self):
+        return len(self.start)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, numpy.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError('occurance index out of range')
+            dtstart = EPOCH + int(self.start[key]) * MINUTE
+            duration = int(self.duration[key])
+            return OccuranceView(
+                self.events[self.event[key]], dtstart,
+                None if duration == NO_END else dtstart + duration * MINUTE)
+        return OccuranceArray(self.events, self.event[key], self.start[key],
+                              self.duration[key])
+
+    def __iter__(self):
+        # columns converted in bulk, Python objects only for the views
+        events = self.events
+        for event, (dtstart, dtend) in zip(self.event.tolist(),
+                                           self.pairs()):
+            yield OccuranceView(events[event], dtstart, dtend)
+
+    def __eq__(self, other):
+        '''Same (dtstart, dtend) pairs, like the lists this replaces.'''
+        if isinstance(other, OccuranceArray):
+            return (numpy.array_equal(self.start, other.start)
+                    and numpy.array_equal(self.duration, other.duration))
+        try:
+            return self.pairs() == [tuple(x) for x in other]
+        except TypeError:
+            return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'OccuranceArray({} occurances of {} events)'.format(
+            len(self), len(self.events))
+
+    @property
+    def nbytes(self):
+        return self.event.nbytes + self.start.nbytes + self.duration.nbytes
+
+    def pairs(self):
+        '''A list of (dtstart, dtend) tuples, converted in bulk.'''
+        starts = self.start.astype('datetime64[m]').tolist()
+        ends = (self.start + self.duration).astype('datetime64[m]').tolist()
+        return [(x, None if d == NO_END else y)
+                for x, y, d in zip(starts, ends, self.duration.tolist())]
+
+    # --------------------------------------
+    # Vectorized sort and filters
+    # --------------------------------------
+    def sorted(self):
+        '''By start, stable, so ties stay in the order they were added.'''
+        return self[numpy.argsort(self.start, kind='stable')]
+
+    def search(self, start, until):
+        '''Row range [lo, hi) starting in [start, until), when sorted.'''
+        # keys of the column's own type, or numpy converts the column
+        keys = numpy.array(
+            [to_minutes(start, True), to_minutes(until, True)], MINUTES_TYPE)
+        lo, hi = self.start.searchsorted(keys).tolist()
+        return lo, hi
+
+    def search_after(self, after):
+        '''First row starting after a time, when sorted.'''
+        return int(self.start.searchsorted(
+            numpy.array(to_minutes(after), MINUTES_TYPE), side='right'))
+
+    def between(self, start, until):
+        '''Rows starting in [start, until), any order.'''
+        return self[(self.start >= to_minutes(start, True))
+                    & (self.start < to_minutes(until, True))]
+
+    def where(self, predicate):
+        '''Rows whose event matches predicate(event), tested per event.'''
+        keep = numpy.array([bool(predicate(x)) for x in self.events], bool)
+        if not len(keep):
+            return self
+        return self[keep[self.event]]
+
+
+# ==============================================================================
+class TestUM(unittest.TestCase):
+    def test_array(self):
+        """Views unpack like the pairs, columns sort and filter."""
+        day = datetime.datetime(2019, 1, 5, 19, 30)
+        hours = datetime.timedelta(hours=2)
+        week = datetime.timedelta(days=7)
+        pairs = [(day + n * week, day + n * week + hours) for n in range(5)]
+        star = OccuranceArray.from_pairs('star party', pairs)
+        self.assertEqual(star, pairs)
+        self.assertEqual(star.pairs(), pairs)
+        self.assertEqual([(x, y) for x, y in star], pairs)
+        self.assertEqual(star[-1].dtend, pairs[-1][1])
+        self.assertEqual(star[1].event, 'star party')
+        self.assertEqual((star[1][0], star[1][-1], len(star[1])),
+                         pairs[1] + (2, ))
+        self.assertEqual(star[1][:], pairs[1])
+        self.assertEqual(len(star[1:3]), 2)
+        with self.assertRaises(IndexError):
+            star[5]
+
+        board = OccuranceArray.from_pairs(
+            'board', [(day + datetime.timedelta(days=8), None)])
+        both = OccuranceArray.concatenate([star, board]).sorted()
+        self.assertEqual([x.event for x in both], ['star party'] * 2 +
+                         ['board'] + ['star party'] * 3)
+        self.assertIsNone(both[2].dtend)
+        self.assertEqual(both[2], (day + datetime.timedelta(days=8), None))
+        self.assertEqual(both.search(day, day + 2 * week), (0, 3))
+        self.assertEqual(both.search(day + datetime.timedelta(seconds=1),
+                                     day + 2 * week), (1, 3))
+        self.assertEqual(both[::-1].between(day, day + 2 * week).pairs(),
+                         both[2::-1].pairs())
+        self.assertEqual(len(both.where(lambda x: x == 'board')), 1)
+        with self.assertRaises(ValueError):
+            OccuranceArray.from_pairs(
+                'late', [(day + datetime.timedelta(seconds=5), None)])
+
+    def test_memory(self):
+        """An order of magnitude smaller than the list of tuples."""
+        day = datetime.datetime(2019, 1, 1, 19)
+        pairs = [(day + datetime.timedelta(days=n),
+                  day + datetime.timedelta(days=n, hours=3))
+                 for n in range(1000)]
+        listed = sys.getsizeof(pairs) + sum(
+            sys.getsizeof(x) + sys.getsizeof(x[0]) + sys.getsizeof(x[1])
+            for x in pairs)
+        packed = OccuranceArray.from_pairs(None, pairs)
+        self.assertEqual(packed.nbytes, 12000)
+        self.assertGreater(listed, 10 * packed.nbytes)
+
+
+# ==============================================================================
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+'''
+
+  Astronomy Club Event Generator
+  file: cal_parallel.py
+
+  Copyright (C) 2016  Teruo Utsumi, San Jose Astronomical Association
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+'''
+
+import argparse
+import datetime
+import os
+import unittest
+
+import cal_lazy
+
+futures = cal_lazy.lazy_import('concurrent.futures')
+
+
+# ==============================================================================
+# Year ranges, e.g. --years 2019-2028
+# ==============================================================================
+def parse_years(text):
+    '''argparse type for "YYYY" or "YYYY-YYYY" (inclusive).'''
+    try:
+        first, _, last = text.partition('-')
+        first = int(first)
+        last = int(last) if last else first
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected YEAR or FIRST-LAST, got {!r}'.format(text))
+    if last < first:
+        raise argparse.ArgumentTypeError(
+            'empty year range {!r}'.format(text))
+    return range(first, last + 1)
+
+
+def year_window(year):
+    '''The start/until window a single --year run covers.'''
+    return datetime.datetime(year, 1, 1), datetime.datetime(year, 12, 31)
+
+
+# ==============================================================================
+# Process Pool
+# ==============================================================================
+def pool_map(func, tasks, jobs=1, initializer=None, initargs=()):
+    '''Ordered map of func over tasks using a pool of processes.'''
+    return list(pool_imap(func, tasks, jobs, initializer, initargs))
+
+
+def pool_imap(func, tasks, jobs=1, initializer=None, initargs=()):
+    '''Yield func over tasks, in order, as a pool of processes finishes.
+
+        With one job everything runs lazily in this process, through the
+        same initializer and func, so serial and parallel runs are
+        identical.
+    '''
+    tasks = list(tasks)
+    if jobs is not None and jobs <= 1:
+        if initializer:
+            initializer(*initargs)
+        for task in tasks:
+            yield func(task)
+        return
+
+    jobs = jobs or os.cpu_count() or 1
+    chunksize = max(1, len(tasks) // (4 * jobs))
+    with futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=initializer,
+            initargs=initargs) as pool:
+        for result in pool.map(func, tasks, chunksize=chunksize):
+            yield result
+
+
+# ==============================================================================
+class TestUM(unittest.TestCase):
+    def test_parse_years(self):
+        self.assertEqual(parse_years('2019'), range(2019, 2020))
+        self.assertEqual(parse_years('2019-2028'), range(2019, 2029))
+        with self.assertRaises(argparse.ArgumentTypeError):
+            parse_years('2028-2019')
+        with self.assertRaises(argparse.ArgumentTypeError):
+            parse_years('soon')
+
+    def test_gen_years(self):
+        """Parallel multi-year generation matches the serial path."""
+        import cal_gen
+        serial = cal_gen.CalGen()
+        span = serial.gen_years(range(2019, 2021), jobs=1)
+        parallel = cal_gen.CalGen()
+        self.assertEqual(span, parallel.gen_years(range(2019, 2021), jobs=2))
+        for x, y in zip(serial.events, parallel.events):
+            self.assertEqual(
+                serial.get_occurances(x, *span),
+                parallel.get_occurances(y, *span))
+
+    def test_gen_years_edited(self):
+        """Rules edited after init_events are generated as edited."""
+        import cal_gen
+        for jobs in (1, 2):
+            gen = cal_gen.CalGen()
+            event = gen.events[0]
+            event.times(datetime.time(hour=9), 1)
+            span = gen.gen_years(range(2019, 2020), jobs=jobs)
+            self.assertEqual({x.dtstart.time() for x in
+                              gen.get_occurances(event, *span)},
+                             {datetime.time(hour=9)})
+
+    def test_astro_years(self):
+        import cal_astro
+        serial = cal_astro.gen_years_data(range(2019, 2021), jobs=1)
+        self.assertEqual(serial,
+                         cal_astro.gen_years_data(range(2019, 2021), jobs=2))
+        self.assertEqual(serial[0][0], datetime.datetime(2019, 1, 4))
+        self.assertEqual(serial[-1][0].year, 2020)
+
+
+# ==============================================================================
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,331 @@
+'''
+
+  Astronomy Club Event Generator
+  file: cal_profile.py
+
+  Copyright (C) 2016  Teruo Utsumi, San Jose Astronomical Association
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+'''
+
+import collections
+import datetime
+import functools
+import inspect
+import json
+import resource
+import sys
+import threading
+import time
+import types
+import unittest
+
+import ephem
+
+import cal_ephemeris
+import cal_events
+import cal_ical
+
+# ==============================================================================
+# Constants
+# ==============================================================================
+# ephem.Observer searches
+EPHEM_METHODS = ('next_setting', 'next_rising', 'previous_setting',
+                 'previous_rising')
+
+# ephem module searches, also looked up through NEXT_MOON_PHASE and SEASONS
+EPHEM_FUNCTIONS = ('next_new_moon', 'next_first_quarter_moon',
+                   'next_full_moon', 'next_last_quarter_moon',
+                   'previous_new_moon', 'previous_first_quarter_moon',
+                   'previous_full_moon', 'previous_last_quarter_moon',
+                   'next_vernal_equinox', 'next_summer_solstice',
+                   'next_autumn_equinox', 'next_winter_solstice')
+
+# bodies whose compute() calls are counted, ephem's own searches included
+EPHEM_BODIES = ('Sun', 'Moon', 'Mars', 'Jupiter', 'Saturn', 'Uranus',
+                'Neptune', 'Pluto')
+
+# (stage, class, method), time spent in nested stages is not counted twice
+STAGES = (
+    ('rule expansion', cal_events.CalEvent, 'gen_dates'),
+    ('lunar matching', cal_events.CalEvent, 'gen_lunar_dates'),
+    ('sunset calculation', cal_events.CalEvent, 'calc_sunset_times'),
+    ('sunset calculation', cal_ephemeris.CalEphemeris, 'twilight_ladder'),
+    ('moon calculation', cal_ephemeris.CalEphemeris, 'moon_night'),
+    ('moon phases', cal_ephemeris.CalEphemeris, '_calc_moon_phases'),
+    ('ics serialization', cal_ical.IcalWriter, 'add_event'),
+    ('ics serialization', cal_ical.IcalWriter, 'close'),
+)
+
+UNATTRIBUTED = '(none)'  # ephem calls made outside any CalEphemeris method
+
+
+def _wrap(func, enter, leave):
+    '''Call enter() before and leave(token) after func, or each step of it
+    for a generator function.'''
+    if inspect.isgeneratorfunction(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            gen = func(*args, **kwargs)
+            while True:
+                token = enter()
+                try:
+                    item = next(gen)
+                except StopIteration:
+                    return
+                finally:
+                    leave(token)
+                yield item
+    else:
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            token = enter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                leave(token)
+
+    return wrapper
+
+
+# ==============================================================================
+# Profiler
+# ==============================================================================
+class Profiler(object):
+    '''Count ephem operations and time the pipeline stages of a run.
+
+        Nothing is instrumented until install(), which wraps the ephem
+        calls, the CalEphemeris methods and the STAGES in place, and
+        uninstall() puts the originals back, so an unprofiled run pays
+        nothing.  Only this process is seen, profile with one job.
+    '''
+
+    def __init__(self):
+        self.ops = collections.defaultdict(collections.Counter)
+        self.stages = collections.OrderedDict()  # stage -> seconds
+        self.lock = threading.Lock()
+        self.local = threading.local()  # per thread method/stage stacks
+        self.patches = []  # (owner, name, original), in patch order
+        self.begin = None
+        self.seconds = 0.0
+
+    def _stack(self, name):
+        stack = getattr(self.local, name, None)
+        if stack is None:
+            stack = []
+            setattr(self.local, name, stack)
+        return stack
+
+    def _patch(self, owner, name, value):
+        if isinstance(owner, dict):
+            self.patches.append((owner, name, owner[name]))
+            owner[name] = value
+        else:
+            self.patches.append((owner, name, getattr(owner, name)))
+            setattr(owner, name, value)
+
+    # --------------------------------------
+    # Ephem operations, by the innermost CalEphemeris method
+    # --------------------------------------
+    def count(self, op):
+        methods = self._stack('methods')
+        method = methods[-1] if methods else UNATTRIBUTED
+        with self.lock:
+            self.ops[method][op] += 1
+
+    def _counted(self, op, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self.count(op)
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    def _counted_body(self, body_type):
+        count = self.count
+
+        def compute(body, *args, **kwargs):
+            count('compute')
+            return body_type.compute(body, *args, **kwargs)
+
+        return type(body_type.__name__, (body_type, ), {'compute': compute})
+
+    def _attributed(self, name, func):
+        methods = self._stack
+
+        def enter():
+            methods('methods').append(name)
+
+        def leave(token):
+            methods('methods').pop()
+
+        return _wrap(func, enter, leave)
+
+    # --------------------------------------
+    # Stage timers, exclusive of nested stages
+    # --------------------------------------
+    def wrap_stage(self, stage, owner, name):
+        '''Time owner.name (a function or method) as part of stage.'''
+        stages = self._stack
+
+        def enter():
+            frame = [time.perf_counter(), 0.0]  # start, nested seconds
+            stages('stages').append(frame)
+            return frame
+
+        def leave(frame):
+            elapsed = time.perf_counter() - frame[0]
+            stack = stages('stages')
+            stack.pop()
+            if stack:
+                stack[-1][1] += elapsed
+            with self.lock:
+                self.stages[stage] = (self.stages.get(stage, 0.0) + elapsed -
+                                      frame[1])
+
+        self._patch(owner, name, _wrap(getattr(owner, name), enter, leave))
+
+    # --------------------------------------
+    def install(self):
+        '''Instrument ephem, CalEphemeris and the STAGES.'''
+        for name in EPHEM_METHODS:
+            self._patch(ephem.Observer, name,
+                        self._counted(name, getattr(ephem.Observer, name)))
+
+        for name in EPHEM_FUNCTIONS:
+            original = getattr(ephem, name)
+            counted = self._counted(name, original)
+            self._patch(ephem, name, counted)
+            for table in (cal_ephemeris.NEXT_MOON_PHASE,
+                          cal_ephemeris.SEASONS):
+                for key, value in list(table.items()):
+                    if value[0] is original:
+                        self._patch(table, key, (counted, ) + value[1:])
+
+        bodies = {}
+        for name in EPHEM_BODIES:
+            bodies[name] = self._counted_body(getattr(ephem, name))
+            self._patch(ephem, name, bodies[name])
+        self._patch(cal_ephemeris, 'PLANETS',
+                    tuple(bodies[x.__name__] for x in cal_ephemeris.PLANETS))
+
+        for name, value in list(vars(cal_ephemeris.CalEphemeris).items()):
+            if (isinstance(value, types.FunctionType)
+                    and not name.startswith('__')):
+                self._patch(cal_ephemeris.CalEphemeris, name,
+                            self._attributed(name, value))
+
+        for stage, owner, name in STAGES:
+            self.wrap_stage(stage, owner, name)
+        self.begin = time.perf_counter()
+
+    def uninstall(self):
+        '''Put every original back.'''
+        if self.begin is not None:
+            self.seconds += time.perf_counter() - self.begin
+            self.begin = None
+        for owner, name, original in reversed(self.patches):
+            if isinstance(owner, dict):
+                owner[name] = original
+            else:
+                setattr(owner, name, original)
+        self.patches = []
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *args):
+        self.uninstall()
+
+    # --------------------------------------
+    # Reports
+    # --------------------------------------
+    def report(self):
+        '''The profile as a dict, ready for JSON.'''
+        totals = collections.Counter()
+        for counts in self.ops.values():
+            totals.update(counts)
+        return {
+            'seconds': self.seconds,
+            # kilobytes on Linux, the high water mark of the whole process
+            'peak_memory_kb':
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'stages': dict(self.stages),
+            'ephem_totals': dict(totals),
+            'ephem': {
+                method: dict(counts)
+                for method, counts in sorted(self.ops.items())
+            },
+        }
+
+    def format(self):
+        '''The profile as text.'''
+        report = self.report()
+        lines = [
+            'total {:.3f}s, peak memory {} KB'.format(
+                report['seconds'], report['peak_memory_kb'])
+        ]
+        for stage, seconds in sorted(report['stages'].items(),
+                                     key=lambda x: -x[1]):
+            lines.append('  {:24} {:9.3f}s'.format(stage, seconds))
+        lines.append('ephem operations')
+        for op, count in sorted(report['ephem_totals'].items()):
+            lines.append('  {:24} {:9}'.format(op, count))
+        for method, counts in report['ephem'].items():
+            lines.append('  {}: {}'.format(method, ', '.join(
+                '{} {}'.format(op, count)
+                for op, count in sorted(counts.items()))))
+        return '\n'.join(lines)
+
+    def write(self, filename='-'):
+        '''Print the report to stderr ('-'), or save it as JSON.'''
+        if filename == '-':
+            print(self.format(), file=sys.stderr)
+        else:
+            with open(filename, 'w') as pfp:
+                json.dump(self.report(), pfp, indent=2)
+
+
+# ==============================================================================
+class TestUM(unittest.TestCase):
+    def test_profile(self):
+        """Calls are counted and timed while installed, and only then."""
+        original = ephem.Observer.next_setting
+        eph = cal_ephemeris.CalEphemeris()
+        with Profiler() as profiler:
+            self.assertIsNot(ephem.Observer.next_setting, original)
+            event = cal_events.CalEvent(eph)
+            event.lunar(cal_events.RuleLunar.moon_1q, cal_events.FRI)
+            event.sunset_times(cal_events.RuleSunset.nautical,
+                               datetime.time(hour=19))
+            dates = event.gen_occurances(datetime.datetime(2018, 1, 1),
+                                         datetime.datetime(2018, 4, 1))
+        self.assertEqual(len(dates), 3)
+        self.assertIs(ephem.Observer.next_setting, original)
+        self.assertIs(cal_ephemeris.PLANETS[0], ephem.Mars)
+        report = profiler.report()
+        self.assertEqual(report['ephem']['_calc_sunset']['next_setting'], 3)
+        self.assertGreater(report['ephem_totals']['compute'], 3)
+        self.assertEqual(set(report['stages']), {
+            'rule expansion', 'lunar matching', 'moon phases',
+            'sunset calculation'
+        })
+        self.assertLessEqual(sum(report['stages'].values()),
+                             report['seconds'])
+        json.dumps(report)
+
+
+# ==============================================================================
+if __name__ == '__main__':
+    unittest.main()
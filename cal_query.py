@@ -0,0 +1,157 @@
+'''
+
+  Astronomy Club Event Generator
+  file: cal_query.py
+
+  Copyright (C) 2016  Teruo Utsumi, San Jose Astronomical Association
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+'''
+
+import datetime
+import unittest
+
+import cal_events
+import cal_occurances
+from cal_schedule import Occurance
+
+
+# ==============================================================================
+# Occurance Index
+# ==============================================================================
+class OccuranceIndex(object):
+    '''Occurances sorted by start, for range and next occurance queries.
+
+        Held as a cal_occurances.OccuranceArray sorted by start, a range
+        is two binary searches: O(log n) plus the k occurances returned.
+        The rows of one location, visibility, both or one event are
+        picked out by a vectorized mask on first use and kept, sorted.
+    '''
+
+    def __init__(self, occurances):
+        if not isinstance(occurances, cal_occurances.OccuranceArray):
+            occurances = cal_occurances.OccuranceArray.from_occurances(
+                occurances)
+        # stable, so occurances starting together stay in event order
+        self.occurances = occurances.sorted()
+        self.subsets = {(None, None): self.occurances}  # key -> rows
+
+    def __len__(self):
+        return len(self.occurances)
+
+    def _subset(self, key, predicate):
+        try:
+            return self.subsets[key]
+        except KeyError:
+            subset = self.subsets[key] = self.occurances.where(predicate)
+            return subset
+
+    def between(self, start, until, location=None, visibility=None):
+        '''Occurances starting from start up to (not including) until.
+
+            input
+                start       datetime    first start time included
+                until       datetime    first start time excluded
+                location    Location    only events here (None = any)
+                visibility  EventVisibility     only these (None = any)
+            output
+                return      OccuranceArray      by start time
+        '''
+        found = self._subset(
+            (location, visibility),
+            lambda x: (location in (None, x.location) and
+                       visibility in (None, x.visibility)))
+        lo, hi = found.search(start, until)
+        return found[lo:hi]
+
+    def next_occurance(self, event, after):
+        '''The event's first OccuranceView starting after a time, or None.'''
+        found = self._subset(event, lambda x: x is event)
+        i = found.search_after(after)
+        return found[i] if i < len(found) else None
+
+
+# ==============================================================================
+class TestUM(unittest.TestCase):
+    def event(self, name, location, visibility):
+        event = cal_events.CalEvent(None)
+        event.name = name
+        event.location = cal_events.LOCATIONS[location]
+        event.visibility = visibility
+        return event
+
+    def test_index(self):
+        public = cal_events.EventVisibility.public
+        member = cal_events.EventVisibility.member
+        itsp = self.event('In-town Star Party', 2, public)
+        dark = self.event('Dark Sky Night', 4, member)
+        board = self.event('Board Meeting', 1, public)
+        day = datetime.datetime(2019, 1, 1, 19)
+        week = datetime.timedelta(days=7)
+        occurances = [
+            Occurance(event, day + n * week, day + n * week)
+            for n, event in enumerate([board, itsp, dark] * 10)
+        ][::-1]
+        index = OccuranceIndex(occurances)
+        self.assertEqual(len(index), 30)
+
+        found = index.between(day + week, day + 4 * week)
+        self.assertEqual([x.event.name for x in found],
+                         ['In-town Star Party', 'Dark Sky Night',
+                          'Board Meeting'])
+        self.assertEqual(len(index.between(day, day + 30 * week)), 30)
+        self.assertEqual(index.between(day + 30 * week, day + 40 * week), [])
+        self.assertEqual(
+            index.between(day, day + 30 * week, visibility=member),
+            index.between(day, day + 30 * week, location=dark.location))
+        self.assertEqual(
+            len(index.between(day, day + 30 * week, board.location,
+                              public)), 10)
+        self.assertEqual(
+            index.between(day, day + 30 * week, board.location, member), [])
+
+        self.assertEqual(index.next_occurance(dark, day).dtstart,
+                         day + 2 * week)
+        self.assertEqual(index.next_occurance(dark, day + 2 * week).dtstart,
+                         day + 5 * week)
+        self.assertIsNone(index.next_occurance(dark, day + 30 * week))
+
+    def test_calgen(self):
+        """CalGen queries agree with filtering every event's occurances."""
+        import cal_gen
+        gen = cal_gen.CalGen()
+        gen.materialize(range(2019, 2021))
+        start = datetime.datetime(2019, 11, 1)
+        until = datetime.datetime(2020, 3, 1)
+        houge = cal_events.LOCATIONS[1]
+        expected = sorted(
+            ((dtstart, event.name) for event in gen.events
+             if event.location == houge
+             for dtstart, _ in gen.get_occurances(event, *gen.span)
+             if start <= dtstart < until),
+            key=lambda x: x[0])
+        found = gen.query(start, until, location=houge)
+        self.assertEqual([(x.dtstart, x.event.name) for x in found],
+                         expected)
+        self.assertEqual(
+            gen.next_occurance(0, start).dtstart,
+            datetime.datetime(2019, 11, 1, 19))
+
+        # a rule change is seen by the next query
+        gen.events[0].time_earliest = datetime.time(20)
+        self.assertEqual(
+            gen.next_occurance(0, start).dtstart,
+            datetime.datetime(2019, 11, 1, 20))
+
+
+# ==============================================================================
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+'''
+
+  Astronomy Club Event Generator
+  file: cal_schedule.py
+
+  Copyright (C) 2016  Teruo Utsumi, San Jose Astronomical Association
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+'''
+
+import collections
+import datetime
+import heapq
+import itertools
+import unittest
+
+import cal_events
+import cal_holidays
+
+# ==============================================================================
+# Constants
+# ==============================================================================
+Occurance = collections.namedtuple('Occurance', 'event dtstart dtend')
+
+# kind is OVERLAP, VENUE or HOLIDAY, other is the second Occurance or the
+# holiday's name
+Conflict = collections.namedtuple('Conflict', 'kind occurance other')
+
+OVERLAP = 'overlap'  # same location, overlapping times
+VENUE = 'venue'  # same venue, e.g. Houge Park indoor vs outdoor
+HOLIDAY = 'holiday'  # on a holiday
+
+
+def venue(location):
+    '''Locations at the same coordinates are one venue.'''
+    return (location.lat, location.lon)
+
+
+def occurance_end(occurance):
+    '''End of an occurance, the end of the day for all day events.'''
+    if occurance.dtend:
+        return occurance.dtend
+    day = datetime.datetime.combine(occurance.dtstart, datetime.time())
+    return day + datetime.timedelta(days=1)
+
+
+# ==============================================================================
+# Conflict Detection
+# ==============================================================================
+def find_overlaps(occurances):
+    '''Overlapping occurances at each venue, by a sorted interval sweep.
+
+        Occurances are sorted per venue by start, a heap holds the ones
+        still running, so this is O(n log n) plus the conflicts found.
+
+        input
+            occurances  iterable    Occurances, events need a location
+        output
+            return      list        Conflicts, OVERLAP or VENUE
+    '''
+    venues = collections.defaultdict(list)
+    for occurance in occurances:
+        if occurance.event.location:
+            venues[venue(occurance.event.location)].append(
+                (occurance.dtstart, occurance_end(occurance), occurance))
+
+    conflicts = []
+    tiebreak = itertools.count()  # never compare Occurances in the heap
+    for intervals in venues.values():
+        intervals.sort(key=lambda x: (x[0], x[1]))
+        running = []  # heap of (end, tiebreak, occurance)
+        for dtstart, dtend, occurance in intervals:
+            while running and running[0][0] <= dtstart:
+                heapq.heappop(running)
+            for _, _, other in running:
+                if other.event.location == occurance.event.location:
+                    kind = OVERLAP
+                else:
+                    kind = VENUE
+                conflicts.append(Conflict(kind, other, occurance))
+            heapq.heappush(running, (dtend, next(tiebreak), occurance))
+    conflicts.sort(key=lambda x: (x.occurance.dtstart, x.other.dtstart))
+    return conflicts
+
+
+def find_holidays(occurances, hol):
+    '''Occurances that fall on a holiday.
+
+        input
+            occurances  iterable    Occurances
+            hol         CalHoliday  covering the occurances
+        output
+            return      list        HOLIDAY Conflicts
+    '''
+    conflicts = []
+    for occurance in occurances:
+        holiday = hol.check_date(occurance.dtstart.date())
+        if holiday:
+            conflicts.append(Conflict(HOLIDAY, occurance, holiday))
+    return conflicts
+
+
+def find_conflicts(occurances, hol=None):
+    '''All schedule conflicts, overlaps and then holidays, in time order.'''
+    occurances = list(occurances)
+    conflicts = find_overlaps(occurances)
+    if hol:
+        conflicts += find_holidays(occurances, hol)
+    conflicts.sort(key=lambda x: x.occurance.dtstart)
+    return conflicts
+
+
+def format_conflict(conflict):
+    '''One line description of a Conflict.'''
+    first = conflict.occurance
+    text = '{}: {} - {} ({})'.format(
+        conflict.kind, first.dtstart.strftime('%a %b %-d %Y %-I:%M %p'),
+        first.event.name, first.event.location)
+    if conflict.kind == HOLIDAY:
+        return '{} on {}'.format(text, conflict.other)
+    second = conflict.other
+    return '{} vs {} - {} ({})'.format(
+        text, second.dtstart.strftime('%-I:%M %p'), second.event.name,
+        second.event.location)
+
+
+# ==============================================================================
+class TestUM(unittest.TestCase):
+    def event(self, name, location):
+        event = cal_events.CalEvent(None)
+        event.name = name
+        event.location = cal_events.LOCATIONS[location]
+        return event
+
+    def test_overlaps(self):
+        indoor = self.event('Board Meeting', 1)
+        class_ = self.event('Intro Class', 1)
+        outdoor = self.event('In-town Star Party', 2)
+        away = self.event('Dark Sky Night', 4)
+        day = datetime.datetime(2019, 3, 8)
+        hour = datetime.timedelta(hours=1)
+        occurances = [
+            Occurance(indoor, day + 19 * hour, day + 21 * hour),
+            Occurance(class_, day + 20 * hour, day + 22 * hour),
+            Occurance(outdoor, day + 21 * hour, day + 24 * hour),
+            Occurance(away, day + 20 * hour, day + 24 * hour),
+            Occurance(indoor, day + 22 * hour, day + 23 * hour),
+        ]
+        conflicts = find_overlaps(occurances)
+        self.assertEqual([(x.kind, x.occurance.event.name, x.other.event.name)
+                          for x in conflicts],
+                         [(OVERLAP, 'Board Meeting', 'Intro Class'),
+                          (VENUE, 'Intro Class', 'In-town Star Party'),
+                          (VENUE, 'In-town Star Party', 'Board Meeting')])
+        self.assertEqual(
+            format_conflict(conflicts[0]),
+            'overlap: Fri Mar 8 2019 7:00 PM - Board Meeting '
+            '(Houge Park, Blg. 1) vs 8:00 PM - Intro Class '
+            '(Houge Park, Blg. 1)')
+
+    def test_holidays(self):
+        swap = self.event('Swap Meet', 1)
+        occurances = [
+            Occurance(swap, datetime.datetime(2019, 5, 12, 11), None),
+            Occurance(swap, datetime.datetime(2019, 5, 19, 11), None),
+        ]
+        conflicts = find_conflicts(occurances, cal_holidays.CalHoliday(2019))
+        self.assertEqual(len(conflicts), 1)
+        self.assertEqual(conflicts[0].other, "Mother's Day")
+        # all day events overlap anything else that day
+        self.assertEqual(
+            len(find_overlaps(occurances + [Occurance(
+                swap, datetime.datetime(2019, 5, 19, 20),
+                datetime.datetime(2019, 5, 19, 21))])), 1)
+
+
+# ==============================================================================
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,590 @@
+'''
+
+  Astronomy Club Event Generator
+  file: cal_server.py
+
+  Copyright (C) 2016  Teruo Utsumi, San Jose Astronomical Association
+
+  This program is free software: you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation, either version 3 of the License, or
+  (at your option) any later version.
+
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+'''
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import email.utils
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import urllib.parse
+
+import cal_astro
+import cal_cache
+import cal_catalog
+import cal_events
+import cal_gen
+import cal_parallel
+
+# ==============================================================================
+# Constants
+# ==============================================================================
+FEEDS = {
+    # path -> (kind, format)
+    '/events.ics': ('events', 'ics'),
+    '/events.csv': ('events', 'csv'),
+    '/astro.ics': ('astro', 'ics'),
+    '/astro.csv': ('astro', 'csv'),
+}
+CONTENT_TYPES = {
+    'ics': 'text/calendar; charset=utf-8',
+    'csv': 'text/csv; charset=utf-8',
+}
+MAX_YEARS = 50  # longest year range a feed may ask for
+POLL_SECONDS = 5  # how often the catalog is checked for rule changes
+KEEPALIVE_SECONDS = 15  # idle time before a client connection is closed
+HEADER_SECONDS = 10  # time a client gets to send a request's headers
+MAX_HEADER_LINES = 100
+MAX_FEEDS = 16  # feeds (both formats) kept, least recently used dropped
+
+VISIBILITIES = {
+    'public': (cal_events.EventVisibility.public, ),
+    'member': (cal_events.EventVisibility.member,
+               cal_events.EventVisibility.private),  # like private.ics
+}
+
+# kind 'events' or 'astro', years a range, visibility a VISIBILITIES key,
+# location a LOCATIONS key (or None), the last two are None for astro
+FeedKey = collections.namedtuple('FeedKey', 'kind years visibility location')
+
+
+class Feed(object):
+    '''One generated response body, with its validators.'''
+    __slots__ = ('body', 'etag', 'modified')
+
+    def __init__(self, body, modified):
+        self.body = body
+        self.etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        self.modified = int(modified)  # seconds, HTTP dates have no less
+
+
+class RequestError(Exception):
+    '''A request we answer with an error status.'''
+
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+
+# ==============================================================================
+# Feed generation, run in the server's executor
+# ==============================================================================
+def parse_query(path, query, default_years):
+    '''FeedKey and format for a request, RequestError if it's not a feed.'''
+    try:
+        kind, fmt = FEEDS[path]
+    except KeyError:
+        raise RequestError(404, 'Not Found')
+    params = urllib.parse.parse_qs(query)
+
+    def param(name, default=None):
+        values = params.get(name)
+        return values[-1] if values else default
+
+    try:
+        years = default_years
+        if param('years'):
+            years = cal_parallel.parse_years(param('years'))
+    except argparse.ArgumentTypeError:
+        raise RequestError(400, 'Bad years')
+    if len(years) > MAX_YEARS:
+        raise RequestError(400, 'Too many years')
+    if kind == 'astro':
+        return FeedKey(kind, years, None, None), fmt
+
+    visibility = param('visibility', 'public')
+    if visibility not in VISIBILITIES:
+        raise RequestError(400, 'Bad visibility')
+    location = param('location')
+    if location is not None:
+        try:
+            location = int(location)
+            cal_events.LOCATIONS[location]
+        except (KeyError, ValueError):
+            raise RequestError(400, 'Bad location')
+    return FeedKey(kind, years, visibility, location), fmt
+
+
+def gen_events(gen, key):
+    '''ICS and CSV bodies of the CalGen events selected by key.'''
+    start, until = gen.gen_years(key.years)
+    visibility = VISIBILITIES[key.visibility]
+    events = [
+        e for e in gen.events if e.visibility in visibility and (
+            key.location is None
+            or e.location == cal_events.LOCATIONS[key.location])
+    ]
+    if key.visibility == 'public':
+        prodid = 'SJAA Public Events Calendar'
+    else:
+        prodid = 'SJAA Member Only Events Calendar'
+
+    icfp = io.BytesIO()
+    gen.write_ical(start, until, prodid, events, icfp)
+    cfp = io.StringIO()
+    cal_gen.write_csv_file(gen, events, cfp, start, until)
+    return {'ics': icfp.getvalue(), 'csv': cfp.getvalue().encode('utf-8')}
+
+
+def gen_astro(key, cache_filename=None):
+    '''ICS and CSV bodies of the cal_astro almanac for key.years.'''
+    icfp = io.BytesIO()
+    cfp = io.StringIO()
+    cal_astro.write_astro(key.years, cfp, icfp,
+                          cache_filename=cache_filename)
+    return {'ics': icfp.getvalue(), 'csv': cfp.getvalue().encode('utf-8')}
+
+
+# ==============================================================================
+# Server
+# ==============================================================================
+class CalServer(object):
+    '''Calendar feeds over HTTP, generated once and served from memory.
+
+        GET/HEAD /events.ics, /events.csv ?years=2019-2021&visibility=
+        public|member&location=N and /astro.ics, /astro.csv ?years=...
+
+        Each feed is generated on first request (or by precompute()) in a
+        one thread executor, then served with an ETag and Last-Modified
+        so polling clients get a 304.  Only the MAX_FEEDS most recently
+        used feeds are kept, with the CalGen occurances behind them.  A
+        background task watches the catalog and, when its rules change,
+        drops the events feeds, regenerating just the precomputed ones.
+    '''
+
+    def __init__(self,
+                 years,
+                 catalog=cal_catalog.CATALOG,
+                 cache_filename=None,
+                 poll=POLL_SECONDS):
+        self.years = years  # default year range
+        self.catalog = catalog
+        self.cache_filename = cache_filename
+        self.poll = poll
+        self.feeds = collections.OrderedDict()  # FeedKey -> {format: Feed}
+        self.max_feeds = MAX_FEEDS
+        self.header_seconds = HEADER_SECONDS
+        self.warm = []  # FeedKeys given to precompute()
+        self.pending = {}  # FeedKey -> Future of the running generation
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.digest = self._catalog_digest()
+        self.gen = None  # CalGen, only touched in the executor
+        self.server = None
+        self.watcher = None
+        self.clients = set()  # open connections, as StreamWriters
+        self.requests = 0
+        self.generated = 0
+
+    def _catalog_digest(self):
+        with open(self.catalog, 'rb') as cfp:
+            return hashlib.sha1(cfp.read()).hexdigest()
+
+    # --------------------------------------
+    # Generation
+    # --------------------------------------
+    def _generate(self, key):
+        '''Bodies for a FeedKey (executor thread).'''
+        if key.kind == 'astro':
+            return gen_astro(key, self.cache_filename)
+        if self.gen is None:
+            cache = None
+            if self.cache_filename:
+                cache = cal_cache.EphemerisCache(self.cache_filename)
+            self.gen = cal_gen.CalGen(cache, self.catalog)
+        return gen_events(self.gen, key)
+
+    def _forget(self, years):
+        '''Drop the CalGen occurances of a span (executor thread).'''
+        if self.gen is None:
+            return
+        span = (cal_parallel.year_window(years[0])[0],
+                cal_parallel.year_window(years[-1])[1])
+        for key in [x for x in self.gen.occurances if x[1:] == span]:
+            del self.gen.occurances[key]
+
+    def _store(self, key, bodies):
+        now = time.time()
+        old = self.feeds.pop(key, {})
+        feeds = self.feeds[key] = {}
+        for fmt, body in bodies.items():
+            if fmt in old and old[fmt].body == body:
+                feeds[fmt] = old[fmt]  # same validators
+            else:
+                feeds[fmt] = Feed(body, now)
+        self.generated += 1
+        while len(self.feeds) > self.max_feeds:
+            dropped, _ = self.feeds.popitem(last=False)
+            if dropped.kind == 'events' and not any(
+                    x.kind == 'events' and x.years == dropped.years
+                    for x in self.feeds):
+                self.executor.submit(self._forget, dropped.years)
+
+    async def feed(self, key, fmt):
+        '''The Feed for a key and format, generated if we don't have it.'''
+        try:
+            feed = self.feeds[key][fmt]
+            self.feeds.move_to_end(key)
+            return feed
+        except KeyError:
+            pass
+        future = self.pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, self._generate, key)
+            self.pending[key] = future
+            try:
+                self._store(key, await future)
+            finally:
+                del self.pending[key]
+        else:
+            await asyncio.shield(future)
+        return self.feeds[key][fmt]
+
+    async def precompute(self, keys):
+        '''Generate feeds before any client asks, and after rule changes.'''
+        self.warm = list(keys)
+        for key in keys:
+            await self.feed(key, 'ics')
+
+    async def check_rules(self):
+        '''Drop the events feeds if the catalog changed.
+
+            Returns True when it did.  The precompute() feeds are
+            regenerated right away (clients get their previous bodies
+            until then), the rest on their next request.
+        '''
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(self.executor,
+                                            self._catalog_digest)
+        if digest == self.digest:
+            return False
+        self.digest = digest
+        await loop.run_in_executor(self.executor, self._reset)
+        warm = [x for x in self.warm if x.kind == 'events']
+        for key in [x for x in self.feeds if x.kind == 'events']:
+            if key not in warm:
+                del self.feeds[key]
+        for key in warm:
+            bodies = await loop.run_in_executor(self.executor, self._generate,
+                                                key)
+            self._store(key, bodies)
+        return True
+
+    def _reset(self):
+        if self.gen and self.gen.eph.cache:
+            self.gen.eph.cache.close()
+        self.gen = None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll)
+            try:
+                await self.check_rules()
+            except (OSError, ValueError) as err:
+                # a half written or broken catalog, keep the old feeds
+                print('catalog not reloaded: {}'.format(err))
+
+    # --------------------------------------
+    # HTTP
+    # --------------------------------------
+    async def start(self, host='127.0.0.1', port=8000):
+        '''Listen on host:port (0 = any free port), return the port.'''
+        self.server = await asyncio.start_server(self._client, host, port)
+        if self.poll:
+            self.watcher = asyncio.ensure_future(self._watch())
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.watcher:
+            self.watcher.cancel()
+        if self.server:
+            self.server.close()
+            for writer in list(self.clients):
+                writer.close()
+            await self.server.wait_closed()
+        self.executor.shutdown()
+
+    async def _client(self, reader, writer):
+        self.clients.add(writer)
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(),
+                                                  KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    break
+                if not line:
+                    break
+                try:
+                    headers = await asyncio.wait_for(
+                        self._read_headers(reader), self.header_seconds)
+                except asyncio.TimeoutError:
+                    break
+                keep = await self._respond(line, headers, writer)
+                await writer.drain()
+                if not keep:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    @staticmethod
+    async def _read_headers(reader):
+        headers = {}
+        for _ in range(MAX_HEADER_LINES):
+            header = await reader.readline()
+            if header in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = header.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return headers
+
+    async def _respond(self, line, headers, writer):
+        '''Answer one request, return whether to keep the connection.'''
+        self.requests += 1
+        try:
+            method, target, version = line.decode('latin-1').split()
+        except ValueError:
+            self._write(writer, 400, 'Bad Request', {}, b'', False)
+            return False
+        keep = (version == 'HTTP/1.1'
+                and headers.get('connection', '').lower() != 'close')
+        head = method == 'HEAD'
+        try:
+            if method not in ('GET', 'HEAD'):
+                raise RequestError(405, 'Method Not Allowed')
+            url = urllib.parse.urlsplit(target)
+            key, fmt = parse_query(url.path, url.query, self.years)
+            feed = await self.feed(key, fmt)
+        except RequestError as err:
+            self._write(writer, err.status, err.reason, {},
+                        (err.reason + '\n').encode('ascii'), keep, head)
+            return keep
+        except Exception as err:  # a failed generation, report and go on
+            print('{} failed: {!r}'.format(target, err))
+            self._write(writer, 500, 'Internal Server Error', {}, b'', False,
+                        head)
+            return False
+
+        extra = {
+            'Content-Type': CONTENT_TYPES[fmt],
+            'ETag': feed.etag,
+            'Last-Modified': email.utils.formatdate(feed.modified,
+                                                    usegmt=True),
+            'Cache-Control': 'no-cache',  # always revalidate, it's cheap
+        }
+        if self._not_modified(feed, headers):
+            self._write(writer, 304, 'Not Modified', extra, b'', keep, True)
+        else:
+            self._write(writer, 200, 'OK', extra, feed.body, keep, head)
+        return keep
+
+    @staticmethod
+    def _not_modified(feed, headers):
+        if 'if-none-match' in headers:
+            tags = [x.strip() for x in headers['if-none-match'].split(',')]
+            return feed.etag in tags or '*' in tags
+        if 'if-modified-since' in headers:
+            try:
+                since = email.utils.parsedate_to_datetime(
+                    headers['if-modified-since'])
+            except (TypeError, ValueError):
+                return False
+            return feed.modified <= since.timestamp()
+        return False
+
+    @staticmethod
+    def _write(writer, status, reason, extra, body, keep, head=False):
+        lines = ['HTTP/1.1 {} {}'.format(status, reason)]
+        lines.append('Date: ' + email.utils.formatdate(usegmt=True))
+        lines.extend('{}: {}'.format(*x) for x in extra.items())
+        if status != 304:
+            lines.append('Content-Length: {}'.format(len(body)))
+        lines.append('Connection: ' + ('keep-alive' if keep else 'close'))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if not head:
+            writer.write(body)
+
+
+# ==============================================================================
+def main():
+    '''Serve the calendar feeds until interrupted.'''
+    parser = argparse.ArgumentParser(description='Calendar Feed Server')
+    parser.add_argument(
+        '--host',
+        action='store',
+        default='127.0.0.1',
+        help='Address to listen on (default localhost only)')
+    parser.add_argument(
+        '--port', type=int, action='store', default=8000, help='TCP port')
+    parser.add_argument(
+        '--years',
+        type=cal_parallel.parse_years,
+        action='store',
+        default=range(datetime.date.today().year,
+                      datetime.date.today().year + 1),
+        help='Default range of years, e.g. 2019-2028 (default this year)')
+    parser.add_argument(
+        '--catalog',
+        action='store',
+        default=cal_catalog.CATALOG,
+        help='Event Catalog Filename (JSON), reloaded when it changes')
+    parser.add_argument(
+        '--cache',
+        action='store',
+        help='Ephemeris Cache Filename (SQLite), reused between runs')
+    args = parser.parse_args()
+
+    async def serve():
+        server = CalServer(args.years, args.catalog, args.cache)
+        port = await server.start(args.host, args.port)
+        print('serving on http://{}:{}/'.format(args.host, port),
+              flush=True)
+        # the feeds cal_gen.py and cal_astro.py write by default
+        await server.precompute([
+            FeedKey('events', args.years, 'public', None),
+            FeedKey('events', args.years, 'member', None),
+            FeedKey('astro', args.years, None, None),
+        ])
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+# ==============================================================================
+class TestUM(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.catalog = os.path.join(self.dirname, 'events.json')
+        shutil.copy(cal_catalog.CATALOG, self.catalog)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    async def get(self, port, target, headers=()):
+        '''Status, headers and body of one request on a new connection.'''
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        request = ['GET {} HTTP/1.1'.format(target), 'Host: localhost',
+                   'Connection: close'] + list(headers)
+        writer.write(('\r\n'.join(request) + '\r\n\r\n').encode('ascii'))
+        response = await reader.read()
+        writer.close()
+        head, _, body = response.partition(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        fields = dict(x.split(': ', 1) for x in lines[1:])
+        return int(lines[0].split()[1]), fields, body
+
+    async def exercise(self):
+        server = CalServer(range(2019, 2020), self.catalog, poll=0)
+        port = await server.start(port=0)
+        try:
+            status, fields, body = await self.get(port, '/events.ics')
+            self.assertEqual(status, 200)
+            self.assertEqual(fields['Content-Type'], CONTENT_TYPES['ics'])
+            # the same bytes cal_gen.py writes to public.ics
+            gen = cal_gen.CalGen(catalog=self.catalog)
+            start, until = gen.gen_years(range(2019, 2020))
+            icfp = io.BytesIO()
+            gen.gen_cal(start, until, True, icfp)
+            self.assertEqual(body, icfp.getvalue())
+
+            # conditional GETs
+            etag = fields['ETag']
+            status, _, body = await self.get(
+                port, '/events.ics', ['If-None-Match: ' + etag])
+            self.assertEqual((status, body), (304, b''))
+            status, _, _ = await self.get(
+                port, '/events.ics',
+                ['If-Modified-Since: ' + fields['Last-Modified']])
+            self.assertEqual(status, 304)
+            self.assertEqual(server.generated, 1)
+
+            # a location and the CSV, then errors
+            status, _, body = await self.get(
+                port, '/events.csv?years=2019&visibility=member&location=4')
+            self.assertEqual(status, 200)
+            self.assertEqual(
+                {x.split(',')[0] for x in body.decode().splitlines()[1:]},
+                {'Dark Sky Night'})
+            for target, error in (('/nothing', 404),
+                                  ('/events.ics?years=2020-2019', 400),
+                                  ('/events.ics?location=99', 400)):
+                status, _, _ = await self.get(port, target)
+                self.assertEqual(status, error)
+
+            # a rule change regenerates the feed, new ETag
+            self.assertFalse(await server.check_rules())
+            with open(self.catalog) as cfp:
+                catalog = json.load(cfp)
+            catalog['events'] = catalog['events'][1:]  # drop Intro class
+            with open(self.catalog, 'w') as cfp:
+                json.dump(catalog, cfp)
+            self.assertTrue(await server.check_rules())
+            status, fields, body = await self.get(
+                port, '/events.ics', ['If-None-Match: ' + etag])
+            self.assertEqual(status, 200)
+            self.assertNotEqual(fields['ETag'], etag)
+            self.assertNotIn(b'Intro to the Night Sky', body)
+
+            # only max_feeds feeds, and the occurances behind them, stay
+            server.max_feeds = 2
+            for years in ('2019', '2020', '2021'):
+                status, _, _ = await self.get(port,
+                                              '/events.ics?years=' + years)
+                self.assertEqual(status, 200)
+            self.assertEqual([x.years for x in server.feeds],
+                             [range(2020, 2021), range(2021, 2022)])
+            spans = await asyncio.get_running_loop().run_in_executor(
+                server.executor,
+                lambda: {x[1].year for x in server.gen.occurances})
+            self.assertEqual(spans, {2020, 2021})
+
+            # a client that never finishes its headers is dropped
+            server.header_seconds = 0.1
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET /events.ics HTTP/1.1\r\nHost: localhost\r\n')
+            self.assertEqual(await asyncio.wait_for(reader.read(), 5), b'')
+            writer.close()
+        finally:
+            await server.close()
+
+    def test_server(self):
+        """Feeds on localhost, cached (LRU) with ETags, reset on rule edits."""
+        asyncio.run(self.exercise())
+
+
+# -------------------------------------
+if __name__ == '__main__':
+    exit(main())